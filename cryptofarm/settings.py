@@ -66,6 +66,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'users.middleware.TelegramAuthMiddleware',  # Middleware для проверки Telegram авторизации
+    'users.middleware.RateLimitMiddleware',  # Ограничение частоты запросов пользователя
 ]
 
 ROOT_URLCONF = 'cryptofarm.urls'
@@ -152,6 +153,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'p2p.api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
 }
@@ -179,9 +184,37 @@ GAME_SETTINGS = {
         5: {'branches': 75, 'income': 3.0},
     },
     'BRANCH_DROP_CHANCE': 0.1,  # 10% шанс выпадения ветки
+    'AUTO_WATER_BRANCH_BOOST': 1.5,  # Множитель шанса ветки при автополиве
     'STAKING_DURATION': 7,  # Длительность стейкинга в днях
     'STAKING_BONUS': 0.1,  # +10% к доходу
     'P2P_COMMISSION': 0.03,  # 3% комиссия с P2P сделок
     'ORDER_EXPIRY': 3,  # Ордера истекают через 3 дня
+    'P2P_MARKET_PAGE_SIZE': 50,  # Количество ордеров на странице биржи
+    'ORDER_SWEEP_INTERVAL': 60,  # Интервал фоновой обработки истекших ордеров в секундах (0 — выключено)
+    'P2P_MARKET_DATA_TTL': 2,  # Время жизни кеша глубины стакана и тикера в секундах
+    'P2P_MAX_PRICE_ALERTS': 20,  # Максимум активных ценовых оповещений пользователя
     'MIN_CF_FOR_STAKING': 300,  # Минимальное количество CF для стейкинга
+    'GAME_RULES_RELOAD': 30,  # Как часто сверять переопределения игровых настроек в базе, секунд (0 — не читать)
+    # Ограничение частоты запросов пользователя: маршрут -> (емкость корзины, токенов в секунду).
+    # 'default' — для изменяющих запросов (POST/PUT/PATCH/DELETE) к остальным маршрутам
+    'RATE_LIMITS': {
+        'default': (30, 1.0),
+        'water_tree': (5, 0.5),
+        'collect_income': (5, 0.5),
+        'water_all': (3, 0.2),
+        'collect_all': (3, 0.2),
+        'upgrade_tree': (5, 0.2),
+        'buy_item': (5, 0.2),
+        'buy_tree': (3, 0.1),
+        'buy_autowater': (3, 0.1),
+        'create_staking': (3, 0.1),
+        'claim_staking': (5, 0.2),
+        'p2p:create_order': (5, 0.2),
+        'p2p:buy_order': (5, 0.2),
+        'p2p:send_message': (10, 0.5),
+        'p2p:order-list': (30, 1.0),
+        'p2p:order-buy': (5, 0.2),
+        'p2p:order-cancel': (5, 0.2),
+        'p2p:transaction-message-list': (30, 1.0),
+    },
 }
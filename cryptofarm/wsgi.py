@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cryptofarm.settings')
 
 application = get_wsgi_application()
+
+# Фоновая обработка истекших ордеров (только в процессе веб-сервера)
+from p2p.expiry import start_sweeper  # noqa: E402
+
+start_sweeper()
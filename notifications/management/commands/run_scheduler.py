@@ -0,0 +1,38 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from notifications.scheduler import BATCH_SIZE, REFILL_SECONDS, WINDOW, Scheduler
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает сроки ордеров, стейкингов, удобрения и автополива по мере их наступления'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=int(WINDOW.total_seconds()), metavar='SECONDS',
+                            help='На сколько вперед загружать сроки в очередь')
+        parser.add_argument('--refill', type=int, default=REFILL_SECONDS, metavar='SECONDS',
+                            help='Как часто пополнять очередь из базы')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Максимум сроков одного вида за одно пополнение')
+        parser.add_argument('--once', action='store_true',
+                            help='Обработать наступившие сроки и завершиться')
+
+    def handle(self, *args, **options):
+        window = datetime.timedelta(seconds=max(options['window'], options['refill']))
+        scheduler = Scheduler(window=window, batch_size=options['batch_size'])
+        while True:
+            close_old_connections()
+            now = timezone.now()
+            if scheduler.refilled_at is None or (now - scheduler.refilled_at).total_seconds() >= options['refill']:
+                scheduler.refill(now)
+            fired = scheduler.run_due(now)
+            for name, count in fired.items():
+                if count:
+                    self.stdout.write(self.style.SUCCESS(f'{name}: обработано {count}'))
+            if options['once']:
+                break
+            time.sleep(scheduler.seconds_until_next(options['refill']))
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='type',
+            field=models.CharField(choices=[('watering', 'Полив'), ('auto_water', 'Авто-полив'), ('order', 'Ордер'), ('price', 'Ценовое оповещение'), ('staking', 'Стейкинг'), ('referral', 'Реферал'), ('system', 'Системное')], max_length=10, verbose_name='Тип'),
+        ),
+    ]
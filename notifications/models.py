@@ -6,6 +6,7 @@ class Notification(models.Model):
         ('watering', 'Полив'),
         ('auto_water', 'Авто-полив'),
         ('order', 'Ордер'),
+        ('price', 'Ценовое оповещение'),
         ('staking', 'Стейкинг'),
         ('referral', 'Реферал'),
         ('system', 'Системное'),
@@ -0,0 +1,221 @@
+"""
+Планировщик сроков: истечение ордеров, завершение стейкингов и окончание
+удобрения и автополива.
+
+Ближайшие сроки хранятся в памяти процесса в куче (``heapq``) кортежей
+``(срок, вид, id)``. Куча пополняется окнами: раз в ``REFILL_SECONDS`` для
+каждого вида одним индексированным запросом читаются сроки в интервале
+(контрольная точка, ``now + WINDOW``], не больше ``BATCH_SIZE`` строк.
+Наступившие сроки снимаются с вершины кучи и обрабатываются пачкой на вид:
+обработчик заново проверяет условие в базе (срок могли продлить, ордер —
+купить или отменить), поэтому устаревшая запись в куче ничего не ломает.
+
+Контрольная точка вида (``SweepCheckpoint``) — момент, до которого все
+сроки уже обработаны; после перезапуска чтение продолжается с нее. При
+первом запуске точка ставится на текущий момент, чтобы не рассылать
+уведомления о давно прошедших сроках. ``Purchase.valid_until`` отдельно не
+планируется: он всегда совпадает со сроком автополива пользователя или
+дерева, уведомление о котором уже отправляется.
+"""
+import datetime
+import heapq
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from p2p.expiry import expire_orders
+from p2p.models import Order, SweepCheckpoint
+from staking.models import Staking
+from trees.models import Tree
+from users.models import User
+
+from .models import Notification, NotificationSettings
+
+WINDOW = datetime.timedelta(minutes=10)
+REFILL_SECONDS = 60
+BATCH_SIZE = 1000
+CHECKPOINT_PREFIX = 'scheduler:'
+
+logger = logging.getLogger(__name__)
+
+
+def _notify(rows, type, flag, title, message, user_key='user_id'):
+    """Создает уведомления одной вставкой, пропуская пользователей, отключивших их"""
+    muted = set(NotificationSettings.objects.filter(
+        user_id__in={row[user_key] for row in rows}, **{flag: False}
+    ).values_list('user_id', flat=True))
+    Notification.objects.bulk_create([
+        Notification(user_id=row[user_key], type=type, title=title, message=message(row))
+        for row in rows if row[user_key] not in muted
+    ])
+
+
+def complete_stakings(staking_ids, now):
+    """Переводит наступившие стейкинги в статус completed и уведомляет владельцев"""
+    with transaction.atomic():
+        rows = list(Staking.objects.select_for_update().filter(
+            pk__in=staking_ids, status='active', end_date__lte=now
+        ).values('id', 'user_id', 'amount', 'reward_amount', 'token_type'))
+        Staking.objects.filter(pk__in=[row['id'] for row in rows]).update(status='completed')
+        _notify(
+            rows, 'staking', 'staking_notifications', 'Стейкинг завершен',
+            lambda row: (
+                f"Стейкинг {row['amount']} {row['token_type']} завершен, "
+                f"награда {row['reward_amount']} {row['token_type']} доступна для получения"
+            ),
+        )
+    return len(rows)
+
+
+def _boost_handler(model, field, columns, type, flag, title, message):
+    """
+    Обработчик окончания бустера: уведомляет, если срок не продлили.
+    Первая из ``columns`` — поле с id пользователя.
+    """
+    def fire(ids, now):
+        rows = list(model.objects.filter(pk__in=ids, **{f'{field}__lte': now}).values(*columns))
+        _notify(rows, type, flag, title, message, user_key=columns[0])
+        return len(rows)
+    return fire
+
+
+class DeadlineKind:
+    """Вид сроков: поле модели, отбор строк и обработчик наступивших сроков"""
+
+    def __init__(self, name, queryset, field, fire):
+        self.name = name
+        self.queryset = queryset
+        self.field = field
+        self.fire = fire
+
+    @property
+    def checkpoint_name(self):
+        return CHECKPOINT_PREFIX + self.name
+
+    def upcoming(self, since, until, limit):
+        """Пары (id, срок) в интервале (``since``, ``until``] по возрастанию срока"""
+        return list(self.queryset().filter(**{
+            f'{self.field}__gt': since, f'{self.field}__lte': until
+        }).order_by(self.field, 'pk').values_list('pk', self.field)[:limit])
+
+
+KINDS = [
+    DeadlineKind(
+        'orders', lambda: Order.objects.filter(status='active'), 'expires_at', expire_orders,
+    ),
+    DeadlineKind(
+        'stakings', lambda: Staking.objects.filter(status='active'), 'end_date', complete_stakings,
+    ),
+    DeadlineKind(
+        'tree_fertilizer', Tree.objects.all, 'fertilized_until',
+        _boost_handler(
+            Tree, 'fertilized_until', ['user_id', 'type'], 'system', 'system_notifications', 'Удобрение закончилось',
+            lambda row: f"Действие удобрения на дереве {row['type']} закончилось",
+        ),
+    ),
+    DeadlineKind(
+        'tree_auto_water', Tree.objects.all, 'auto_water_until',
+        _boost_handler(
+            Tree, 'auto_water_until', ['user_id', 'type'], 'auto_water', 'auto_water_notifications', 'Автополив закончился',
+            lambda row: f"Автополив дерева {row['type']} закончился",
+        ),
+    ),
+    DeadlineKind(
+        'user_auto_water', User.objects.all, 'auto_water_until',
+        _boost_handler(
+            User, 'auto_water_until', ['pk'], 'auto_water', 'auto_water_notifications', 'Автополив закончился',
+            lambda row: "Срок действия автополива закончился",
+        ),
+    ),
+]
+
+
+class Scheduler:
+    """Куча ближайших сроков всех видов, пополняемая окнами из базы"""
+
+    def __init__(self, kinds=None, window=WINDOW, batch_size=BATCH_SIZE):
+        self.kinds = {kind.name: kind for kind in (kinds or KINDS)}
+        self.window = window
+        self.batch_size = batch_size
+        self.refilled_at = None
+        self._heap = []
+        self._queued = set()
+        self._checkpoints = {}
+        self._horizons = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _load_checkpoints(self, now):
+        names = {kind.checkpoint_name: kind.name for kind in self.kinds.values()}
+        positions = dict(SweepCheckpoint.objects.filter(name__in=names).values_list('name', 'position'))
+        for checkpoint_name, name in names.items():
+            position = positions.get(checkpoint_name)
+            if position is None:
+                position = now
+                SweepCheckpoint.objects.update_or_create(name=checkpoint_name, defaults={'position': now})
+            self._checkpoints[name] = position
+
+    def refill(self, now=None):
+        """Добавляет в кучу сроки до ``now + window``, которых в ней еще нет"""
+        now = now or timezone.now()
+        if not self._checkpoints:
+            self._load_checkpoints(now)
+        until = now + self.window
+        for name, kind in self.kinds.items():
+            rows = kind.upcoming(self._checkpoints[name], until, self.batch_size)
+            horizon = until
+            if len(rows) == self.batch_size:
+                # Окно не поместилось: сроки, равные последнему, дочитаются
+                # следующим пополнением вместе с остальными
+                last = rows[-1][1]
+                trimmed = [row for row in rows if row[1] < last]
+                if trimmed:
+                    rows = trimmed
+                    horizon = last - datetime.timedelta(microseconds=1)
+                else:
+                    horizon = last
+            for pk, deadline in rows:
+                item = (deadline, name, pk)
+                if item not in self._queued:
+                    self._queued.add(item)
+                    heapq.heappush(self._heap, item)
+            self._horizons[name] = horizon
+        self.refilled_at = now
+        return len(self._heap)
+
+    def run_due(self, now=None):
+        """Обрабатывает наступившие сроки; возвращает количество обработанных по видам"""
+        now = now or timezone.now()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            self._queued.discard(item)
+            due.setdefault(item[1], []).append(item[2])
+
+        fired = {}
+        for name, ids in due.items():
+            try:
+                fired[name] = self.kinds[name].fire(ids, now)
+            except Exception:
+                # Контрольная точка не сдвигается: сроки перечитаются следующим пополнением
+                logger.exception("Ошибка при обработке сроков %s", name)
+                self._horizons[name] = self._checkpoints[name]
+
+        for name in self._horizons:
+            position = min(now, self._horizons[name])
+            if position > self._checkpoints[name]:
+                self._checkpoints[name] = position
+                SweepCheckpoint.objects.filter(name=self.kinds[name].checkpoint_name).update(
+                    position=position, updated_at=timezone.now()
+                )
+        return fired
+
+    def seconds_until_next(self, refill_seconds=REFILL_SECONDS, now=None):
+        """Сколько можно спать до ближайшего срока или следующего пополнения"""
+        now = now or timezone.now()
+        wake = self.refilled_at + datetime.timedelta(seconds=refill_seconds)
+        if self._heap:
+            wake = min(wake, self._heap[0][0])
+        return max((wake - now).total_seconds(), 0)
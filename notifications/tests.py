@@ -1,3 +1,90 @@
 from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
 
-# Create your tests here.
+from notifications.models import Notification, NotificationSettings
+from notifications.scheduler import Scheduler
+from p2p.models import Order, SweepCheckpoint
+from staking.models import Staking
+from trees.models import Tree
+from users.models import User
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = User.objects.create(
+            telegram_id=111111111,
+            username='user',
+            first_name='User',
+            cf_balance=Decimal('1000'),
+        )
+        self.scheduler = Scheduler()
+        self.scheduler.refill(self.now)
+
+    def later(self, **kwargs):
+        return self.now + timezone.timedelta(**kwargs)
+
+    def test_fires_due_deadlines_in_order(self):
+        order = Order.objects.create(
+            user=self.user, type='buy', token_type='CF', amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'), min_amount=Decimal('1'), expires_at=self.later(minutes=1)
+        )
+        staking = Staking.objects.create(user=self.user, amount=Decimal('100'), end_date=self.later(minutes=2))
+        Tree.objects.create(user=self.user, type='CF', fertilized_until=self.later(minutes=3))
+        self.scheduler.refill(self.now)
+        self.assertEqual(len(self.scheduler), 3)
+
+        self.assertEqual(self.scheduler.run_due(self.later(seconds=90)), {'orders': 1})
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'expired')
+        self.assertEqual(Staking.objects.get(pk=staking.pk).status, 'active')
+
+        self.assertEqual(self.scheduler.run_due(self.later(minutes=5)), {'stakings': 1, 'tree_fertilizer': 1})
+        self.assertEqual(Staking.objects.get(pk=staking.pk).status, 'completed')
+        self.assertEqual(
+            set(Notification.objects.values_list('type', flat=True)), {'order', 'staking', 'system'}
+        )
+
+    def test_extended_boost_is_not_notified(self):
+        User.objects.filter(pk=self.user.pk).update(auto_water_until=self.later(minutes=1))
+        self.scheduler.refill(self.now)
+        # Автополив продлили после загрузки срока в очередь
+        User.objects.filter(pk=self.user.pk).update(auto_water_until=self.later(days=1))
+
+        self.assertEqual(self.scheduler.run_due(self.later(minutes=2)), {'user_auto_water': 0})
+        self.assertFalse(Notification.objects.exists())
+
+    def test_muted_users_are_skipped(self):
+        NotificationSettings.objects.create(user=self.user, auto_water_notifications=False)
+        Tree.objects.create(user=self.user, type='CF', auto_water_until=self.later(minutes=1))
+        self.scheduler.refill(self.now)
+
+        self.assertEqual(self.scheduler.run_due(self.later(minutes=2)), {'tree_auto_water': 1})
+        self.assertFalse(Notification.objects.exists())
+
+    def test_restart_resumes_from_checkpoint(self):
+        Tree.objects.create(user=self.user, type='CF', fertilized_until=self.later(minutes=1))
+        Tree.objects.create(user=self.user, type='TON', fertilized_until=self.later(minutes=3))
+        self.scheduler.refill(self.now)
+        self.scheduler.run_due(self.later(minutes=2))
+        self.assertEqual(
+            SweepCheckpoint.objects.get(name='scheduler:tree_fertilizer').position, self.later(minutes=2)
+        )
+
+        restarted = Scheduler()
+        restarted.refill(self.later(minutes=2))
+        self.assertEqual(len(restarted), 1)
+        self.assertEqual(restarted.run_due(self.later(minutes=4)), {'tree_fertilizer': 1})
+        self.assertEqual(Notification.objects.filter(type='system').count(), 2)
+
+    def test_refill_is_limited_by_batch_size(self):
+        for index, token in enumerate(('CF', 'TON')):
+            Tree.objects.create(user=self.user, type=token, auto_water_until=self.later(minutes=index + 1))
+        scheduler = Scheduler(batch_size=1)
+        scheduler.refill(self.now)
+        self.assertEqual(len(scheduler), 1)
+
+        scheduler.run_due(self.later(minutes=5))
+        scheduler.refill(self.later(minutes=5))
+        self.assertEqual(scheduler.run_due(self.later(minutes=5)), {'tree_auto_water': 1})
+        self.assertEqual(Notification.objects.filter(type='auto_water').count(), 2)
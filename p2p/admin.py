@@ -1,11 +1,14 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
-from django.db.models import Sum, Count, F, Q
+from django.db.models import Sum, F, Q
 from django.utils import timezone
+from django.db import transaction
 from decimal import Decimal
 
 from .models import Order, Transaction, Message
+from . import orderbook
+from .settlement import refund_locked, settle_transactions
 
 
 class MessageInline(admin.TabularInline):
@@ -136,31 +139,25 @@ class OrderAdmin(admin.ModelAdmin):
     
     def activate_orders(self, request, queryset):
         """Активация выбранных ордеров"""
+        order_ids = list(queryset.values_list('id', flat=True))
         updated = queryset.update(status='active', expires_at=timezone.now() + timezone.timedelta(days=3))
+        orderbook.refresh(order_ids)
         self.message_user(request, f'Успешно активировано {updated} ордеров.')
     
     activate_orders.short_description = "Активировать выбранные ордера"
     
     def cancel_orders(self, request, queryset):
         """Отмена выбранных ордеров"""
-        active_orders = queryset.filter(status='active')
-        count = active_orders.count()
-        
-        # Для ордеров на продажу нужно вернуть средства пользователям
-        for order in active_orders:
-            if order.type == 'sell':
-                user = order.user
-                if order.token_type == 'CF':
-                    user.cf_balance += order.amount
-                elif order.token_type == 'TON':
-                    user.ton_balance += order.amount
-                elif order.token_type == 'NOT':
-                    user.not_balance += order.amount
-                user.save()
-        
-        # Отмечаем ордера как отмененные
-        active_orders.update(status='cancelled')
-        
+        with transaction.atomic():
+            rows = list(queryset.filter(status='active').select_for_update().values(
+                'id', 'user_id', 'type', 'token_type', 'amount'
+            ))
+            order_ids = [row['id'] for row in rows]
+            count = Order.objects.filter(pk__in=order_ids, status='active').update(status='cancelled')
+            # Для ордеров на продажу возвращаем средства пользователям
+            refund_locked(rows)
+            orderbook.refresh(order_ids)
+
         self.message_user(request, f'Успешно отменено {count} ордеров. Средства возвращены пользователям.')
     
     cancel_orders.short_description = "Отменить выбранные ордера и вернуть средства"
@@ -168,7 +165,9 @@ class OrderAdmin(admin.ModelAdmin):
     def extend_expiration(self, request, queryset):
         """Продление срока действия ордеров"""
         active_orders = queryset.filter(status='active')
+        order_ids = list(active_orders.values_list('id', flat=True))
         updated = active_orders.update(expires_at=timezone.now() + timezone.timedelta(days=3))
+        orderbook.refresh(order_ids)
         self.message_user(request, f'Срок действия продлен для {updated} ордеров.')
     
     extend_expiration.short_description = "Продлить срок действия на 3 дня"
@@ -282,71 +281,23 @@ class TransactionAdmin(admin.ModelAdmin):
     
     def message_count(self, obj):
         """Количество сообщений в транзакции"""
-        count = obj.message_set.count()
+        count = obj.message_count
         if count > 0:
             return format_html('<span style="background-color: #17a2b8; color: white; padding: 2px 6px; border-radius: 10px;">{}</span>', count)
         return '0'
     
     message_count.short_description = 'Сообщения'
+    message_count.admin_order_field = 'message_count'
     
     def get_queryset(self, request):
         """Оптимизация запросов"""
         queryset = super().get_queryset(request)
-        return queryset.select_related('order', 'buyer', 'seller').annotate(
-            message_count=Count('message')
-        )
+        return queryset.select_related('order', 'buyer', 'seller')
     
     def complete_transactions(self, request, queryset):
         """Завершение выбранных транзакций"""
-        pending_transactions = queryset.filter(status='paid')
-        count = pending_transactions.count()
-        
-        for transaction in pending_transactions:
-            # Выполняем обмен средствами
-            buyer = transaction.buyer
-            seller = transaction.seller
-            amount = transaction.amount
-            price = amount * transaction.price_per_unit
-            
-            if transaction.token_type == 'CF':
-                if transaction.order.type == 'sell':
-                    # Продавец продает CF, покупатель получает CF
-                    buyer.cf_balance += amount
-                    buyer.ton_balance -= price
-                    seller.ton_balance += price
-                else:  # buy order
-                    # Продавец продает TON за CF, покупатель получает TON
-                    seller.cf_balance += amount
-                    seller.ton_balance -= price
-                    buyer.ton_balance += price
-            elif transaction.token_type == 'TON':
-                if transaction.order.type == 'sell':
-                    # Продавец продает TON, покупатель получает TON
-                    buyer.ton_balance += amount
-                    buyer.cf_balance -= price
-                    seller.cf_balance += price
-                else:  # buy order
-                    # Продавец продает CF за TON, покупатель получает CF
-                    seller.ton_balance += amount
-                    seller.cf_balance -= price
-                    buyer.cf_balance += price
-            elif transaction.token_type == 'NOT':
-                if transaction.order.type == 'sell':
-                    # Продавец продает NOT, покупатель получает NOT
-                    buyer.not_balance += amount
-                    buyer.ton_balance -= price
-                    seller.ton_balance += price
-                else:  # buy order
-                    # Продавец продает TON за NOT, покупатель получает TON
-                    seller.not_balance += amount
-                    seller.ton_balance -= price
-                    buyer.ton_balance += price
-            
-            buyer.save()
-            seller.save()
-        
-        # Отмечаем транзакции как завершенные
-        pending_transactions.update(status='completed')
+        # Переводим средства по всем оплаченным сделкам одной пачкой
+        count = len(settle_transactions(queryset.filter(status='paid')))
         
         self.message_user(request, f'Успешно завершено {count} транзакций. Средства переведены между пользователями.')
     
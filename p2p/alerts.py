@@ -0,0 +1,180 @@
+"""
+Ценовые оповещения P2P-биржи.
+
+Активные оповещения хранятся в памяти процесса: для каждого токена — два
+отсортированных по порогу массива, «выше» и «ниже». После каждой пачки
+завершенных сделок ``check_trades`` находит все сработавшие оповещения одним ``bisect``
+на массив: для «выше» это пороги не больше максимальной цены пачки, для
+«ниже» — не меньше минимальной. Сработавшие оповещения отключаются в той же
+транзакции БД, что и сделки, а уведомления создаются одним ``bulk_create``.
+
+Индекс загружается из базы при первом обращении и обновляется через
+``sync_alert`` после фиксации транзакции. Оповещения, созданные другими
+процессами, попадают в индекс при перезагрузке раз в ``RELOAD_SECONDS``.
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+from operator import itemgetter
+
+from django.db import transaction
+from django.utils import timezone
+
+from notifications.models import Notification
+
+from .models import Order, PriceAlert
+
+RELOAD_SECONDS = 60
+
+_threshold = itemgetter(0)
+
+
+class AlertIndex:
+    """Активные оповещения одного токена, отсортированные по порогу"""
+
+    def __init__(self):
+        self._keys = {'above': [], 'below': []}
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, alert_id, direction, threshold):
+        self.remove(alert_id)
+        self._entries[alert_id] = (direction, threshold)
+        insort(self._keys[direction], (threshold, alert_id))
+
+    def remove(self, alert_id):
+        entry = self._entries.pop(alert_id, None)
+        if entry is None:
+            return
+        direction, threshold = entry
+        keys = self._keys[direction]
+        index = bisect_left(keys, (threshold, alert_id))
+        if index < len(keys) and keys[index][1] == alert_id:
+            del keys[index]
+
+    def triggered(self, low, high):
+        """id оповещений, сработавших при ценах сделок от ``low`` до ``high``"""
+        above = self._keys['above']
+        below = self._keys['below']
+        ids = [alert_id for _, alert_id in above[:bisect_right(above, high, key=_threshold)]]
+        ids.extend(alert_id for _, alert_id in below[bisect_left(below, low, key=_threshold):])
+        return ids
+
+
+_indexes = {}
+_lock = threading.RLock()
+_loaded_at = None
+
+
+def _load():
+    global _loaded_at
+    indexes = {token: AlertIndex() for token, _ in Order.TOKEN_CHOICES}
+    rows = PriceAlert.objects.filter(is_active=True).values_list('id', 'token_type', 'direction', 'threshold')
+    for alert_id, token_type, direction, threshold in rows.iterator():
+        indexes.setdefault(token_type, AlertIndex()).add(alert_id, direction, threshold)
+    _indexes.clear()
+    _indexes.update(indexes)
+    _loaded_at = time.monotonic()
+
+
+def get_index(token_type):
+    """Индекс оповещений токена, при необходимости загруженный из базы"""
+    with _lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at > RELOAD_SECONDS:
+            _load()
+        return _indexes.setdefault(token_type, AlertIndex())
+
+
+def reset():
+    """Сбрасывает индекс; при следующем обращении он будет загружен заново"""
+    global _loaded_at
+    with _lock:
+        _indexes.clear()
+        _loaded_at = None
+
+
+def _apply(alert_id, token_type, direction=None, threshold=None):
+    with _lock:
+        if _loaded_at is None:
+            return
+        index = _indexes.setdefault(token_type, AlertIndex())
+        if direction is None:
+            index.remove(alert_id)
+        else:
+            index.add(alert_id, direction, threshold)
+
+
+def sync_alert(alert):
+    """
+    Приводит индекс в соответствие с состоянием оповещения.
+    Изменение применяется после фиксации текущей транзакции БД.
+    """
+    alert_id, token_type = alert.pk, alert.token_type
+    if alert.is_active and alert_id is not None:
+        direction, threshold = alert.direction, Decimal(str(alert.threshold))
+        transaction.on_commit(lambda: _apply(alert_id, token_type, direction, threshold))
+    else:
+        transaction.on_commit(lambda: _apply(alert_id, token_type))
+
+
+def price_ranges(deals):
+    """Минимальная и максимальная цена сделок по токенам"""
+    ranges = {}
+    for deal in deals:
+        price = Decimal(str(deal.price_per_unit))
+        low, high = ranges.get(deal.token_type, (price, price))
+        ranges[deal.token_type] = (min(low, price), max(high, price))
+    return ranges
+
+
+def _format_price(value):
+    return f'{Decimal(value).normalize():f}'
+
+
+def alert_message(alert, low, high):
+    threshold = _format_price(alert.threshold)
+    if alert.direction == 'above':
+        return f"Цена {alert.token_type} поднялась до {_format_price(high)} (порог {threshold})"
+    return f"Цена {alert.token_type} опустилась до {_format_price(low)} (порог {threshold})"
+
+
+def check_trades(deals):
+    """
+    Отключает оповещения, сработавшие по ценам новых сделок, и создает
+    уведомления. Вызывается в транзакции, завершающей сделки; возвращает
+    созданные уведомления.
+    """
+    ranges = price_ranges(deals)
+    candidates = {}
+    with _lock:
+        for token_type, (low, high) in ranges.items():
+            for alert_id in get_index(token_type).triggered(low, high):
+                candidates[alert_id] = token_type
+    if not candidates:
+        return []
+
+    with transaction.atomic():
+        # Блокировка строк не дает параллельному процессу отправить уведомление повторно
+        alerts = list(PriceAlert.objects.select_for_update().filter(pk__in=list(candidates), is_active=True))
+        PriceAlert.objects.filter(pk__in=[alert.pk for alert in alerts]).update(
+            is_active=False, triggered_at=timezone.now()
+        )
+        notifications = Notification.objects.bulk_create([
+            Notification(
+                user_id=alert.user_id,
+                type='price',
+                title='Ценовое оповещение',
+                message=alert_message(alert, *ranges[alert.token_type]),
+            )
+            for alert in alerts
+        ])
+
+    def discard():
+        for alert_id, token_type in candidates.items():
+            _apply(alert_id, token_type)
+
+    transaction.on_commit(discard)
+    return notifications
@@ -0,0 +1,33 @@
+"""
+Быстрый JSON-рендерер ответов DRF.
+
+Если установлен ``orjson``, ответы кодируются им; типы, которых ``orjson``
+не знает (``Decimal``, ``datetime`` и т. п.), передаются кодировщику DRF,
+поэтому формат ответа совпадает со стандартным ``JSONRenderer``. Без
+``orjson`` и для ответов с отступами (Browsable API, ``indent=``)
+используется стандартный рендерер.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` на ``orjson``"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        ret = orjson.dumps(
+            data,
+            default=JSONEncoder().default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
+        # Как и стандартный рендерер, экранируем разделители строк, недопустимые в JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
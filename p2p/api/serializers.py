@@ -1,6 +1,12 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 from django.utils import timezone
-from p2p.models import Order, Transaction, Message
+from django.conf import settings
+from django.db import transaction
+from p2p.models import Order, Transaction, Message, PriceAlert
+from p2p.matching import match_order
+from p2p.settlement import lock_funds
 from users.api.serializers import UserSerializer
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -40,6 +46,70 @@ class OrderSerializer(serializers.ModelSerializer):
         return data
 
 
+AMOUNT_STEP = Decimal('0.01')
+PRICE_STEP = Decimal('0.00000001')
+
+# Поля строк ``.values()`` для компактных сериализаторов списков
+ORDER_LIST_FIELDS = (
+    'id', 'user_id', 'user__username', 'type', 'token_type', 'amount', 'price_per_unit',
+    'min_amount', 'payment_details', 'status', 'created_at', 'expires_at',
+)
+TRANSACTION_LIST_FIELDS = (
+    'id', 'order_id', 'order__type', 'buyer_id', 'buyer__username', 'seller_id', 'seller__username',
+    'amount', 'price_per_unit', 'token_type', 'commission', 'status', 'created_at', 'updated_at',
+    'message_count', 'buyer_unread', 'seller_unread',
+)
+
+
+def format_decimal(value, step):
+    return f'{value.quantize(step):f}'
+
+
+def format_datetime(value):
+    """Дата в формате DRF по умолчанию: ISO 8601 в текущем часовом поясе"""
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+class CompactListSerializer(serializers.BaseSerializer):
+    """
+    Сериализатор списков только для чтения: строки ``.values()`` без вложенных
+    сериализаторов, текущее время берется один раз на страницу
+    """
+
+    @property
+    def now(self):
+        if not hasattr(self, '_now'):
+            self._now = self.context.get('now') or timezone.now()
+        return self._now
+
+
+class OrderListSerializer(CompactListSerializer):
+    """Компактное представление ордера в списках: строка ``.values(*ORDER_LIST_FIELDS)``"""
+
+    def to_representation(self, row):
+        remaining = (row['expires_at'] - self.now).total_seconds()
+        return {
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'username': row['user__username'],
+            'type': row['type'],
+            'token_type': row['token_type'],
+            'amount': format_decimal(row['amount'], AMOUNT_STEP),
+            'price_per_unit': format_decimal(row['price_per_unit'], PRICE_STEP),
+            'min_amount': format_decimal(row['min_amount'], AMOUNT_STEP),
+            'payment_details': row['payment_details'],
+            'status': row['status'],
+            'created_at': format_datetime(row['created_at']),
+            'expires_at': format_datetime(row['expires_at']),
+            'is_expired': remaining < 0,
+            'total_price': format_decimal(row['amount'] * row['price_per_unit'], AMOUNT_STEP),
+            'expires_in': int(remaining) if remaining > 0 else 0,
+        }
+
+
 class OrderCreateSerializer(serializers.ModelSerializer):
     """Сериализатор для создания ордера"""
     class Meta:
@@ -87,23 +157,22 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         """Создание нового ордера"""
         user = self.context['request'].user
         
-        # Создаем ордер
-        order = Order.objects.create(
-            user=user,
-            **validated_data,
-            expires_at=timezone.now() + timezone.timedelta(days=3)  # Срок действия ордера по умолчанию
-        )
-        
-        # Если это ордер на продажу, блокируем средства на балансе пользователя
-        if order.type == 'sell':
-            if order.token_type == 'CF':
-                user.cf_balance -= order.amount
-            elif order.token_type == 'TON':
-                user.ton_balance -= order.amount
-            elif order.token_type == 'NOT':
-                user.not_balance -= order.amount
+        # Ордер, блокировка средств и сведение со стаканом фиксируются вместе
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user,
+                **validated_data,
+                expires_at=timezone.now() + timezone.timedelta(days=3)  # Срок действия ордера по умолчанию
+            )
             
-            user.save()
+            # Если это ордер на продажу, блокируем средства, только если их все еще хватает
+            if not lock_funds(order):
+                raise serializers.ValidationError(
+                    f"Недостаточно средств на балансе. Требуется {order.amount} {order.token_type}"
+                )
+            
+            # Сводим ордер со встречными ордерами стакана
+            match_order(order)
         
         return order
 
@@ -114,19 +183,60 @@ class TransactionSerializer(serializers.ModelSerializer):
     seller = UserSerializer(read_only=True)
     total_price = serializers.DecimalField(max_digits=15, decimal_places=2, read_only=True)
     total_with_commission = serializers.DecimalField(max_digits=15, decimal_places=2, read_only=True)
+    unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Transaction
         fields = (
             'id', 'order', 'buyer', 'seller', 'amount', 'price_per_unit',
             'token_type', 'commission', 'status', 'created_at', 'updated_at',
-            'total_price', 'total_with_commission'
+            'total_price', 'total_with_commission', 'message_count', 'unread_count'
         )
         read_only_fields = (
             'id', 'order', 'buyer', 'seller', 'amount', 'price_per_unit',
             'token_type', 'commission', 'created_at', 'updated_at',
-            'total_price', 'total_with_commission'
+            'total_price', 'total_with_commission', 'message_count', 'unread_count'
         )
+    
+    def get_unread_count(self, obj):
+        """Непрочитанные текущим пользователем сообщения — из счетчика сделки, без запросов"""
+        request = self.context.get('request')
+        if request is None:
+            return 0
+        return obj.unread_for(request.user)
+
+
+class TransactionListSerializer(CompactListSerializer):
+    """Компактное представление сделки в списках: строка ``.values(*TRANSACTION_LIST_FIELDS)``"""
+
+    def to_representation(self, row):
+        request = self.context.get('request')
+        user_id = request.user.pk if request is not None else None
+        if user_id == row['buyer_id']:
+            unread = row['buyer_unread']
+        elif user_id == row['seller_id']:
+            unread = row['seller_unread']
+        else:
+            unread = 0
+        return {
+            'id': row['id'],
+            'order_id': row['order_id'],
+            'order_type': row['order__type'],
+            'buyer_id': row['buyer_id'],
+            'buyer_username': row['buyer__username'],
+            'seller_id': row['seller_id'],
+            'seller_username': row['seller__username'],
+            'amount': format_decimal(row['amount'], AMOUNT_STEP),
+            'price_per_unit': format_decimal(row['price_per_unit'], PRICE_STEP),
+            'token_type': row['token_type'],
+            'commission': format_decimal(row['commission'], PRICE_STEP),
+            'status': row['status'],
+            'created_at': format_datetime(row['created_at']),
+            'updated_at': format_datetime(row['updated_at']),
+            'total_price': format_decimal(row['amount'] * row['price_per_unit'], AMOUNT_STEP),
+            'message_count': row['message_count'],
+            'unread_count': unread,
+        }
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -156,4 +266,24 @@ class MessageSerializer(serializers.ModelSerializer):
             content=validated_data['content']
         )
         
-        return message 
\ No newline at end of file
+        return message
+
+
+class PriceAlertSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PriceAlert
+        fields = ('id', 'token_type', 'direction', 'threshold', 'is_active', 'created_at', 'triggered_at')
+        read_only_fields = ('id', 'is_active', 'created_at', 'triggered_at')
+    
+    def validate_threshold(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Порог цены должен быть положительным")
+        return value
+    
+    def validate(self, data):
+        user = self.context['request'].user
+        limit = settings.GAME_SETTINGS.get('P2P_MAX_PRICE_ALERTS', 20)
+        if PriceAlert.objects.filter(user=user, is_active=True).count() >= limit:
+            raise serializers.ValidationError(f"Можно создать не больше {limit} активных оповещений")
+        return data
+
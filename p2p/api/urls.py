@@ -1,18 +1,23 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested.routers import NestedDefaultRouter
-from .views import OrderViewSet, TransactionViewSet, MessageViewSet
+from .views import (
+    OrderViewSet, TransactionViewSet, MessageViewSet, PriceAlertViewSet, market_depth, market_ticker
+)
 
 # Создаем основной роутер
 router = DefaultRouter()
 router.register(r'orders', OrderViewSet, basename='order')
 router.register(r'transactions', TransactionViewSet, basename='transaction')
+router.register(r'alerts', PriceAlertViewSet, basename='price-alert')
 
 # Создаем вложенный роутер для сообщений в транзакциях
 transactions_router = NestedDefaultRouter(router, r'transactions', lookup='transaction')
 transactions_router.register(r'messages', MessageViewSet, basename='transaction-message')
 
 urlpatterns = [
+    path('depth/<str:token>/', market_depth, name='market-depth'),
+    path('ticker/', market_ticker, name='market-ticker'),
     path('', include(router.urls)),
     path('', include(transactions_router.urls)),
 ] 
\ No newline at end of file
@@ -1,19 +1,43 @@
-from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import action
+from rest_framework import mixins, viewsets, permissions, status
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.db.models import Q
 from django.utils import timezone
 from django.conf import settings
-from decimal import Decimal
+from django.db import transaction as db_transaction
+from decimal import Decimal, InvalidOperation
 
-from p2p.models import Order, Transaction, Message
+from p2p.models import Order, Transaction, Message, PriceAlert
+from p2p import alerts, chat, market, orderbook
+from p2p.matching import FillError, cancel_order, fill_order
+from p2p.pagination import (
+    AscendingKeysetPagination, KeysetPagination, decode_book_cursor, encode_book_cursor,
+)
+from p2p.settlement import settle_transactions
+from users.idempotency import idempotent
 from .serializers import (
-    OrderSerializer, OrderCreateSerializer,
-    TransactionSerializer, MessageSerializer
+    ORDER_LIST_FIELDS, TRANSACTION_LIST_FIELDS,
+    OrderSerializer, OrderCreateSerializer, OrderListSerializer,
+    TransactionSerializer, TransactionListSerializer, MessageSerializer, PriceAlertSerializer
 )
 from p2p.permissions import HasP2PAccess, IsOrderOwner, IsTransactionParticipant
 
 
+def _parse_price(value):
+    """Цена из параметра запроса; для некорректного значения — ``ValueError``"""
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(value)
+    if not price.is_finite():
+        raise ValueError(value)
+    return price
+
+
 class OrderViewSet(viewsets.ModelViewSet):
     """
     API для работы с ордерами P2P-биржи
@@ -22,41 +46,64 @@ class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     
     def get_queryset(self):
-        """Возвращает ордера с фильтрацией"""
-        # Базовый queryset с активными ордерами
+        """Ордера для действий над конкретным ордером; список строится в ``list`` из стакана"""
         queryset = Order.objects.filter(status='active', expires_at__gt=timezone.now())
-        
-        # Фильтр по типу ордера (buy/sell)
-        order_type = self.request.query_params.get('type')
-        if order_type:
-            queryset = queryset.filter(type=order_type)
-        
-        # Фильтр по типу токена
-        token_type = self.request.query_params.get('token_type')
-        if token_type:
-            queryset = queryset.filter(token_type=token_type)
-        
-        # Фильтр по минимальной цене
-        min_price = self.request.query_params.get('min_price')
-        if min_price:
-            queryset = queryset.filter(price_per_unit__gte=Decimal(min_price))
-        
-        # Фильтр по максимальной цене
-        max_price = self.request.query_params.get('max_price')
-        if max_price:
-            queryset = queryset.filter(price_per_unit__lte=Decimal(max_price))
-        
-        # Исключаем ордера текущего пользователя
-        exclude_own = self.request.query_params.get('exclude_own')
-        if exclude_own and exclude_own.lower() == 'true':
-            queryset = queryset.exclude(user=self.request.user)
-        
         return queryset.select_related('user').order_by('-created_at')
     
+    def list(self, request, *args, **kwargs):
+        """
+        Список живых ордеров из стакана, без сканирования таблицы.
+        Ордера идут по токенам, в каждом сначала продажа, затем покупка,
+        внутри стороны — в порядке цена-время; страница продолжается по
+        курсору ``cursor`` и читает из стакана только свои записи.
+        """
+        params = request.query_params
+        exclude_own = params.get('exclude_own')
+        try:
+            min_price = _parse_price(params.get('min_price'))
+            max_price = _parse_price(params.get('max_price'))
+        except ValueError:
+            return Response({'error': 'Некорректная цена'}, status=status.HTTP_400_BAD_REQUEST)
+        side = params.get('type') or None
+        if side not in (None, 'buy', 'sell'):
+            return Response({'error': 'Некорректный тип ордера'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE') or 10
+        cursor = params.get('cursor')
+        try:
+            entries = orderbook.select_entries(
+                token_type=params.get('token_type') or None,
+                side=side,
+                exclude_user=request.user.pk if exclude_own and exclude_own.lower() == 'true' else None,
+                min_price=min_price,
+                max_price=max_price,
+                limit=page_size + 1,
+                after=decode_book_cursor(cursor) if cursor else None,
+            )
+        except ValueError:
+            raise NotFound('Некорректный курсор')
+        has_next = len(entries) > page_size
+        entries = entries[:page_size]
+        
+        # Списки сериализуются из строк .values(), без моделей и вложенных сериализаторов
+        rows = {
+            row['id']: row
+            for row in Order.objects.filter(pk__in=[entry.id for entry in entries]).values(*ORDER_LIST_FIELDS)
+        }
+        data = self.get_serializer([rows[entry.id] for entry in entries if entry.id in rows], many=True).data
+        next_link = None
+        if has_next:
+            next_link = replace_query_param(
+                request.build_absolute_uri(), 'cursor', encode_book_cursor(entries[-1])
+            )
+        return Response({'next': next_link, 'previous': None, 'results': data})
+    
     def get_serializer_class(self):
         """Выбор сериализатора в зависимости от действия"""
         if self.action == 'create':
             return OrderCreateSerializer
+        if self.action == 'list':
+            return OrderListSerializer
         return OrderSerializer
     
     def perform_create(self, serializer):
@@ -68,153 +115,51 @@ class OrderViewSet(viewsets.ModelViewSet):
         """Отмена ордера"""
         order = self.get_object()
         
-        if order.status != 'active':
-            return Response(
-                {"error": "Можно отменить только активный ордер"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Отменяем ордер
-        order.status = 'cancelled'
-        order.save()
-        
-        # Если это ордер на продажу, возвращаем средства на баланс
-        if order.type == 'sell':
-            user = order.user
-            if order.token_type == 'CF':
-                user.cf_balance += order.amount
-            elif order.token_type == 'TON':
-                user.ton_balance += order.amount
-            elif order.token_type == 'NOT':
-                user.not_balance += order.amount
-            
-            user.save()
+        # Статус меняется условным UPDATE, а возвращается остаток, перечитанный
+        # после него, поэтому параллельное исполнение не вернет средства дважды
+        try:
+            order = cancel_order(order.pk, order.user_id)
+        except FillError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         return Response(OrderSerializer(order).data)
     
     @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
     def my_orders(self, request):
         """Получение списка своих ордеров"""
-        orders = Order.objects.filter(user=request.user).order_by('-created_at')
+        orders = Order.objects.filter(user=request.user)
         
         # Фильтр по статусу
         status_param = request.query_params.get('status')
         if status_param:
             orders = orders.filter(status=status_param)
         
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        # Курсорная пагинация по (created_at, id)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(orders.values(*ORDER_LIST_FIELDS), request, view=self)
+        serializer = OrderListSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
     
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated, HasP2PAccess])
+    @idempotent
     def buy(self, request, pk=None):
         """Покупка по существующему ордеру"""
         order = self.get_object()
         user = request.user
         
-        # Проверка, что ордер активен
-        if order.status != 'active':
-            return Response(
-                {"error": "Ордер не активен"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Проверка, что пользователь не покупает свой же ордер
-        if order.user == user:
-            return Response(
-                {"error": "Вы не можете купить по своему ордеру"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         # Получаем количество для покупки
-        amount_str = request.data.get('amount')
-        if not amount_str:
+        amount = request.data.get('amount')
+        if not amount:
             return Response(
                 {"error": "Не указано количество для покупки"},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # Резервируем объем в ордере; расчет происходит после подтверждений сторон
         try:
-            amount = Decimal(amount_str)
-        except:
-            return Response(
-                {"error": "Некорректное количество"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Проверка количества
-        if amount <= 0:
-            return Response(
-                {"error": "Количество должно быть положительным"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        if amount > order.amount:
-            return Response(
-                {"error": f"Недостаточно средств в ордере. Доступно: {order.amount}"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        if amount < order.min_amount:
-            return Response(
-                {"error": f"Минимальная сумма покупки: {order.min_amount}"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Рассчитываем стоимость и комиссию
-        price = amount * order.price_per_unit
-        commission_rate = settings.GAME_SETTINGS.get('P2P_COMMISSION', Decimal('0.03'))
-        commission = price * commission_rate
-        total_cost = price + commission
-        
-        # Проверка баланса покупателя при покупке
-        if order.type == 'sell':
-            if user.ton_balance < total_cost:
-                return Response(
-                    {"error": f"Недостаточно TON на балансе. Требуется: {total_cost}, доступно: {user.ton_balance}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        else:  # buy order
-            token_type = order.token_type
-            if token_type == 'CF' and user.cf_balance < amount:
-                return Response(
-                    {"error": f"Недостаточно CF на балансе. Требуется: {amount}, доступно: {user.cf_balance}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            elif token_type == 'TON' and user.ton_balance < amount:
-                return Response(
-                    {"error": f"Недостаточно TON на балансе. Требуется: {amount}, доступно: {user.ton_balance}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            elif token_type == 'NOT' and user.not_balance < amount:
-                return Response(
-                    {"error": f"Недостаточно NOT на балансе. Требуется: {amount}, доступно: {user.not_balance}"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        
-        # Создаем транзакцию
-        if order.type == 'sell':
-            buyer = user
-            seller = order.user
-        else:  # buy order
-            buyer = order.user
-            seller = user
-        
-        transaction = Transaction.objects.create(
-            order=order,
-            buyer=buyer,
-            seller=seller,
-            amount=amount,
-            price_per_unit=order.price_per_unit,
-            token_type=order.token_type,
-            commission=commission,
-            status='pending'
-        )
-        
-        # Обновляем ордер
-        order.amount -= amount
-        if order.amount == 0:
-            order.status = 'completed'
-        order.save()
+            transaction = fill_order(order.pk, user, amount, settle=False)
+        except FillError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         # Возвращаем данные транзакции
         return Response(TransactionSerializer(transaction).data)
@@ -226,13 +171,20 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     """
     serializer_class = TransactionSerializer
     permission_classes = [permissions.IsAuthenticated, IsTransactionParticipant]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
         """Возвращает транзакции текущего пользователя"""
         user = self.request.user
-        return Transaction.objects.filter(
-            Q(buyer=user) | Q(seller=user)
-        ).select_related('order', 'buyer', 'seller').order_by('-created_at')
+        queryset = Transaction.objects.filter(Q(buyer=user) | Q(seller=user)).order_by('-created_at', '-id')
+        if self.action == 'list':
+            return queryset.values(*TRANSACTION_LIST_FIELDS)
+        return queryset.select_related('order', 'buyer', 'seller')
+    
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return TransactionListSerializer
+        return TransactionSerializer
     
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def confirm_payment(self, request, pk=None):
@@ -280,53 +232,13 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Обновляем статус транзакции
-        transaction.status = 'completed'
-        transaction.save()
-        
-        # Выполняем обмен средствами
-        buyer = transaction.buyer
-        seller = transaction.seller
-        amount = transaction.amount
-        price = amount * transaction.price_per_unit
-        
-        if transaction.token_type == 'CF':
-            if transaction.order.type == 'sell':
-                # Продавец продает CF, покупатель получает CF
-                buyer.cf_balance += amount
-                buyer.ton_balance -= price
-                seller.ton_balance += price
-            else:  # buy order
-                # Продавец продает TON за CF, покупатель получает TON
-                seller.cf_balance += amount
-                seller.ton_balance -= price
-                buyer.ton_balance += price
-        elif transaction.token_type == 'TON':
-            if transaction.order.type == 'sell':
-                # Продавец продает TON, покупатель получает TON
-                buyer.ton_balance += amount
-                buyer.cf_balance -= price  # предполагаем, что TON продается за CF
-                seller.cf_balance += price
-            else:  # buy order
-                # Продавец продает CF за TON, покупатель получает CF
-                seller.ton_balance += amount
-                seller.cf_balance -= price
-                buyer.cf_balance += price
-        elif transaction.token_type == 'NOT':
-            if transaction.order.type == 'sell':
-                # Продавец продает NOT, покупатель получает NOT
-                buyer.not_balance += amount
-                buyer.ton_balance -= price
-                seller.ton_balance += price
-            else:  # buy order
-                # Продавец продает TON за NOT, покупатель получает TON
-                seller.not_balance += amount
-                seller.ton_balance -= price
-                buyer.ton_balance += price
-        
-        # Сохраняем изменения
-        buyer.save()
-        seller.save()
+        # Переводим средства и завершаем сделку; не покрытая балансом сделка остается оплаченной
+        if not settle_transactions([transaction]):
+            return Response(
+                {"error": "Недостаточно средств на балансе для расчета сделки"},
+                status=status.HTTP_409_CONFLICT
+            )
+        transaction.refresh_from_db()
         
         return Response(TransactionSerializer(transaction).data)
 
@@ -337,13 +249,14 @@ class MessageViewSet(viewsets.ModelViewSet):
     """
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated, IsTransactionParticipant]
+    pagination_class = AscendingKeysetPagination
     
     def get_queryset(self):
         """Возвращает сообщения для конкретной транзакции"""
         transaction_id = self.kwargs.get('transaction_pk')
         return Message.objects.filter(
             transaction_id=transaction_id
-        ).select_related('sender').order_by('created_at')
+        ).select_related('sender').order_by('created_at', 'id')
     
     def perform_create(self, serializer):
         """Создание нового сообщения"""
@@ -356,7 +269,9 @@ class MessageViewSet(viewsets.ModelViewSet):
             raise permissions.PermissionDenied("Вы не являетесь участником этой сделки")
         
         # Создаем сообщение
-        serializer.save(transaction=transaction, sender=user)
+        with db_transaction.atomic():
+            serializer.save(transaction=transaction, sender=user)
+            chat.count_message(transaction, user.pk)
     
     @action(detail=False, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def mark_read(self, request, transaction_pk=None):
@@ -368,14 +283,63 @@ class MessageViewSet(viewsets.ModelViewSet):
         if user != transaction.buyer and user != transaction.seller:
             raise permissions.PermissionDenied("Вы не являетесь участником этой сделки")
         
-        # Определяем отправителя сообщений, которые нужно отметить как прочитанные
-        sender = transaction.buyer if user == transaction.seller else transaction.seller
-        
-        # Отмечаем сообщения как прочитанные
-        Message.objects.filter(
-            transaction=transaction, 
-            sender=sender, 
-            is_read=False
-        ).update(is_read=True)
+        # Отмечаем входящие сообщения как прочитанными и обнуляем счетчик
+        chat.mark_read(transaction.id, user.pk)
         
-        return Response({"status": "success"}) 
\ No newline at end of file
+        return Response({"status": "success"}) 
+
+class PriceAlertViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    API ценовых оповещений: уведомление приходит, когда сделка по токену
+    пересекает порог, — без опроса биржи клиентом
+    """
+    serializer_class = PriceAlertSerializer
+    permission_classes = [permissions.IsAuthenticated, HasP2PAccess]
+    pagination_class = KeysetPagination
+    
+    def get_queryset(self):
+        return PriceAlert.objects.filter(user=self.request.user).order_by('-created_at', '-id')
+    
+    def perform_create(self, serializer):
+        alert = serializer.save(user=self.request.user)
+        alerts.sync_alert(alert)
+    
+    def perform_destroy(self, instance):
+        instance.is_active = False
+        alerts.sync_alert(instance)
+        instance.delete()
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def market_depth(request, token):
+    """
+    Глубина стакана токена по ценовым уровням.
+    Параметры: ``precision`` — знаков после запятой в цене уровня (0–8),
+    ``levels`` — число уровней на сторону (1–100).
+    """
+    token = token.upper()
+    if token not in market.tokens():
+        return Response({'error': 'Неизвестный токен'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        precision = int(request.query_params.get('precision', market.MAX_PRECISION))
+        levels = int(request.query_params.get('levels', 20))
+    except ValueError:
+        return Response({'error': 'Некорректные параметры'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 <= precision <= market.MAX_PRECISION or not 1 <= levels <= market.MAX_DEPTH_LEVELS:
+        return Response({'error': 'Некорректные параметры'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(market.get_depth(token, precision, levels))
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def market_ticker(request):
+    """Тикер всех токенов или одного (параметр ``token``)"""
+    ticker = market.get_ticker()
+    token = request.query_params.get('token')
+    if not token:
+        return Response(ticker)
+    for item in ticker['tickers']:
+        if item['token'] == token.upper():
+            return Response(item)
+    return Response({'error': 'Неизвестный токен'}, status=status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,183 @@
+"""
+Свечи OHLCV по сделкам P2P-биржи.
+
+Для каждого токена хранятся свечи 1m/1h/1d (``PriceCandle``). Сделки
+добавляются в свечи инкрементально в той же транзакции БД, в которой
+завершаются (ожидающие сделки — при расчете, в корзину времени создания):
+сделки пачки сначала сворачиваются в памяти, затем каждая
+затронутая свеча обновляется одним ``UPDATE`` с ``F()``/``Greatest``/``Least``
+(или создается). Свеча хранит время первой и последней сделки, поэтому
+сделка, рассчитанная позже более новой, не затирает цену закрытия. Полная история строится командой ``build_candles`` за один
+последовательный проход по сделкам. Графики и API читают только готовые свечи.
+"""
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import PriceCandle, Transaction
+
+INTERVALS = ('1m', '1h', '1d')
+WRITE_BATCH_SIZE = 500
+
+
+def bucket_start(moment, interval):
+    """Начало интервала свечи (в UTC), в который попадает ``moment``"""
+    moment = moment.astimezone(datetime.timezone.utc)
+    if interval == '1m':
+        return moment.replace(second=0, microsecond=0)
+    if interval == '1h':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    if interval == '1d':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f'Неизвестный интервал свечи: {interval}')
+
+
+class CandleBuilder:
+    """Сворачивает сделки в свечи в памяти"""
+
+    def __init__(self, intervals=INTERVALS):
+        self.intervals = intervals
+        self.candles = {}
+
+    def add(self, token_type, price, amount, moment):
+        for interval in self.intervals:
+            key = (token_type, interval, bucket_start(moment, interval))
+            candle = self.candles.get(key)
+            if candle is None:
+                self.candles[key] = {
+                    'open': price, 'high': price, 'low': price, 'close': price,
+                    'volume': amount, 'quote_volume': amount * price, 'trades': 1,
+                    'first': moment, 'last': moment,
+                }
+                continue
+            candle['high'] = max(candle['high'], price)
+            candle['low'] = min(candle['low'], price)
+            if moment >= candle['last']:
+                candle['close'], candle['last'] = price, moment
+            if moment < candle['first']:
+                candle['open'], candle['first'] = price, moment
+            candle['volume'] += amount
+            candle['quote_volume'] += amount * price
+            candle['trades'] += 1
+
+    def add_deals(self, deals):
+        for deal in deals:
+            self.add(deal.token_type, deal.price_per_unit, deal.amount, deal.created_at)
+        return self
+
+    def build(self):
+        """Несохраненные объекты ``PriceCandle``"""
+        return [
+            PriceCandle(
+                token_type=token_type, interval=interval, bucket=bucket,
+                open=candle['open'], high=candle['high'], low=candle['low'], close=candle['close'],
+                volume=candle['volume'], quote_volume=candle['quote_volume'], trades=candle['trades'],
+                first_trade_at=candle['first'], last_trade_at=candle['last'],
+            )
+            for (token_type, interval, bucket), candle in self.candles.items()
+        ]
+
+
+def _merge(token_type, interval, bucket, candle):
+    """
+    Добавляет свернутые сделки к сохраненной свече; возвращает число обновленных строк.
+    Цена открытия заменяется, только если сделки раньше первой сохраненной,
+    цена закрытия — если не раньше последней.
+    """
+    price_field = PriceCandle._meta.get_field('high')
+    time_field = PriceCandle._meta.get_field('last_trade_at')
+    first = Value(candle['first'], output_field=time_field)
+    last = Value(candle['last'], output_field=time_field)
+    earlier = Q(first_trade_at__isnull=True) | Q(first_trade_at__gt=candle['first'])
+    later = Q(last_trade_at__isnull=True) | Q(last_trade_at__lte=candle['last'])
+    return PriceCandle.objects.filter(token_type=token_type, interval=interval, bucket=bucket).update(
+        high=Greatest(F('high'), Value(candle['high'], output_field=price_field)),
+        low=Least(F('low'), Value(candle['low'], output_field=price_field)),
+        # Свечи до появления времени сделок считаются открытыми раньше любой новой сделки
+        open=Case(When(first_trade_at__gt=candle['first'], then=Value(candle['open'])), default=F('open')),
+        first_trade_at=Case(When(earlier, then=first), default=F('first_trade_at')),
+        close=Case(When(later, then=Value(candle['close'])), default=F('close')),
+        last_trade_at=Case(When(later, then=last), default=F('last_trade_at')),
+        volume=F('volume') + candle['volume'],
+        quote_volume=F('quote_volume') + candle['quote_volume'],
+        trades=F('trades') + candle['trades'],
+        updated_at=timezone.now(),
+    )
+
+
+def record_trades(deals):
+    """
+    Добавляет завершенные сделки в свечи. Вызывается в транзакции,
+    завершающей сделки; цены открытия и закрытия берутся из самой ранней и
+    самой поздней по времени создания сделки, в каком бы порядке их ни рассчитали.
+    """
+    builder = CandleBuilder().add_deals(deals)
+    for (token_type, interval, bucket), candle in builder.candles.items():
+        if _merge(token_type, interval, bucket, candle):
+            continue
+        try:
+            with transaction.atomic():
+                PriceCandle.objects.create(
+                    token_type=token_type, interval=interval, bucket=bucket,
+                    open=candle['open'], high=candle['high'], low=candle['low'], close=candle['close'],
+                    volume=candle['volume'], quote_volume=candle['quote_volume'], trades=candle['trades'],
+                    first_trade_at=candle['first'], last_trade_at=candle['last'],
+                )
+        except IntegrityError:
+            # Свечу только что создала параллельная сделка
+            _merge(token_type, interval, bucket, candle)
+
+
+def rebuild_candles(token_type=None, chunk_size=2000):
+    """
+    Перестраивает свечи по всей истории завершенных сделок за один
+    проход по таблице ``Transaction``. Возвращает количество свечей.
+    """
+    deals = Transaction.objects.filter(status='completed')
+    candles = PriceCandle.objects.all()
+    if token_type:
+        deals = deals.filter(token_type=token_type)
+        candles = candles.filter(token_type=token_type)
+
+    builder = CandleBuilder()
+    rows = deals.order_by('created_at', 'id').values_list('token_type', 'price_per_unit', 'amount', 'created_at')
+    for row_token, price, amount, created_at in rows.iterator(chunk_size=chunk_size):
+        builder.add(row_token, price, amount, created_at)
+
+    built = builder.build()
+    with transaction.atomic():
+        candles.delete()
+        PriceCandle.objects.bulk_create(built, batch_size=WRITE_BATCH_SIZE)
+    return len(built)
+
+
+def get_candles(token_type, interval, limit=100):
+    """Последние ``limit`` свечей токена по возрастанию времени"""
+    candles = PriceCandle.objects.filter(token_type=token_type, interval=interval).order_by('-bucket')[:limit]
+    return list(reversed(candles))
+
+
+def daily_chart(token_type, days=7, today=None):
+    """
+    Данные для графика цены за последние ``days`` дней: подписи дат и цены
+    закрытия по дневным свечам. День без сделок берет цену предыдущего дня.
+    """
+    today = today or timezone.now().astimezone(datetime.timezone.utc).date()
+    first_day = today - datetime.timedelta(days=days - 1)
+    start = datetime.datetime.combine(first_day, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+    daily = PriceCandle.objects.filter(token_type=token_type, interval='1d')
+    closes = dict(daily.filter(bucket__gte=start).values_list('bucket', 'close'))
+    previous = daily.filter(bucket__lt=start).order_by('-bucket').values_list('close', flat=True).first()
+
+    labels, values = [], []
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        bucket = datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+        previous = closes.get(bucket, previous)
+        labels.append(day.strftime('%d.%m'))
+        values.append(float(previous) if previous is not None else None)
+    return labels, values
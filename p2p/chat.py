@@ -0,0 +1,192 @@
+"""
+Поток обновлений чата сделки (Server-Sent Events).
+
+Открытый чат держит один поток ``event_stream``: он дочитывает сообщения
+с ``id`` больше последнего отправленного клиенту и отметки о прочтении
+своих сообщений одним запросом, а затем ждет уведомления ``notify`` о
+новом сообщении в сделке. Уведомления работают внутри процесса; записи,
+сделанные другими процессами, поток находит при очередной проверке раз в
+``POLL_SECONDS``. Поток закрывается через ``STREAM_SECONDS``, браузер
+переподключается сам и продолжает с заголовка ``Last-Event-ID``.
+
+Количество сообщений и непрочитанных каждым участником хранится в самой
+сделке (``Transaction.message_count``/``buyer_unread``/``seller_unread``):
+``count_message`` увеличивает счетчики при добавлении сообщения, а
+``mark_read`` обнуляет счетчик читателя одним ``UPDATE``.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Case, F, Max, PositiveIntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import Message, Transaction
+
+POLL_SECONDS = 5
+STREAM_SECONDS = 300
+RETRY_MILLISECONDS = 3000
+MESSAGE_FIELDS = ('id', 'sender_id', 'content', 'created_at', 'is_read')
+
+_subscriptions = defaultdict(set)
+_lock = threading.Lock()
+
+
+class Subscription:
+    """Подписка потока на уведомления о сделке"""
+
+    def __init__(self, deal_id):
+        self.deal_id = deal_id
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def __enter__(self):
+        with _lock:
+            _subscriptions[self.deal_id].add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            subscriptions = _subscriptions[self.deal_id]
+            subscriptions.discard(self)
+            if not subscriptions:
+                del _subscriptions[self.deal_id]
+
+    def wake(self):
+        # Уведомление может прийти из потока синхронного представления
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout):
+        """Ждет уведомления не дольше ``timeout`` секунд"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+
+def wake(deal_id):
+    """Будит все открытые потоки чата сделки"""
+    with _lock:
+        subscriptions = list(_subscriptions.get(deal_id, ()))
+    for subscription in subscriptions:
+        subscription.wake()
+
+
+def notify(deal_id):
+    """Будит потоки чата сделки после фиксации текущей транзакции БД"""
+    transaction.on_commit(lambda: wake(deal_id))
+
+
+def count_message(deal, sender_id):
+    """
+    Учитывает новое сообщение в счетчиках сделки и будит потоки чата.
+    Вызывается в транзакции, создающей сообщение.
+    """
+    recipient = 'seller_unread' if sender_id == deal.buyer_id else 'buyer_unread'
+    Transaction.objects.filter(pk=deal.pk).update(
+        message_count=F('message_count') + 1,
+        **{recipient: F(recipient) + 1},
+    )
+    notify(deal.pk)
+
+
+def mark_read(deal_id, reader_id):
+    """
+    Отмечает прочитанными все входящие сообщения участника ``reader_id``
+    и обнуляет его счетчик. Возвращает количество отмеченных сообщений.
+    """
+    with transaction.atomic():
+        # Сначала обнуляем счетчик: UPDATE блокирует строку сделки, и сообщение,
+        # добавленное параллельно, увеличит счетчик только после этой транзакции
+        counter = PositiveIntegerField()
+        Transaction.objects.filter(pk=deal_id).update(
+            buyer_unread=Case(When(buyer_id=reader_id, then=Value(0)), default=F('buyer_unread'), output_field=counter),
+            seller_unread=Case(When(seller_id=reader_id, then=Value(0)), default=F('seller_unread'), output_field=counter),
+        )
+        updated = Message.objects.filter(transaction_id=deal_id, is_read=False).exclude(
+            sender_id=reader_id
+        ).update(is_read=True)
+    if updated:
+        notify(deal_id)
+    return updated
+
+
+def format_event(event, data, event_id=None):
+    """Событие в формате text/event-stream"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def message_data(row, user_id):
+    return {
+        'id': row['id'],
+        'content': row['content'],
+        'created_at': timezone.localtime(row['created_at']).strftime('%H:%M, %d.%m.%Y'),
+        'is_my_message': row['sender_id'] == user_id,
+        'is_read': row['is_read'],
+    }
+
+
+async def read_up_to(deal_id, user_id):
+    """Наибольший id прочитанного собеседником сообщения пользователя"""
+    result = await Message.objects.filter(
+        transaction_id=deal_id, sender_id=user_id, is_read=True
+    ).aaggregate(last=Max('id'))
+    return result['last'] or 0
+
+
+async def fetch_updates(deal_id, user_id, last_id, read_id):
+    """
+    Новые сообщения (``id > last_id``) и уже отправленные клиенту свои
+    сообщения, прочитанные после ``read_id``, — одним запросом.
+    """
+    rows = Message.objects.filter(transaction_id=deal_id).filter(
+        Q(id__gt=last_id) | Q(sender_id=user_id, is_read=True, id__gt=read_id, id__lte=last_id)
+    ).order_by('id').values(*MESSAGE_FIELDS)
+    return [row async for row in rows]
+
+
+async def event_stream(deal_id, user_id, last_id=0, poll_seconds=POLL_SECONDS, stream_seconds=STREAM_SECONDS):
+    """Выдает события ``message`` и ``read`` чата сделки для участника ``user_id``"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + stream_seconds
+    read_id = await read_up_to(deal_id, user_id)
+    yield f'retry: {RETRY_MILLISECONDS}\n\n'
+
+    with Subscription(deal_id) as subscription:
+        while True:
+            rows = await fetch_updates(deal_id, user_id, last_id, read_id)
+            events = []
+            incoming = []
+            for row in rows:
+                if row['id'] > last_id:
+                    events.append(format_event('message', message_data(row, user_id), row['id']))
+                    if row['sender_id'] != user_id and not row['is_read']:
+                        incoming.append(row['id'])
+                    last_id = row['id']
+            read = max((row['id'] for row in rows if row['sender_id'] == user_id and row['is_read']), default=0)
+            if read > read_id:
+                read_id = read
+                events.append(format_event('read', {'up_to': read_id}, last_id))
+
+            if incoming:
+                # Открытый чат сразу отмечает входящие прочитанными — собеседник увидит отметку
+                await sync_to_async(mark_read)(deal_id, user_id)
+
+            for event in events:
+                yield event
+            if not events:
+                yield ': ping\n\n'
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            await subscription.wait(min(poll_seconds, remaining))
@@ -0,0 +1,164 @@
+"""
+Массовое истечение ордеров P2P-биржи.
+
+Вместо проверки ``is_expired()`` на каждом запросе активные ордера с
+``expires_at <= now`` переводятся в статус ``expired`` пачками одним
+``UPDATE`` на пачку. Заблокированные средства ордеров на продажу
+возвращаются одним set-based ``F()``-обновлением на пачку, уведомления создаются через
+``bulk_create``. Контрольная точка (``SweepCheckpoint``) хранит момент,
+до которого ордера уже обработаны, поэтому каждый проход читает только
+ордера, истекшие после предыдущего прохода.
+"""
+import logging
+import threading
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from notifications.models import Notification, NotificationSettings
+from .models import Order, SweepCheckpoint
+from .settlement import refund_locked
+from . import orderbook
+
+CHECKPOINT_NAME = 'order_expiry'
+DEFAULT_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def _notify(rows):
+    """Создает уведомления об истечении ордеров одной вставкой"""
+    user_ids = {row['user_id'] for row in rows}
+    muted = set(NotificationSettings.objects.filter(
+        user_id__in=user_ids, order_notifications=False
+    ).values_list('user_id', flat=True))
+    Notification.objects.bulk_create([
+        Notification(
+            user_id=row['user_id'],
+            type='order',
+            title='Ордер истек',
+            message=(
+                f"Срок действия ордера #{row['id']} на "
+                f"{'продажу' if row['type'] == 'sell' else 'покупку'} "
+                f"{row['amount']} {row['token_type']} истек"
+            ),
+        )
+        for row in rows if row['user_id'] not in muted
+    ])
+
+
+def _expire_chunk(rows, now):
+    """
+    Переводит пачку ордеров в статус expired и возвращает средства.
+    Возвращает строки ордеров, которые действительно перевел этот вызов.
+    """
+    ids = [row['id'] for row in rows]
+    if not Order.objects.filter(pk__in=ids, status='active').update(status='expired', updated_at=now):
+        return []
+    # Ордер могли исполнить, отменить или истечь в другом процессе после
+    # чтения пачки: средства возвращаются и уведомления создаются только
+    # по строкам, которые перевел этот UPDATE
+    moved = list(Order.objects.filter(pk__in=ids, status='expired', updated_at=now).values(
+        'id', 'user_id', 'type', 'token_type', 'amount'
+    ))
+
+    refund_locked(moved)
+    _notify(moved)
+    orderbook.discard((row['id'], row['token_type']) for row in moved)
+    return moved
+
+
+def expire_orders(order_ids, now=None):
+    """
+    Переводит в статус ``expired`` указанные ордера, если они еще активны
+    и их срок истек. Используется планировщиком сроков; возвращает
+    количество истекших ордеров.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        rows = list(Order.objects.select_for_update().filter(
+            pk__in=list(order_ids), status='active', expires_at__lte=now
+        ).values('id', 'user_id', 'type', 'token_type', 'amount'))
+        if rows:
+            rows = _expire_chunk(rows, now)
+    return len(rows)
+
+
+def sweep_expired_orders(now=None, chunk_size=DEFAULT_CHUNK_SIZE, full=False):
+    """
+    Переводит истекшие активные ордера в статус ``expired``.
+
+    Обрабатываются ордера с ``expires_at`` в интервале
+    (контрольная точка, ``now``]; при ``full=True`` контрольная точка
+    игнорируется. Каждая пачка обрабатывается в своей транзакции;
+    обработанные ордера перестают быть активными, поэтому прерванный проход
+    безопасно продолжается со старой контрольной точки, а сама точка
+    сдвигается на ``now`` только после обработки всего интервала.
+    Возвращает количество истекших ордеров.
+    """
+    now = now or timezone.now()
+    checkpoint, _ = SweepCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+    queryset = Order.objects.filter(status='active', expires_at__lte=now)
+    if not full and checkpoint.position is not None:
+        queryset = queryset.filter(expires_at__gt=checkpoint.position)
+    queryset = queryset.order_by('expires_at', 'id').values(
+        'id', 'user_id', 'type', 'token_type', 'amount'
+    )
+
+    expired = 0
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.select_for_update()[:chunk_size])
+            if rows:
+                expired += len(_expire_chunk(rows, now))
+        if len(rows) < chunk_size:
+            break
+
+    if checkpoint.position is None or now > checkpoint.position:
+        SweepCheckpoint.objects.filter(pk=checkpoint.pk).update(position=now, updated_at=timezone.now())
+    return expired
+
+
+class ExpirySweeper(threading.Thread):
+    """Фоновый поток, периодически запускающий ``sweep_expired_orders``"""
+
+    def __init__(self, interval, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(name='p2p-expiry-sweeper', daemon=True)
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            close_old_connections()
+            try:
+                expired = sweep_expired_orders(chunk_size=self.chunk_size)
+                if expired:
+                    logger.info("Истекло ордеров: %s", expired)
+            except Exception:
+                logger.exception("Ошибка при обработке истекших ордеров")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stopped.set()
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper():
+    """
+    Запускает фоновый поток в процессе веб-сервера, если в
+    ``GAME_SETTINGS['ORDER_SWEEP_INTERVAL']`` задан интервал в секундах.
+    """
+    global _sweeper
+    interval = settings.GAME_SETTINGS.get('ORDER_SWEEP_INTERVAL')
+    if not interval:
+        return None
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = ExpirySweeper(interval)
+            _sweeper.start()
+    return _sweeper
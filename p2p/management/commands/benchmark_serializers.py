@@ -0,0 +1,79 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from p2p.api.renderers import FastJSONRenderer
+from p2p.api.serializers import ORDER_LIST_FIELDS, OrderListSerializer, OrderSerializer
+from p2p.models import Order
+from users.models import User
+
+
+def build_orders(count):
+    """Ордера в памяти и соответствующие им строки ``.values()``; база не используется"""
+    now = timezone.now()
+    users = [
+        User(telegram_id=100000000 + index, username=f'trader{index}', first_name='Trader', referral_code=f'REF{index:05d}')
+        for index in range(100)
+    ]
+    orders = []
+    for index in range(count):
+        user = users[index % len(users)]
+        orders.append(Order(
+            id=index + 1,
+            user=user,
+            type='sell' if index % 2 else 'buy',
+            token_type='CF',
+            amount=Decimal('150.00'),
+            price_per_unit=Decimal('0.51234567') + Decimal(index).scaleb(-8),
+            min_amount=Decimal('10.00'),
+            payment_details='',
+            status='active',
+            created_at=now - timezone.timedelta(seconds=index),
+            expires_at=now + timezone.timedelta(days=3),
+        ))
+    rows = [
+        {
+            field: order.user.username if field == 'user__username' else getattr(order, field)
+            for field in ORDER_LIST_FIELDS
+        }
+        for order in orders
+    ]
+    return orders, rows
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость сериализации и рендеринга списков ордеров API: прежний и компактный путь'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Количество ордеров на странице')
+        parser.add_argument('--repeat', type=int, default=3, help='Количество замеров (берется лучший)')
+
+    def measure(self, render, rows, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            content = render()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return rows / best, len(content)
+
+    def handle(self, *args, **options):
+        count = options['rows']
+        orders, rows = build_orders(count)
+
+        cases = [
+            ('OrderSerializer + JSONRenderer',
+             lambda: JSONRenderer().render(OrderSerializer(orders, many=True).data)),
+            ('OrderListSerializer + JSONRenderer',
+             lambda: JSONRenderer().render(OrderListSerializer(rows, many=True).data)),
+            ('OrderListSerializer + FastJSONRenderer',
+             lambda: FastJSONRenderer().render(OrderListSerializer(rows, many=True).data)),
+        ]
+        baseline = None
+        for name, render in cases:
+            rate, size = self.measure(render, count, options['repeat'])
+            baseline = baseline or rate
+            self.stdout.write(f'{name:<40} {rate:>12,.0f} строк/с  x{rate / baseline:.1f}  {size:,} байт')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from p2p.candles import rebuild_candles
+from p2p.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает свечи OHLCV по всей истории сделок P2P-биржи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--token', choices=[token for token, _ in Order.TOKEN_CHOICES],
+                            help='Перестроить свечи только для указанного токена')
+
+    def handle(self, *args, **options):
+        count = rebuild_candles(token_type=options['token'])
+        self.stdout.write(self.style.SUCCESS(f'Построено свечей: {count}'))
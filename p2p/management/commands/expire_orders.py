@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from p2p.expiry import DEFAULT_CHUNK_SIZE, sweep_expired_orders
+
+
+class Command(BaseCommand):
+    help = 'Переводит истекшие ордера P2P-биржи в статус expired и возвращает заблокированные средства'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Количество ордеров в одной пачке')
+        parser.add_argument('--full', action='store_true',
+                            help='Игнорировать контрольную точку и проверить все активные ордера')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Повторять проход с указанным интервалом')
+
+    def handle(self, *args, **options):
+        full = options['full']
+        while True:
+            expired = sweep_expired_orders(chunk_size=options['chunk_size'], full=full)
+            self.stdout.write(self.style.SUCCESS(f'Истекло ордеров: {expired}'))
+            if not options['loop']:
+                break
+            full = False
+            time.sleep(options['loop'])
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from p2p.orderbook import write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Сохраняет снимок стакана P2P-биржи и удаляет устаревшие записи его журнала'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Повторять снимок с указанным интервалом')
+
+    def handle(self, *args, **options):
+        while True:
+            snapshot = write_snapshot()
+            self.stdout.write(self.style.SUCCESS(
+                f'Снимок стакана: ордеров {len(snapshot.entries)}, журнал до #{snapshot.position}'
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,202 @@
+"""
+Сводные рыночные данные P2P-биржи: глубина стакана и тикер.
+
+Данные строятся по стакану в памяти (``orderbook``), минутным свечам
+(``candles``) и скользящей статистике за 24 часа (``stats``) и кешируются
+на ``P2P_MARKET_DATA_TTL`` секунд. Устаревший снимок перестраивает только
+один запрос: внутри процесса остальные ждут его на блокировке ключа,
+а другие процессы, не получившие метку в кеше, отдают предыдущий снимок,
+пока новый не готов (или ждут новый, если предыдущего нет). Метку снимает
+только процесс, который ее поставил.
+"""
+import threading
+import time
+from collections import defaultdict
+from decimal import ROUND_DOWN, ROUND_UP, Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from . import orderbook, stats
+from .candles import bucket_start
+from .models import Order, PriceCandle
+
+MAX_PRECISION = 8
+PRICE_STEP = Decimal('0.00000001')
+VOLUME_STEP = Decimal('0.01')
+MAX_DEPTH_LEVELS = 100
+# Сколько записей стакана читается за раз при построении глубины
+DEPTH_CHUNK_SIZE = 200
+# Устаревший снимок хранится дольше TTL, чтобы его можно было отдать во время перестроения
+STALE_SECONDS = 60
+# Метка перестроения снимается сама, если процесс-владелец упал
+REBUILD_LOCK_SECONDS = 10
+REBUILD_POLL_SECONDS = 0.05
+
+_key_locks = defaultdict(threading.Lock)
+_key_locks_guard = threading.Lock()
+
+
+def tokens():
+    return [token for token, _ in Order.TOKEN_CHOICES]
+
+
+def cache_ttl():
+    return settings.GAME_SETTINGS.get('P2P_MARKET_DATA_TTL', 2)
+
+
+def _key_lock(key):
+    with _key_locks_guard:
+        return _key_locks[key]
+
+
+def _wait_for_rebuild(key, lock_key):
+    """Ждет, пока другой процесс построит снимок ``key`` или снимет метку"""
+    deadline = time.monotonic() + REBUILD_LOCK_SECONDS
+    while cache.get(lock_key) is not None and time.monotonic() < deadline:
+        time.sleep(REBUILD_POLL_SECONDS)
+        stored = cache.get(key)
+        if stored is not None:
+            return stored
+    return cache.get(key)
+
+
+def cached(key, build, ttl=None):
+    """
+    Возвращает снимок ``key`` из кеша или строит его вызовом ``build()``.
+    Одновременно снимок перестраивает не больше одного запроса.
+    """
+    ttl = cache_ttl() if ttl is None else ttl
+    stored = cache.get(key)
+    if stored is not None and stored[0] > time.time():
+        return stored[1]
+
+    with _key_lock(key):
+        # Пока ждали блокировку, снимок мог построить другой поток
+        stored = cache.get(key)
+        if stored is not None and stored[0] > time.time():
+            return stored[1]
+
+        lock_key = f'{key}:rebuild'
+        acquired = cache.add(lock_key, 1, timeout=REBUILD_LOCK_SECONDS)
+        if not acquired:
+            # Снимок строит другой процесс — отдаем предыдущий, а если его
+            # еще нет, ждем новый
+            stored = stored or _wait_for_rebuild(key, lock_key)
+            if stored is not None:
+                return stored[1]
+            # Владелец метки не успел построить снимок
+            acquired = cache.add(lock_key, 1, timeout=REBUILD_LOCK_SECONDS)
+        try:
+            value = build()
+            cache.set(key, (time.time() + ttl, value), timeout=ttl + STALE_SECONDS)
+        finally:
+            # Метку снимает только процесс, который ее поставил
+            if acquired:
+                cache.delete(lock_key)
+        return value
+
+
+def aggregate_levels(entries, step, rounding, limit=MAX_DEPTH_LEVELS):
+    """
+    Сворачивает ордера одной стороны в ценовые уровни шага ``step``.
+    Записи стакана уже отсортированы по приоритету цены, поэтому уровни
+    идут подряд и обход заканчивается на ``limit`` уровнях.
+    """
+    levels = []
+    for entry in entries:
+        price = entry.price_per_unit.quantize(step, rounding=rounding)
+        if levels and levels[-1]['price'] == price:
+            levels[-1]['amount'] += entry.amount
+            levels[-1]['orders'] += 1
+            continue
+        if len(levels) >= limit:
+            break
+        levels.append({'price': price, 'amount': entry.amount, 'orders': 1})
+    return [
+        {'price': str(level['price']), 'amount': str(level['amount']), 'orders': level['orders']}
+        for level in levels
+    ]
+
+
+def side_entries(book, side, chunk_size=DEPTH_CHUNK_SIZE):
+    """
+    Записи стороны стакана в порядке приоритета. Стакан читается порциями
+    по ``chunk_size``, поэтому обход, остановленный на нужном числе
+    уровней, не проходит всю сторону.
+    """
+    after = None
+    while True:
+        entries = book.top(side, limit=chunk_size, after=after)
+        yield from entries
+        if len(entries) < chunk_size:
+            return
+        after = entries[-1].sort_key
+
+
+def build_depth(token_type, precision=MAX_PRECISION):
+    """Глубина стакана токена: уровни покупки и продажи с точностью ``precision`` знаков"""
+    book = orderbook.get_book(token_type)
+    step = Decimal(1).scaleb(-precision)
+    # Уровни покупок округляются вниз, продаж — вверх, чтобы не пересекаться
+    return {
+        'token': token_type,
+        'precision': precision,
+        'bids': aggregate_levels(side_entries(book, 'buy'), step, ROUND_DOWN),
+        'asks': aggregate_levels(side_entries(book, 'sell'), step, ROUND_UP),
+        'updated_at': timezone.now().isoformat(),
+    }
+
+
+def get_depth(token_type, precision=MAX_PRECISION, levels=MAX_DEPTH_LEVELS):
+    depth = cached(f'p2p:depth:{token_type}:{precision}', lambda: build_depth(token_type, precision))
+    return dict(depth, bids=depth['bids'][:levels], asks=depth['asks'][:levels])
+
+
+def _decimal_str(value):
+    return str(value) if value is not None else None
+
+
+def build_ticker():
+    """Лучшие цены, спред, объем и VWAP за 24 часа по каждому токену"""
+    since = bucket_start(timezone.now() - timezone.timedelta(hours=24), '1m')
+    minute_candles = PriceCandle.objects.filter(interval='1m')
+    # Объем и количество сделок берутся из скользящих окон, минимум и максимум — из свечей
+    extremes = {
+        row['token_type']: row
+        for row in minute_candles.filter(bucket__gte=since).values('token_type').annotate(
+            high=Max('high'), low=Min('low'),
+        ).order_by()
+    }
+
+    tickers = []
+    for token_type in tokens():
+        book = orderbook.get_book(token_type)
+        bid, ask = book.best('buy'), book.best('sell')
+        best_bid = bid.price_per_unit if bid else None
+        best_ask = ask.price_per_unit if ask else None
+        last_price = minute_candles.filter(token_type=token_type).order_by('-bucket').values_list(
+            'close', flat=True
+        ).first()
+        row = extremes.get(token_type, {})
+        window = stats.get_stats(token_type)
+        tickers.append({
+            'token': token_type,
+            'best_bid': _decimal_str(best_bid),
+            'best_ask': _decimal_str(best_ask),
+            'spread': _decimal_str(best_ask - best_bid) if bid and ask else None,
+            'last_price': _decimal_str(last_price),
+            'high_24h': _decimal_str(row.get('high')),
+            'low_24h': _decimal_str(row.get('low')),
+            'volume_24h': str(window['volume_24h']),
+            'quote_volume_24h': str(window['quote_volume_24h']),
+            'vwap_24h': _decimal_str(window['vwap_24h']),
+            'trades_24h': window['trades_24h'],
+        })
+    return {'tickers': tickers, 'updated_at': timezone.now().isoformat()}
+
+
+def get_ticker():
+    return cached('p2p:ticker', build_ticker)
@@ -0,0 +1,267 @@
+"""
+Исполнение ордеров P2P-биржи.
+
+``fill_order`` — частичное или полное исполнение конкретного ордера
+пользователем (кнопка «Купить»/«Продать» и API), ``match_order`` —
+автоматическое сведение нового ордера со встречными ордерами стакана
+в порядке цена-время, ``cancel_order`` — отмена ордера владельцем. Все изменения ордеров и балансов выполняются атомарно;
+завершенные сделки в той же транзакции попадают в свечи и проверяют ценовые
+оповещения, а ожидающие — только после расчета (``settle_transactions``).
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from users import ledger
+from users.models import User
+from .models import Order, Transaction
+from .settlement import (
+    add_trade_deltas, apply_balance_deltas, balance_field, commission_rate,
+    is_supported, merge_deltas, new_deltas, payment_token, refund_locked,
+)
+from . import alerts, candles, expiry, orderbook, stats
+
+
+class FillError(Exception):
+    """Ошибка исполнения ордера; текст сообщения показывается пользователю"""
+
+
+@transaction.atomic
+def match_order(order):
+    """
+    Сводит новый ордер со встречными ордерами стакана.
+
+    Сделка проходит по цене стоящего (мейкерского) ордера, комиссию платит
+    новый ордер, как и при ручной покупке в ``buy_order``. Средства ордера на
+    продажу уже заблокированы при его создании, а владелец ордера на покупку
+    оплачивает сделку со своего баланса в момент исполнения.
+    Возвращает список созданных транзакций.
+    """
+    if order.status != 'active' or not is_supported(order.token_type):
+        orderbook.sync_order(order)
+        return []
+    pay_field = balance_field(payment_token(order.token_type))
+
+    book = orderbook.get_book(order.token_type)
+    entries = book.crossing(order.type, order.price_per_unit, exclude_user=order.user_id)
+    if not entries:
+        orderbook.sync_order(order)
+        return []
+
+    # Блокируем встречные ордера и перепроверяем их состояние по базе
+    now = timezone.now()
+    locked = Order.objects.select_for_update().filter(
+        pk__in=[entry.id for entry in entries], status='active', expires_at__gt=now
+    ).in_bulk()
+    makers = [locked[entry.id] for entry in entries if entry.id in locked]
+
+    user_ids = {order.user_id} | {maker.user_id for maker in makers}
+    users = User.objects.select_for_update().in_bulk(user_ids)
+    # Доступные средства для оплаты с учетом уже сведенных сделок
+    available = {user_id: getattr(user, pay_field) for user_id, user in users.items()}
+
+    rate = commission_rate()
+    remaining = Decimal(str(order.amount))
+    transactions = []
+    trades = []
+    touched = []
+
+    for maker in makers:
+        if remaining <= 0:
+            break
+        quantity = min(remaining, maker.amount)
+        # Частичное исполнение меньше минимальной суммы мейкера недопустимо
+        if quantity < maker.amount and quantity < maker.min_amount:
+            continue
+
+        price = maker.price_per_unit
+        cost = quantity * price
+        commission = cost * rate
+
+        # Покупатель должен покрыть оплату с учетом уже сведенных сделок
+        if order.type == 'buy':
+            buyer_id, seller_id = order.user_id, maker.user_id
+            required = cost + commission
+        else:
+            buyer_id, seller_id = maker.user_id, order.user_id
+            required = cost
+        if available[buyer_id] < required:
+            if buyer_id == order.user_id:
+                break
+            continue
+        available[buyer_id] -= required
+        trade = new_deltas()
+        add_trade_deltas(
+            trade, order.token_type, maker.type, maker.user_id, order.user_id,
+            quantity, cost, commission, taker_tokens_locked=True,
+        )
+
+        transactions.append(Transaction(
+            order=maker,
+            buyer_id=buyer_id,
+            seller_id=seller_id,
+            amount=quantity,
+            price_per_unit=price,
+            token_type=order.token_type,
+            commission=commission,
+            status='completed',
+        ))
+        trades.append(trade)
+
+        maker.amount -= quantity
+        if maker.amount == 0:
+            maker.status = 'completed'
+            maker.completed_at = now
+        maker.updated_at = now
+        touched.append(maker)
+        remaining -= quantity
+
+    if not transactions:
+        orderbook.sync_order(order)
+        return []
+
+    order.amount = remaining
+    if remaining == 0:
+        order.status = 'completed'
+        order.completed_at = now
+    order.updated_at = now
+    touched.append(order)
+
+    created = Transaction.objects.bulk_create(transactions)
+    Order.objects.bulk_update(touched, ['amount', 'status', 'completed_at', 'updated_at'])
+    deltas = new_deltas()
+    entries = []
+    for deal, trade in zip(created, trades):
+        entries.extend(ledger.entries_from_deltas(trade, 'p2p_trade', deal))
+        merge_deltas(deltas, trade)
+    apply_balance_deltas(deltas)
+    ledger.write(entries)
+    candles.record_trades(created)
+    alerts.check_trades(created)
+    stats.record_trades(created)
+
+    orderbook.sync_orders(touched)
+    return created
+
+
+def fill_order(order_id, taker, amount=None, settle=True):
+    """
+    Исполняет ордер ``order_id`` пользователем ``taker`` целиком или частично.
+
+    ``amount`` — количество токенов (по умолчанию весь остаток ордера); оно не
+    может быть меньше ``min_amount`` ордера, если только это не весь остаток.
+    Остаток уменьшается атомарным ``UPDATE`` с условием ``amount >= количество``,
+    поэтому два покупателя не могут забрать один и тот же объем; при нулевом
+    остатке ордер автоматически завершается.
+    При ``settle=True`` балансы переводятся сразу и сделка создается завершенной,
+    иначе создается ожидающая сделка, которая рассчитывается после подтверждений.
+    Возвращает созданную транзакцию, при ошибке выбрасывает ``FillError``.
+    """
+    order = Order.objects.filter(pk=order_id).first()
+    if order is None or order.status != 'active':
+        raise FillError('Ордер не активен')
+    if order.user_id == taker.pk:
+        raise FillError('Нельзя купить свой ордер')
+    if order.is_expired():
+        # Истечение возвращает заблокированные средства и убирает ордер из стакана
+        expiry.expire_orders([order.pk])
+        raise FillError('Ордер истек')
+
+    try:
+        quantity = order.amount if amount in (None, '') else Decimal(str(amount))
+    except ArithmeticError:
+        raise FillError('Некорректное количество')
+    if quantity <= 0:
+        raise FillError('Количество должно быть положительным')
+    if quantity > order.amount:
+        raise FillError(f'Недостаточно средств в ордере. Доступно: {order.amount}')
+    if quantity < order.min_amount and quantity != order.amount:
+        raise FillError(f'Минимальная сумма покупки: {order.min_amount}')
+
+    if not is_supported(order.token_type):
+        raise FillError(f'Токен {order.token_type} не поддерживается')
+
+    price = order.price_per_unit
+    cost = quantity * price
+    commission = cost * commission_rate()
+    deltas = new_deltas()
+    add_trade_deltas(deltas, order.token_type, order.type, order.user_id, taker.pk, quantity, cost, commission)
+
+    with transaction.atomic():
+        now = timezone.now()
+        users = User.objects.select_for_update().in_bulk([taker.pk, order.user_id])
+        for user_id, fields in deltas.items():
+            for field, delta in fields.items():
+                if getattr(users[user_id], field) + delta < 0:
+                    token = field.split('_')[0].upper()
+                    if user_id == taker.pk:
+                        raise FillError(f'Недостаточно {token} на балансе')
+                    raise FillError(f'У владельца ордера недостаточно {token}')
+
+        # Атомарно уменьшаем остаток, только если его все еще хватает
+        updated = Order.objects.filter(
+            pk=order.pk, status='active', amount__gte=quantity
+        ).update(amount=F('amount') - quantity, updated_at=now)
+        if not updated:
+            raise FillError('Ордер уже исполнен другим пользователем')
+        Order.objects.filter(pk=order.pk, status='active', amount=0).update(
+            status='completed', completed_at=now, updated_at=now
+        )
+        order.refresh_from_db(fields=['amount', 'status', 'completed_at', 'updated_at'])
+
+        if order.type == 'sell':
+            buyer_id, seller_id = taker.pk, order.user_id
+        else:
+            buyer_id, seller_id = order.user_id, taker.pk
+        created = Transaction.objects.create(
+            order=order,
+            buyer_id=buyer_id,
+            seller_id=seller_id,
+            amount=quantity,
+            price_per_unit=price,
+            token_type=order.token_type,
+            commission=commission,
+            status='completed' if settle else 'pending',
+        )
+        if settle:
+            apply_balance_deltas(deltas)
+            ledger.write(ledger.entries_from_deltas(deltas, 'p2p_trade', created))
+            candles.record_trades([created])
+            alerts.check_trades([created])
+            stats.record_trades([created])
+        orderbook.sync_order(order)
+    return created
+
+
+def cancel_order(order_id, user_id):
+    """
+    Отменяет активный ордер ``order_id`` пользователя ``user_id`` и возвращает
+    владельцу средства, заблокированные под ордер на продажу.
+
+    Статус меняется условным ``UPDATE ... WHERE status = 'active'``, а остаток
+    перечитывается уже после него: исполнение, успевшее пройти до отмены,
+    уменьшило остаток, а после отмены ордер исполнить нельзя, поэтому
+    возвращается ровно неисполненный объем. Возвращает отмененный ордер,
+    при ошибке выбрасывает ``FillError``.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        cancelled = Order.objects.filter(pk=order_id, user_id=user_id, status='active').update(
+            status='cancelled', updated_at=now
+        )
+        if not cancelled:
+            if not Order.objects.filter(pk=order_id, user_id=user_id).exists():
+                raise FillError('Ордер не найден')
+            raise FillError('Можно отменить только активный ордер')
+        order = Order.objects.get(pk=order_id)
+        refund_locked([{
+            'id': order.pk,
+            'user_id': order.user_id,
+            'type': order.type,
+            'token_type': order.token_type,
+            'amount': order.amount,
+        }])
+        orderbook.sync_order(order)
+    return order
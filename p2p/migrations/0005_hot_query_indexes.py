@@ -0,0 +1,42 @@
+# Generated by Django 5.1.1 on 2026-10-17 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0004_order_updated_at_transaction_status_and_more'),
+        ('users', '0002_remove_user_not_balance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['transaction', 'created_at'], name='p2p_msg_chat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['transaction', 'sender'], name='p2p_msg_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'active')), fields=['token_type', 'type', 'price_per_unit', 'created_at'], name='p2p_order_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'active')), fields=['expires_at'], name='p2p_order_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', 'created_at'], name='p2p_order_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['buyer', '-created_at'], name='p2p_tx_buyer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['seller', '-created_at'], name='p2p_tx_seller_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0006_sweepcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceCandle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_type', models.CharField(choices=[('CF', 'CF Token'), ('TON', 'TON Token'), ('NOT', 'NOT Token')], max_length=3, verbose_name='Тип токена')),
+                ('interval', models.CharField(choices=[('1m', '1 минута'), ('1h', '1 час'), ('1d', '1 день')], max_length=2, verbose_name='Интервал')),
+                ('bucket', models.DateTimeField(verbose_name='Начало интервала')),
+                ('open', models.DecimalField(decimal_places=8, max_digits=15, verbose_name='Цена открытия')),
+                ('high', models.DecimalField(decimal_places=8, max_digits=15, verbose_name='Максимум')),
+                ('low', models.DecimalField(decimal_places=8, max_digits=15, verbose_name='Минимум')),
+                ('close', models.DecimalField(decimal_places=8, max_digits=15, verbose_name='Цена закрытия')),
+                ('volume', models.DecimalField(decimal_places=2, default=0, max_digits=20, verbose_name='Объем')),
+                ('quote_volume', models.DecimalField(decimal_places=8, default=0, max_digits=24, verbose_name='Объем в валюте оплаты')),
+                ('trades', models.PositiveIntegerField(default=0, verbose_name='Количество сделок')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Свеча',
+                'verbose_name_plural': 'Свечи',
+                'constraints': [models.UniqueConstraint(fields=('token_type', 'interval', 'bucket'), name='p2p_candle_bucket_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:11
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    """Заполняет счетчики чата по существующим сообщениям одним UPDATE"""
+    Transaction = apps.get_model('p2p', 'Transaction')
+    Message = apps.get_model('p2p', 'Message')
+
+    def count(**filters):
+        messages = Message.objects.filter(transaction=OuterRef('pk'), **filters)
+        return Coalesce(Subquery(messages.values('transaction').annotate(total=Count('id')).values('total')), 0)
+
+    Transaction.objects.update(
+        message_count=count(),
+        buyer_unread=count(is_read=False, sender=OuterRef('seller')),
+        seller_unread=count(is_read=False, sender=OuterRef('buyer')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0007_pricecandle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='buyer_unread',
+            field=models.PositiveIntegerField(default=0, verbose_name='Не прочитано покупателем'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сообщений'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='seller_unread',
+            field=models.PositiveIntegerField(default=0, verbose_name='Не прочитано продавцом'),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
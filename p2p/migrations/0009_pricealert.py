@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0008_chat_counters'),
+        ('users', '0004_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_type', models.CharField(choices=[('CF', 'CF Token'), ('TON', 'TON Token'), ('NOT', 'NOT Token')], max_length=3, verbose_name='Тип токена')),
+                ('direction', models.CharField(choices=[('above', 'Цена выше'), ('below', 'Цена ниже')], max_length=5, verbose_name='Направление')),
+                ('threshold', models.DecimalField(decimal_places=8, max_digits=15, verbose_name='Порог цены')),
+                ('is_active', models.BooleanField(default=True, verbose_name='Активно')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('triggered_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата срабатывания')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_alerts', to='users.user', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ценовое оповещение',
+                'verbose_name_plural': 'Ценовые оповещения',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(condition=models.Q(('is_active', True)), fields=['token_type'], name='p2p_alert_active_idx'), models.Index(fields=['user', 'created_at'], name='p2p_alert_user_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0009_pricealert'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderBookJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.BigIntegerField(verbose_name='Ордер')),
+                ('token_type', models.CharField(choices=[('CF', 'CF Token'), ('TON', 'TON Token'), ('NOT', 'NOT Token')], max_length=3, verbose_name='Тип токена')),
+                ('entry', models.JSONField(blank=True, null=True, verbose_name='Запись стакана')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата записи')),
+            ],
+            options={
+                'verbose_name': 'Запись журнала стакана',
+                'verbose_name_plural': 'Журнал стакана',
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderBookSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.BigIntegerField(default=0, verbose_name='Последняя запись журнала')),
+                ('entries', models.JSONField(default=list, verbose_name='Записи стакана')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата снимка')),
+            ],
+            options={
+                'verbose_name': 'Снимок стакана',
+                'verbose_name_plural': 'Снимки стакана',
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0010_orderbook_journal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pricecandle',
+            index=models.Index(fields=['interval', 'updated_at'], name='p2p_candle_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('p2p', '0011_candle_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pricecandle',
+            name='first_trade_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время первой сделки'),
+        ),
+        migrations.AddField(
+            model_name='pricecandle',
+            name='last_trade_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время последней сделки'),
+        ),
+    ]
@@ -39,6 +39,22 @@ class Order(models.Model):
         verbose_name = 'Ордер'
         verbose_name_plural = 'Ордера'
         ordering = ['-created_at']
+        indexes = [
+            # Стакан: активные ордера токена и стороны по цене и времени
+            models.Index(
+                fields=['token_type', 'type', 'price_per_unit', 'created_at'],
+                condition=models.Q(status='active'),
+                name='p2p_order_book_idx',
+            ),
+            # Поиск истекших активных ордеров
+            models.Index(
+                fields=['expires_at'],
+                condition=models.Q(status='active'),
+                name='p2p_order_expiry_idx',
+            ),
+            # Ордера пользователя («мои ордера»)
+            models.Index(fields=['user', 'status', 'created_at'], name='p2p_order_user_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_type_display()} {self.amount} {self.token_type} @ {self.price_per_unit} ({self.user})"
@@ -89,6 +105,10 @@ class Transaction(models.Model):
     token_type = models.CharField(max_length=3, choices=Order.TOKEN_CHOICES, verbose_name='Тип токена')
     commission = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Комиссия')
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name='Статус')
+    # Счетчики чата сделки, обновляются вместе с сообщениями (см. p2p.chat)
+    message_count = models.PositiveIntegerField(default=0, verbose_name='Сообщений')
+    buyer_unread = models.PositiveIntegerField(default=0, verbose_name='Не прочитано покупателем')
+    seller_unread = models.PositiveIntegerField(default=0, verbose_name='Не прочитано продавцом')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
     
@@ -96,6 +116,11 @@ class Transaction(models.Model):
         verbose_name = 'Транзакция'
         verbose_name_plural = 'Транзакции'
         ordering = ['-created_at']
+        indexes = [
+            # История сделок пользователя
+            models.Index(fields=['buyer', '-created_at'], name='p2p_tx_buyer_idx'),
+            models.Index(fields=['seller', '-created_at'], name='p2p_tx_seller_idx'),
+        ]
     
     def __str__(self):
         return f"{self.buyer} купил {self.amount} {self.token_type} у {self.seller}"
@@ -103,6 +128,10 @@ class Transaction(models.Model):
     def total_amount(self):
         """Возвращает общую сумму транзакции"""
         return self.amount * self.price_per_unit
+    
+    def unread_for(self, user):
+        """Количество непрочитанных пользователем сообщений в чате сделки"""
+        return self.buyer_unread if user.pk == self.buyer_id else self.seller_unread
 
 class Message(models.Model):
     """Модель сообщений между участниками сделки"""
@@ -116,6 +145,122 @@ class Message(models.Model):
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
         ordering = ['created_at']
+        indexes = [
+            # Лента чата и непрочитанные сообщения сделки
+            models.Index(fields=['transaction', 'created_at'], name='p2p_msg_chat_idx'),
+            models.Index(
+                fields=['transaction', 'sender'],
+                condition=models.Q(is_read=False),
+                name='p2p_msg_unread_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"Сообщение от {self.sender} в сделке {self.transaction.id}"
+
+class SweepCheckpoint(models.Model):
+    """Отметка, до которой фоновая задача уже обработала данные"""
+    name = models.CharField(max_length=50, unique=True, verbose_name='Задача')
+    position = models.DateTimeField(null=True, blank=True, verbose_name='Обработано до')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+    
+    class Meta:
+        verbose_name = 'Контрольная точка'
+        verbose_name_plural = 'Контрольные точки'
+    
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+class OrderBookJournal(models.Model):
+    """Запись журнала изменений стакана: новое состояние ордера или его удаление"""
+    order_id = models.BigIntegerField(verbose_name='Ордер')
+    token_type = models.CharField(max_length=3, choices=Order.TOKEN_CHOICES, verbose_name='Тип токена')
+    # Компактная запись стакана (см. orderbook.ENTRY_FIELDS); null — ордер удален из стакана
+    entry = models.JSONField(null=True, blank=True, verbose_name='Запись стакана')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата записи')
+    
+    class Meta:
+        verbose_name = 'Запись журнала стакана'
+        verbose_name_plural = 'Журнал стакана'
+    
+    def __str__(self):
+        return f"#{self.id} {self.token_type} ордер {self.order_id}"
+
+class OrderBookSnapshot(models.Model):
+    """Снимок стакана: активные ордера на момент последней учтенной записи журнала"""
+    position = models.BigIntegerField(default=0, verbose_name='Последняя запись журнала')
+    entries = models.JSONField(default=list, verbose_name='Записи стакана')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Дата снимка')
+    
+    class Meta:
+        verbose_name = 'Снимок стакана'
+        verbose_name_plural = 'Снимки стакана'
+    
+    def __str__(self):
+        return f"Снимок стакана #{self.position} от {self.created_at:%d.%m.%Y %H:%M}"
+
+class PriceCandle(models.Model):
+    """Свеча OHLCV по сделкам токена за интервал"""
+    INTERVAL_CHOICES = [
+        ('1m', '1 минута'),
+        ('1h', '1 час'),
+        ('1d', '1 день'),
+    ]
+    
+    token_type = models.CharField(max_length=3, choices=Order.TOKEN_CHOICES, verbose_name='Тип токена')
+    interval = models.CharField(max_length=2, choices=INTERVAL_CHOICES, verbose_name='Интервал')
+    bucket = models.DateTimeField(verbose_name='Начало интервала')
+    open = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Цена открытия')
+    high = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Максимум')
+    low = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Минимум')
+    close = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Цена закрытия')
+    volume = models.DecimalField(max_digits=20, decimal_places=2, default=0, verbose_name='Объем')
+    quote_volume = models.DecimalField(max_digits=24, decimal_places=8, default=0, verbose_name='Объем в валюте оплаты')
+    trades = models.PositiveIntegerField(default=0, verbose_name='Количество сделок')
+    # Время первой и последней сделки свечи: сделки могут рассчитываться не по
+    # порядку, и open/close заменяются только более ранней/поздней сделкой
+    first_trade_at = models.DateTimeField(null=True, blank=True, verbose_name='Время первой сделки')
+    last_trade_at = models.DateTimeField(null=True, blank=True, verbose_name='Время последней сделки')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+    
+    class Meta:
+        verbose_name = 'Свеча'
+        verbose_name_plural = 'Свечи'
+        constraints = [
+            models.UniqueConstraint(fields=['token_type', 'interval', 'bucket'], name='p2p_candle_bucket_uniq'),
+        ]
+        indexes = [
+            # Синхронизация скользящей статистики: недавно обновленные свечи
+            models.Index(fields=['interval', 'updated_at'], name='p2p_candle_updated_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.token_type} {self.interval} {self.bucket:%d.%m.%Y %H:%M}: {self.close}"
+
+class PriceAlert(models.Model):
+    """Ценовое оповещение: уведомить пользователя, когда цена токена пересечет порог"""
+    DIRECTION_CHOICES = [
+        ('above', 'Цена выше'),
+        ('below', 'Цена ниже'),
+    ]
+    
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='price_alerts', verbose_name='Пользователь')
+    token_type = models.CharField(max_length=3, choices=Order.TOKEN_CHOICES, verbose_name='Тип токена')
+    direction = models.CharField(max_length=5, choices=DIRECTION_CHOICES, verbose_name='Направление')
+    threshold = models.DecimalField(max_digits=15, decimal_places=8, verbose_name='Порог цены')
+    is_active = models.BooleanField(default=True, verbose_name='Активно')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    triggered_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата срабатывания')
+    
+    class Meta:
+        verbose_name = 'Ценовое оповещение'
+        verbose_name_plural = 'Ценовые оповещения'
+        ordering = ['-created_at']
+        indexes = [
+            # Загрузка индекса оповещений: активные оповещения токена
+            models.Index(fields=['token_type'], condition=models.Q(is_active=True), name='p2p_alert_active_idx'),
+            models.Index(fields=['user', 'created_at'], name='p2p_alert_user_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.token_type} {self.get_direction_display().lower()} {self.threshold} ({self.user})"
@@ -0,0 +1,430 @@
+"""
+Стакан ордеров P2P-биржи в памяти процесса.
+
+Для каждого токена хранятся две отсортированные стороны:
+заявки на покупку (bids) — по убыванию цены, затем по времени создания,
+и заявки на продажу (asks) — по возрастанию цены, затем по времени создания.
+Стакан строится при первом обращении и дальше обновляется инкрементально
+через ``sync_order``/``sync_orders``/``discard``/``refresh`` из представлений.
+
+Каждое изменение стакана записывается в журнал (``OrderBookJournal``) в той
+же транзакции БД, что и изменение ордера, поэтому процессы видят изменения
+друг друга: стакан дочитывает журнал не чаще раза в ``CATCH_UP_SECONDS``.
+Холодный старт читает последний снимок (``OrderBookSnapshot``, пишется
+командой ``snapshot_orderbook``) и журнал после него, а не всю таблицу
+``Order``; таблица сканируется, только пока снимков еще нет.
+"""
+import datetime
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import Order, OrderBookJournal, OrderBookSnapshot
+
+# Поля ордера, которые нужны стакану
+ENTRY_FIELDS = (
+    'id', 'user_id', 'type', 'token_type', 'price_per_unit',
+    'amount', 'min_amount', 'created_at', 'expires_at',
+)
+DECIMAL_FIELDS = ('price_per_unit', 'amount', 'min_amount')
+DATETIME_FIELDS = ('created_at', 'expires_at')
+
+# Как часто процесс дочитывает журнал изменений других процессов
+CATCH_UP_SECONDS = 1
+# Записи журнала перечитываются с таким запасом: транзакция с меньшим id
+# могла зафиксироваться позже транзакции с большим
+JOURNAL_OVERLAP = datetime.timedelta(seconds=10)
+# Сколько хранятся записи журнала после снимка
+JOURNAL_RETENTION = datetime.timedelta(minutes=10)
+
+
+class BookEntry:
+    """Облегченное представление активного ордера в стакане"""
+    __slots__ = ENTRY_FIELDS
+
+    def __init__(self, **values):
+        for field in ENTRY_FIELDS:
+            setattr(self, field, values[field])
+
+    @classmethod
+    def from_record(cls, record):
+        """Запись из компактного вида журнала и снимка"""
+        values = dict(zip(ENTRY_FIELDS, record))
+        for field in DECIMAL_FIELDS:
+            values[field] = Decimal(values[field])
+        for field in DATETIME_FIELDS:
+            values[field] = datetime.datetime.fromisoformat(values[field])
+        return cls(**values)
+
+    def to_record(self):
+        """Компактный вид для журнала и снимка: значения полей в порядке ``ENTRY_FIELDS``"""
+        record = []
+        for field in ENTRY_FIELDS:
+            value = getattr(self, field)
+            if field in DECIMAL_FIELDS:
+                value = str(value)
+            elif field in DATETIME_FIELDS:
+                value = value.isoformat()
+            record.append(value)
+        return record
+
+    @classmethod
+    def from_order(cls, order):
+        values = {field: getattr(order, field) for field in ENTRY_FIELDS}
+        # Представления присваивают полям float до перечитывания из базы
+        for field in DECIMAL_FIELDS:
+            values[field] = Decimal(str(values[field]))
+        return cls(**values)
+
+    @property
+    def sort_key(self):
+        """Ключ ценово-временного приоритета"""
+        price = -self.price_per_unit if self.type == 'buy' else self.price_per_unit
+        return (price, self.created_at, self.id)
+
+    def is_expired(self, now=None):
+        return (now or timezone.now()) >= self.expires_at
+
+    def __repr__(self):
+        return f"<BookEntry #{self.id} {self.type} {self.amount} {self.token_type} @ {self.price_per_unit}>"
+
+
+class OrderBook:
+    """Стакан одного токена"""
+
+    def __init__(self, token_type):
+        self.token_type = token_type
+        self._keys = {'buy': [], 'sell': []}
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, order_id):
+        return order_id in self._entries
+
+    def get(self, order_id):
+        return self._entries.get(order_id)
+
+    def add(self, entry):
+        """Добавляет или заменяет ордер в стакане"""
+        self.remove(entry.id)
+        self._entries[entry.id] = entry
+        insort(self._keys[entry.type], entry.sort_key)
+
+    def remove(self, order_id):
+        """Удаляет ордер из стакана, если он там есть"""
+        entry = self._entries.pop(order_id, None)
+        if entry is None:
+            return None
+        keys = self._keys[entry.type]
+        index = bisect_left(keys, entry.sort_key)
+        if index < len(keys) and keys[index][2] == order_id:
+            del keys[index]
+        return entry
+
+    def top(self, side, limit=None, exclude_user=None, min_price=None, max_price=None, after=None):
+        """
+        Возвращает лучшие ордера стороны с учетом фильтров.
+        ``after`` — ключ приоритета (``sort_key``), после которого начинается
+        обход. Обход останавливается, как только набрано ``limit`` записей;
+        встреченные по пути истекшие ордера удаляются из стакана.
+        """
+        now = timezone.now()
+        result = []
+        expired = []
+        with _lock:
+            keys = self._keys[side]
+            start = bisect_right(keys, after) if after is not None else 0
+            for index in range(start, len(keys)):
+                entry = self._entries[keys[index][2]]
+                if entry.is_expired(now):
+                    expired.append(entry.id)
+                    continue
+                if exclude_user is not None and entry.user_id == exclude_user:
+                    continue
+                if min_price is not None and entry.price_per_unit < min_price:
+                    continue
+                if max_price is not None and entry.price_per_unit > max_price:
+                    continue
+                result.append(entry)
+                if limit is not None and len(result) >= limit:
+                    break
+            for order_id in expired:
+                self.remove(order_id)
+        return result
+
+    def crossing(self, order_type, limit_price, exclude_user=None):
+        """
+        Возвращает встречные ордера, цена которых пересекается с ``limit_price``
+        для нового ордера типа ``order_type``, в порядке исполнения.
+        """
+        side = 'sell' if order_type == 'buy' else 'buy'
+        limit_price = Decimal(str(limit_price))
+        now = timezone.now()
+        result = []
+        with _lock:
+            for key in self._keys[side]:
+                entry = self._entries[key[2]]
+                # Стороны отсортированы по приоритету: первая непересекающаяся цена завершает обход
+                if side == 'sell' and entry.price_per_unit > limit_price:
+                    break
+                if side == 'buy' and entry.price_per_unit < limit_price:
+                    break
+                if entry.is_expired(now) or entry.user_id == exclude_user:
+                    continue
+                result.append(entry)
+        return result
+
+    def best(self, side):
+        """Лучший ордер стороны или None"""
+        entries = self.top(side, limit=1)
+        return entries[0] if entries else None
+
+
+_books = {}
+_lock = threading.RLock()
+_loaded = False
+# Последняя прочитанная запись журнала и время последней проверки журнала
+_position = 0
+_polled_at = None
+
+
+def _scan_orders():
+    """Записи активных ордеров из таблицы ``Order``"""
+    rows = Order.objects.filter(status='active', expires_at__gt=timezone.now()).values(*ENTRY_FIELDS)
+    for row in rows.iterator():
+        yield BookEntry(**row)
+
+
+def _journal_position():
+    return OrderBookJournal.objects.aggregate(position=Max('id'))['position'] or 0
+
+
+def _replay(books, since):
+    """
+    Применяет к стаканам записи журнала после ``_position`` и все записи,
+    сделанные начиная с ``since``. Повторно прочитанные записи безопасны:
+    более поздние записи того же ордера тоже попадают в выборку и
+    применяются после них.
+    """
+    global _position, _polled_at
+    rows = OrderBookJournal.objects.filter(
+        Q(id__gt=_position) | Q(created_at__gte=since)
+    ).order_by('id').values_list('id', 'order_id', 'token_type', 'entry')
+    for journal_id, order_id, token_type, record in rows.iterator():
+        book = books.setdefault(token_type, OrderBook(token_type))
+        if record is None:
+            book.remove(order_id)
+        else:
+            book.add(BookEntry.from_record(record))
+        _position = max(_position, journal_id)
+    _polled_at = time.monotonic()
+
+
+def _load():
+    """
+    Строит стаканы всех токенов из последнего снимка и журнала после него.
+    Пока снимка нет, стаканы строятся по активным ордерам из базы.
+    """
+    global _loaded, _position
+    books = {token: OrderBook(token) for token, _ in Order.TOKEN_CHOICES}
+    snapshot = OrderBookSnapshot.objects.order_by('-position', '-id').first()
+    if snapshot is not None:
+        entries = (BookEntry.from_record(record) for record in snapshot.entries)
+        _position, since = snapshot.position, snapshot.created_at - JOURNAL_OVERLAP
+    else:
+        since = timezone.now() - JOURNAL_OVERLAP
+        _position = _journal_position()
+        entries = _scan_orders()
+    for entry in entries:
+        books.setdefault(entry.token_type, OrderBook(entry.token_type)).add(entry)
+    _replay(books, since)
+    _books.clear()
+    _books.update(books)
+    _loaded = True
+
+
+def catch_up():
+    """Применяет к стаканам записи журнала, сделанные другими процессами"""
+    with _lock:
+        if not _loaded:
+            _load()
+        elif time.monotonic() - _polled_at > JOURNAL_RETENTION.total_seconds():
+            # Нужные записи журнала могли быть удалены — перечитываем снимок
+            _load()
+        else:
+            _replay(_books, timezone.now() - JOURNAL_OVERLAP)
+
+
+def get_book(token_type):
+    """
+    Возвращает стакан токена, при необходимости загружая его и
+    дочитывая журнал не чаще раза в ``CATCH_UP_SECONDS``.
+    """
+    with _lock:
+        if not _loaded:
+            _load()
+        elif time.monotonic() - _polled_at >= CATCH_UP_SECONDS and not connection.in_atomic_block:
+            # Внутри транзакции журнал не читаем: ее собственные записи еще могут откатиться
+            catch_up()
+        if token_type not in _books:
+            _books[token_type] = OrderBook(token_type)
+        return _books[token_type]
+
+
+def reset():
+    """Сбрасывает стаканы; при следующем обращении они будут загружены заново"""
+    global _loaded, _position, _polled_at
+    with _lock:
+        _books.clear()
+        _loaded = False
+        _position = 0
+        _polled_at = None
+
+
+def _apply(entry, order_id, token_type):
+    with _lock:
+        if not _loaded:
+            # Стакан еще не загружен — он прочитает актуальное состояние из базы
+            return
+        book = _books.setdefault(token_type, OrderBook(token_type))
+        if entry is None:
+            book.remove(order_id)
+        else:
+            book.add(entry)
+
+
+def _journal(changes):
+    """
+    Записывает изменения ``(order_id, token_type, entry)`` в журнал в текущей
+    транзакции БД и применяет их к стаканам процесса после ее фиксации.
+    """
+    OrderBookJournal.objects.bulk_create([
+        OrderBookJournal(
+            order_id=order_id,
+            token_type=token_type,
+            entry=entry.to_record() if entry is not None else None,
+        )
+        for order_id, token_type, entry in changes
+    ])
+
+    def apply():
+        for order_id, token_type, entry in changes:
+            _apply(entry, order_id, token_type)
+
+    transaction.on_commit(apply)
+
+
+def _change(order):
+    if order.status == 'active' and not order.is_expired():
+        return order.id, order.token_type, BookEntry.from_order(order)
+    return order.id, order.token_type, None
+
+
+def sync_order(order):
+    """
+    Приводит стакан в соответствие с состоянием ордера.
+    Изменение записывается в журнал и применяется после фиксации текущей транзакции БД.
+    """
+    _journal([_change(order)])
+
+
+def sync_orders(orders):
+    """Как ``sync_order``, но для нескольких ордеров одной записью в журнал"""
+    changes = [_change(order) for order in orders]
+    if changes:
+        _journal(changes)
+
+
+def discard(orders):
+    """
+    Удаляет из стаканов ордера, переданные парами ``(id, token_type)``.
+    Изменение записывается в журнал и применяется после фиксации текущей транзакции БД.
+    """
+    changes = [(order_id, token_type, None) for order_id, token_type in orders]
+    if changes:
+        _journal(changes)
+
+
+def refresh(order_ids):
+    """Перечитывает указанные ордера из базы (для массовых операций)"""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    sync_orders(Order.objects.filter(pk__in=order_ids))
+
+
+def write_snapshot():
+    """
+    Сохраняет снимок стакана по активным ордерам из базы и удаляет записи
+    журнала старше ``JOURNAL_RETENTION``. Возвращает снимок.
+    """
+    started = timezone.now()
+    # Журнал может быть уже очищен предыдущим снимком
+    latest = OrderBookSnapshot.objects.aggregate(position=Max('position'))['position'] or 0
+    position = max(_journal_position(), latest)
+    snapshot = OrderBookSnapshot.objects.create(
+        position=position,
+        created_at=started,
+        entries=[entry.to_record() for entry in _scan_orders()],
+    )
+    OrderBookSnapshot.objects.filter(position__lte=position).exclude(pk=snapshot.pk).delete()
+    OrderBookJournal.objects.filter(created_at__lt=started - JOURNAL_RETENTION).delete()
+    return snapshot
+
+
+def select_entries(token_type=None, side=None, exclude_user=None, min_price=None, max_price=None,
+                   limit=None, after=None):
+    """
+    Возвращает записи живых ордеров из стаканов с учетом фильтров: токены
+    в порядке ``Order.TOKEN_CHOICES``, в каждом сначала продажа, затем
+    покупка, внутри стороны — в порядке приоритета.
+
+    ``after`` — позиция ``(токен, сторона, sort_key)`` последней записи
+    предыдущей страницы; обход продолжается сразу за ней и останавливается,
+    как только набрано ``limit`` записей. Для позиции вне выбранных
+    стаканов выбрасывается ``ValueError``.
+    """
+    tokens = [token_type] if token_type else [token for token, _ in Order.TOKEN_CHOICES]
+    sides = [side] if side else ['sell', 'buy']
+    books = [(token, current_side) for token in tokens for current_side in sides]
+    start_key = None
+    if after is not None:
+        token, current_side, start_key = after
+        if (token, current_side) not in books:
+            raise ValueError(after)
+        books = books[books.index((token, current_side)):]
+
+    entries = []
+    with _lock:
+        for token, current_side in books:
+            remaining = None if limit is None else limit - len(entries)
+            if remaining is not None and remaining <= 0:
+                break
+            entries.extend(get_book(token).top(
+                current_side, limit=remaining, exclude_user=exclude_user,
+                min_price=min_price, max_price=max_price, after=start_key,
+            ))
+            start_key = None
+    return entries
+
+
+def select_ids(token_type=None, side=None, exclude_user=None, min_price=None, max_price=None):
+    """Возвращает id живых ордеров из стаканов с учетом фильтров"""
+    return [entry.id for entry in select_entries(
+        token_type=token_type, side=side, exclude_user=exclude_user,
+        min_price=min_price, max_price=max_price,
+    )]
+
+
+def load_orders(entries):
+    """Загружает полноценные объекты Order для записей стакана, сохраняя их порядок"""
+    ids = [entry.id for entry in entries]
+    orders = Order.objects.select_related('user').in_bulk(ids)
+    return [orders[order_id] for order_id in ids if order_id in orders]
@@ -0,0 +1,174 @@
+"""
+Курсорная (keyset) пагинация по ``(created_at, id)``.
+
+Вместо ``COUNT(*)`` и ``OFFSET`` страница выбирается условием
+``(created_at, id) < (курсор)`` по индексу, поэтому глубокие страницы
+читаются так же быстро, как первая. Курсор — непрозрачная строка с
+позицией последней (или первой) записи страницы и направлением перехода.
+
+Список живых ордеров API листается по стакану в памяти: курсор стакана
+хранит токен, сторону и ключ приоритета последней записи страницы.
+"""
+import base64
+import binascii
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(ValueError):
+    """Курсор поврежден или подделан"""
+
+
+def encode_cursor(obj, reverse=False):
+    """Кодирует позицию записи ``obj`` (модели или строки ``.values()``) и направление перехода"""
+    if isinstance(obj, dict):
+        created_at, pk = obj['created_at'], obj['id']
+    else:
+        created_at, pk = obj.created_at, obj.pk
+    raw = f"{'r' if reverse else 'n'}|{created_at.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Возвращает ``(created_at, pk, reverse)``; для некорректного курсора — ``InvalidCursor``"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        position = parse_datetime(created_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if position is None or direction not in ('n', 'r'):
+        raise InvalidCursor(cursor)
+    return position, pk, direction == 'r'
+
+
+def encode_book_cursor(entry):
+    """Кодирует позицию записи стакана ``entry`` (``BookEntry``)"""
+    price, created_at, pk = entry.sort_key
+    raw = f"{entry.token_type}|{entry.type}|{price}|{created_at.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_book_cursor(cursor):
+    """Возвращает ``(токен, сторона, sort_key)``; для некорректного курсора — ``InvalidCursor``"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        token, side, price, created_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        price = Decimal(price)
+        position = parse_datetime(created_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidOperation):
+        raise InvalidCursor(cursor)
+    if position is None or not price.is_finite():
+        raise InvalidCursor(cursor)
+    return token, side, (price, position, pk)
+
+
+class KeysetPage:
+    """Страница записей с курсорами соседних страниц"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def paginate_keyset(queryset, cursor=None, page_size=10, ascending=False):
+    """
+    Возвращает ``KeysetPage`` из ``queryset``, упорядоченного по
+    ``(created_at, id)`` — по убыванию или, при ``ascending=True``, по
+    возрастанию. Читается на одну запись больше страницы, чтобы узнать,
+    есть ли следующая; ``COUNT(*)`` не выполняется.
+    """
+    reverse = False
+    if cursor:
+        position, pk, reverse = decode_cursor(cursor)
+        # Переход назад читает записи в обратном порядке от первой записи страницы
+        forward = ascending != reverse
+        if forward:
+            queryset = queryset.filter(Q(created_at__gt=position) | Q(created_at=position, pk__gt=pk))
+        else:
+            queryset = queryset.filter(Q(created_at__lt=position) | Q(created_at=position, pk__lt=pk))
+    else:
+        forward = ascending
+
+    ordering = ('created_at', 'id') if forward else ('-created_at', '-id')
+    rows = list(queryset.order_by(*ordering)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if reverse:
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage(rows)
+    has_next = has_more if not reverse else True
+    has_previous = has_more if reverse else cursor is not None
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1]) if has_next else None,
+        previous_cursor=encode_cursor(rows[0], reverse=True) if has_previous else None,
+    )
+
+
+class KeysetPagination(BasePagination):
+    """Курсорная пагинация DRF: новые записи первыми"""
+    cursor_query_param = 'cursor'
+    ascending = False
+
+    def __init__(self):
+        self.page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE') or 10
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            self.page = paginate_keyset(
+                queryset, request.query_params.get(self.cursor_query_param),
+                page_size=self.page_size, ascending=self.ascending,
+            )
+        except InvalidCursor:
+            raise NotFound('Некорректный курсор')
+        return list(self.page)
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        return self.get_link(self.page.next_cursor)
+
+    def get_previous_link(self):
+        return self.get_link(self.page.previous_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class AscendingKeysetPagination(KeysetPagination):
+    """Курсорная пагинация DRF в хронологическом порядке (лента сообщений)"""
+    ascending = True
@@ -0,0 +1,222 @@
+"""
+Расчеты по сделкам P2P-биржи.
+
+Движение средств по сделке описывается изменениями балансов
+``{user_id: {поле_баланса: Decimal}}``. Изменения по пачке сделок
+складываются в памяти в чистые суммы по пользователю и активу и
+применяются одним ``UPDATE ... SET поле = поле + CASE WHEN ...`` на пачку
+пользователей, без чтения и сохранения целых строк ``User``.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from users import ledger
+from users.models import User
+from .models import Transaction
+from . import alerts, candles, stats
+
+# Токен, которым оплачивается покупка каждого токена
+PAYMENT_TOKENS = {
+    'CF': 'TON',
+    'TON': 'CF',
+    'NOT': 'CF',
+}
+
+# Сколько пользователей обновляется одним UPDATE
+UPDATE_BATCH_SIZE = 500
+
+
+def payment_token(token_type):
+    """Возвращает токен, которым оплачивается покупка ``token_type``"""
+    return PAYMENT_TOKENS.get(token_type, 'CF')
+
+
+def balance_field(token_type):
+    """Имя поля баланса пользователя для токена"""
+    return f"{token_type.lower()}_balance"
+
+
+def is_supported(token_type):
+    """Проверяет, что у пользователя есть балансы токена и токена оплаты"""
+    return hasattr(User, balance_field(token_type)) and hasattr(User, balance_field(payment_token(token_type)))
+
+
+def commission_rate():
+    """Ставка комиссии P2P в виде Decimal"""
+    return Decimal(str(settings.GAME_SETTINGS.get('P2P_COMMISSION', 0.03)))
+
+
+def new_deltas():
+    """Пустой накопитель изменений балансов"""
+    return defaultdict(lambda: defaultdict(Decimal))
+
+
+def add_trade_deltas(deltas, token_type, maker_type, maker_id, taker_id, quantity, cost, commission,
+                     taker_tokens_locked=False):
+    """
+    Добавляет в ``deltas`` изменения балансов по одной сделке.
+
+    Комиссию платит тейкер. Токены мейкерского ордера на продажу
+    заблокированы при его создании, а владелец ордера на покупку платит
+    при исполнении. Токены тейкера-продавца списываются, если они не были
+    заблокированы заранее (``taker_tokens_locked``).
+    """
+    token = balance_field(token_type)
+    pay = balance_field(payment_token(token_type))
+    if maker_type == 'sell':
+        # Тейкер покупает токены
+        deltas[taker_id][pay] -= cost + commission
+        deltas[taker_id][token] += quantity
+        deltas[maker_id][pay] += cost
+    else:
+        # Тейкер продает токены в ордер на покупку
+        deltas[maker_id][pay] -= cost
+        deltas[maker_id][token] += quantity
+        if not taker_tokens_locked:
+            deltas[taker_id][token] -= quantity
+        deltas[taker_id][pay] += cost - commission
+
+
+def merge_deltas(target, source):
+    """Прибавляет изменения ``source`` к накопителю ``target``"""
+    for user_id, fields in source.items():
+        for field, delta in fields.items():
+            target[user_id][field] += delta
+    return target
+
+
+def add_transaction_deltas(deltas, deal):
+    """Добавляет в ``deltas`` изменения балансов по сохраненной сделке"""
+    order = deal.order
+    taker_id = deal.buyer_id if order.type == 'sell' else deal.seller_id
+    add_trade_deltas(
+        deltas, deal.token_type, order.type, order.user_id, taker_id,
+        deal.amount, deal.amount * deal.price_per_unit, deal.commission,
+    )
+    return deltas
+
+
+def apply_balance_deltas(deltas):
+    """
+    Применяет изменения балансов: одно ``UPDATE`` на каждые
+    ``UPDATE_BATCH_SIZE`` пользователей, по ``CASE`` на поле баланса.
+    """
+    user_ids = [user_id for user_id, fields in deltas.items() if any(fields.values())]
+    for start in range(0, len(user_ids), UPDATE_BATCH_SIZE):
+        batch = user_ids[start:start + UPDATE_BATCH_SIZE]
+        fields = {field for user_id in batch for field, delta in deltas[user_id].items() if delta}
+        changes = {}
+        for field in fields:
+            output_field = User._meta.get_field(field)
+            whens = [
+                When(pk=user_id, then=Value(deltas[user_id][field], output_field=output_field))
+                for user_id in batch if deltas[user_id].get(field)
+            ]
+            changes[field] = F(field) + Case(
+                *whens, default=Value(Decimal('0'), output_field=output_field), output_field=output_field
+            )
+        User.objects.filter(pk__in=batch).update(**changes)
+
+
+def lock_funds(order):
+    """
+    Блокирует средства под ордер на продажу условным ``UPDATE ... WHERE
+    баланс >= amount`` с ``F()``-выражением и пишет движение в журнал.
+    Возвращает False, если баланса не хватает; ордерам на покупку и
+    токенам без баланса блокировать нечего.
+    """
+    field = balance_field(order.token_type)
+    if order.type != 'sell' or not hasattr(User, field):
+        return True
+    locked = User.objects.filter(pk=order.user_id, **{f'{field}__gte': order.amount}).update(
+        **{field: F(field) - order.amount}
+    )
+    if locked:
+        ledger.record(order.user_id, order.token_type, -order.amount, 'p2p_lock', order)
+    return bool(locked)
+
+
+def refund_locked(rows, reason='p2p_refund'):
+    """
+    Возвращает владельцам средства, заблокированные под ордера на продажу.
+    ``rows`` — словари с ключами ``id``, ``user_id``, ``type``, ``token_type``
+    и ``amount``; балансы обновляются пачкой, движения пишутся в журнал.
+    """
+    refunds = new_deltas()
+    entries = []
+    for row in rows:
+        field = balance_field(row['token_type'])
+        if row['type'] == 'sell' and hasattr(User, field):
+            refunds[row['user_id']][field] += row['amount']
+            entries.append(ledger.entry(
+                row['user_id'], row['token_type'], row['amount'], reason, f"p2p.order:{row['id']}"
+            ))
+    apply_balance_deltas(refunds)
+    ledger.write(entries)
+
+
+@transaction.atomic
+def settle_transactions(transactions, statuses=('paid',)):
+    """
+    Рассчитывает пачку сделок: переводит средства между сторонами и
+    отмечает сделки завершенными.
+
+    Сделки перечитываются с блокировкой, и рассчитываются только те, что
+    все еще находятся в одном из ``statuses``, поэтому повторный вызов не
+    переведет средства дважды. Движения по каждой сделке пишутся в журнал
+    балансов одной вставкой. Рассчитанные сделки попадают в свечи и
+    статистику и проверяют ценовые оповещения только сейчас: отмененная
+    ожидающая сделка рынок не двигает.
+
+    Ожидающая сделка не резервирует средства покупателя, поэтому балансы
+    участников тоже перечитываются с блокировкой: сделка, которую баланс
+    не покрывает с учетом уже принятых сделок пачки, пропускается и
+    остается в прежнем статусе. Возвращает список рассчитанных сделок.
+    """
+    ids = [deal.pk for deal in transactions]
+    candidates = [
+        deal for deal in Transaction.objects.select_for_update().select_related('order').filter(
+            pk__in=ids, status__in=statuses
+        ).order_by('pk')
+        if is_supported(deal.token_type)
+    ]
+    if not candidates:
+        return []
+
+    user_ids = {deal.buyer_id for deal in candidates} | {deal.seller_id for deal in candidates}
+    users = User.objects.select_for_update().in_bulk(user_ids)
+
+    deltas = new_deltas()
+    entries = []
+    batch = []
+    for deal in candidates:
+        deal_deltas = add_transaction_deltas(new_deltas(), deal)
+        covered = all(
+            getattr(users[user_id], field) + deltas[user_id][field] + delta >= 0
+            for user_id, fields in deal_deltas.items()
+            for field, delta in fields.items() if delta < 0
+        )
+        if not covered:
+            continue
+        entries.extend(ledger.entries_from_deltas(deal_deltas, 'p2p_trade', deal))
+        merge_deltas(deltas, deal_deltas)
+        batch.append(deal)
+    if not batch:
+        return []
+    apply_balance_deltas(deltas)
+    ledger.write(entries)
+
+    now = timezone.now()
+    Transaction.objects.filter(pk__in=[deal.pk for deal in batch]).update(status='completed', updated_at=now)
+    for deal in batch:
+        deal.status = 'completed'
+        deal.updated_at = now
+    candles.record_trades(batch)
+    alerts.check_trades(batch)
+    stats.record_trades(batch)
+    return batch
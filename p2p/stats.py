@@ -0,0 +1,135 @@
+"""
+Скользящая статистика P2P-биржи за 24 часа: объем, VWAP и количество сделок.
+
+Для каждого токена в памяти процесса хранятся минутные корзины окна и их
+суммы, поэтому чтение статистики — O(1). Корзины совпадают с минутными
+свечами (``PriceCandle``, интервал 1m), которые сохраняются в транзакции
+каждой завершенной сделки (``candles.record_trades``), — они и служат
+постоянным хранилищем окна. Процесс заполняет окно из свечей при первом обращении и
+затем дочитывает только свечи, обновленные после прошлой синхронизации:
+раз в ``SYNC_SECONDS`` (так в окно попадают сделки других процессов) и
+сразу после сделок своего процесса (``record_trades``). Значение корзины
+берется из свечи целиком, поэтому повторное чтение ничего не удваивает.
+"""
+import datetime
+import threading
+import time
+from bisect import insort
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .candles import bucket_start
+from .models import PriceCandle
+
+WINDOW = datetime.timedelta(hours=24)
+SYNC_SECONDS = 5
+# Свечи перечитываются с запасом: транзакция сделки могла зафиксироваться позже
+SYNC_OVERLAP = datetime.timedelta(seconds=10)
+PRICE_STEP = Decimal('0.00000001')
+VOLUME_STEP = Decimal('0.01')
+
+_ZERO = (Decimal(0), Decimal(0), 0)
+
+
+class RollingWindow:
+    """Минутные корзины одного токена за последние 24 часа и их суммы"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._minutes = []
+        self.volume = Decimal(0)
+        self.quote_volume = Decimal(0)
+        self.trades = 0
+
+    def set(self, minute, volume, quote_volume, trades):
+        """Устанавливает значения корзины ``minute`` (начало минуты)"""
+        old_volume, old_quote, old_trades = self._buckets.get(minute, _ZERO)
+        if minute not in self._buckets:
+            insort(self._minutes, minute)
+        self._buckets[minute] = (volume, quote_volume, trades)
+        self.volume += volume - old_volume
+        self.quote_volume += quote_volume - old_quote
+        self.trades += trades - old_trades
+
+    def expire(self, since):
+        """Удаляет корзины раньше ``since``"""
+        expired = 0
+        for minute in self._minutes:
+            if minute >= since:
+                break
+            volume, quote_volume, trades = self._buckets.pop(minute)
+            self.volume -= volume
+            self.quote_volume -= quote_volume
+            self.trades -= trades
+            expired += 1
+        if expired:
+            del self._minutes[:expired]
+
+    def summary(self):
+        vwap = self.quote_volume / self.volume if self.volume else None
+        return {
+            'volume_24h': self.volume.quantize(VOLUME_STEP),
+            'quote_volume_24h': self.quote_volume.quantize(PRICE_STEP),
+            'vwap_24h': vwap.quantize(PRICE_STEP) if vwap is not None else None,
+            'trades_24h': self.trades,
+        }
+
+
+_windows = {}
+_lock = threading.RLock()
+_synced_at = None
+_position = None
+_dirty = False
+
+
+def _sync(now):
+    """Переносит в окна минутные свечи, обновленные после прошлой синхронизации"""
+    global _synced_at, _position, _dirty
+    started = timezone.now()
+    since = bucket_start(now - WINDOW, '1m')
+    candles = PriceCandle.objects.filter(interval='1m', bucket__gte=since)
+    if _position is not None:
+        candles = candles.filter(updated_at__gte=_position - SYNC_OVERLAP)
+    rows = candles.values_list('token_type', 'bucket', 'volume', 'quote_volume', 'trades')
+    for token_type, bucket, volume, quote_volume, trades in rows.iterator():
+        _windows.setdefault(token_type, RollingWindow()).set(bucket, volume, quote_volume, trades)
+    _position = started
+    _synced_at = time.monotonic()
+    _dirty = False
+
+
+def get_stats(token_type, now=None):
+    """Объем, объем в валюте оплаты, VWAP и количество сделок токена за 24 часа"""
+    now = now or timezone.now()
+    with _lock:
+        if _synced_at is None or _dirty or time.monotonic() - _synced_at >= SYNC_SECONDS:
+            _sync(now)
+        window = _windows.setdefault(token_type, RollingWindow())
+        window.expire(bucket_start(now - WINDOW, '1m'))
+        return dict(window.summary(), token=token_type)
+
+
+def _mark_dirty():
+    global _dirty
+    _dirty = True
+
+
+def record_trades(deals):
+    """
+    Отмечает, что окна нужно дочитать из свечей после фиксации транзакции
+    сделок. Вызывается рядом с ``candles.record_trades``.
+    """
+    if deals:
+        transaction.on_commit(_mark_dirty)
+
+
+def reset():
+    """Сбрасывает окна; при следующем обращении они будут заполнены из свечей"""
+    global _synced_at, _position, _dirty
+    with _lock:
+        _windows.clear()
+        _synced_at = None
+        _position = None
+        _dirty = False
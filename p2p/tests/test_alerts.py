@@ -0,0 +1,123 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+
+from notifications.models import Notification
+from p2p import alerts, orderbook
+from p2p.matching import fill_order
+from p2p.models import Order, PriceAlert, Transaction
+from p2p.settlement import settle_transactions
+from users.models import User
+
+
+class PriceAlertTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        alerts.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('1000'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            ton_balance=Decimal('1000'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+        alerts.reset()
+
+    def create_alert(self, direction, threshold, token_type='CF'):
+        with self.captureOnCommitCallbacks(execute=True):
+            alert = PriceAlert.objects.create(
+                user=self.buyer, token_type=token_type, direction=direction, threshold=Decimal(threshold)
+            )
+            alerts.sync_alert(alert)
+        return alert
+
+    def trade(self, price, token_type='CF', settle=True):
+        order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type=token_type,
+            amount=Decimal('10'),
+            price_per_unit=Decimal(price),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            return fill_order(order.pk, self.buyer, '1', settle=settle)
+
+    def test_index_finds_triggered_alerts_by_bisect(self):
+        index = alerts.AlertIndex()
+        index.add(1, 'above', Decimal('0.5'))
+        index.add(2, 'above', Decimal('0.6'))
+        index.add(3, 'above', Decimal('0.7'))
+        index.add(4, 'below', Decimal('0.4'))
+        index.add(5, 'below', Decimal('0.55'))
+
+        self.assertEqual(index.triggered(Decimal('0.45'), Decimal('0.6')), [1, 2, 5])
+        self.assertEqual(index.triggered(Decimal('0.56'), Decimal('0.56')), [1])
+        index.remove(1)
+        self.assertEqual(index.triggered(Decimal('0.3'), Decimal('0.3')), [4, 5])
+        self.assertEqual(len(index), 4)
+
+    def test_trade_creates_notifications(self):
+        above = self.create_alert('above', '0.5')
+        self.create_alert('above', '0.9')
+        below = self.create_alert('below', '0.6')
+        self.create_alert('below', '0.5', token_type='TON')
+
+        self.trade('0.55')
+
+        notifications = Notification.objects.filter(user=self.buyer, type='price')
+        self.assertEqual(notifications.count(), 2)
+        self.assertEqual(set(notifications.values_list('message', flat=True)), {
+            'Цена CF поднялась до 0.55 (порог 0.5)',
+            'Цена CF опустилась до 0.55 (порог 0.6)',
+        })
+        self.assertEqual(
+            set(PriceAlert.objects.filter(is_active=False).values_list('id', flat=True)),
+            {above.id, below.id}
+        )
+        self.assertIsNotNone(PriceAlert.objects.get(pk=above.pk).triggered_at)
+
+    def test_pending_trade_triggers_on_settlement(self):
+        self.create_alert('above', '0.5')
+        deal = self.trade('0.55', settle=False)
+        self.assertFalse(Notification.objects.exists())
+
+        Transaction.objects.filter(pk=deal.pk).update(status='paid')
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_transactions([deal])
+        self.assertEqual(Notification.objects.filter(type='price').count(), 1)
+
+    def test_alert_triggers_once(self):
+        self.create_alert('above', '0.5')
+        self.trade('0.55')
+        self.trade('0.6')
+        self.assertEqual(Notification.objects.filter(type='price').count(), 1)
+
+    def test_stale_index_does_not_notify_twice(self):
+        alert = self.create_alert('above', '0.5')
+        # Оповещение уже сработало в другом процессе
+        PriceAlert.objects.filter(pk=alert.pk).update(is_active=False)
+        self.trade('0.55')
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(alerts.get_index('CF')), 0)
+
+    def test_batch_uses_single_bulk_insert(self):
+        deal = self.trade('0.5')
+        for threshold in ('0.1', '0.2', '0.3', '0.4'):
+            self.create_alert('above', threshold)
+
+        with self.assertNumQueries(5):
+            # SAVEPOINT, SELECT ... FOR UPDATE, UPDATE, INSERT уведомлений, RELEASE
+            alerts.check_trades([deal])
+        self.assertFalse(PriceAlert.objects.filter(is_active=True).exists())
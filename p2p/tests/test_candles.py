@@ -0,0 +1,191 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from io import StringIO
+import datetime
+
+from p2p import candles, orderbook
+from p2p.matching import fill_order
+from p2p.models import Order, PriceCandle, Transaction
+from p2p.settlement import settle_transactions
+from users.models import User
+
+UTC = datetime.timezone.utc
+
+
+class PriceCandleTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('1000'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def create_deal(self, price, amount, created_at, status='completed'):
+        deal = Transaction.objects.create(
+            order=self.order,
+            buyer=self.buyer,
+            seller=self.seller,
+            amount=Decimal(amount),
+            price_per_unit=Decimal(price),
+            token_type='CF',
+            commission=Decimal('0'),
+            status=status
+        )
+        Transaction.objects.filter(pk=deal.pk).update(created_at=created_at)
+        deal.created_at = created_at
+        return deal
+
+    def test_builder_aggregates_ohlcv(self):
+        start = datetime.datetime(2026, 1, 5, 10, 0, 10, tzinfo=UTC)
+        builder = candles.CandleBuilder()
+        builder.add('CF', Decimal('2'), Decimal('10'), start + datetime.timedelta(seconds=20))
+        builder.add('CF', Decimal('1'), Decimal('5'), start)
+        builder.add('CF', Decimal('3'), Decimal('1'), start + datetime.timedelta(seconds=40))
+
+        minute = builder.candles['CF', '1m', start.replace(second=0)]
+        self.assertEqual(
+            (minute['open'], minute['high'], minute['low'], minute['close']),
+            (Decimal('1'), Decimal('3'), Decimal('1'), Decimal('3'))
+        )
+        self.assertEqual(minute['volume'], Decimal('16'))
+        self.assertEqual(minute['quote_volume'], Decimal('28'))
+        self.assertEqual(minute['trades'], 3)
+        self.assertIn(('CF', '1d', start.replace(hour=0, minute=0, second=0)), builder.candles)
+
+    def test_fills_update_candles_incrementally(self):
+        """Каждое исполнение ордера сразу попадает во все интервалы"""
+        fill_order(self.order.pk, self.buyer, '10')
+        fill_order(self.order.pk, self.buyer, '30')
+
+        for interval in candles.INTERVALS:
+            candle = PriceCandle.objects.get(token_type='CF', interval=interval)
+            self.assertEqual(candle.trades, 2)
+            self.assertEqual(candle.volume, Decimal('40'))
+            self.assertEqual(candle.quote_volume, Decimal('20'))
+            self.assertEqual(candle.close, Decimal('0.5'))
+
+    def test_pending_fill_is_recorded_on_settlement(self):
+        """Ожидающая сделка попадает в свечи только после расчета, отмененная — никогда"""
+        cancelled = fill_order(self.order.pk, self.buyer, '10', settle=False)
+        paid = fill_order(self.order.pk, self.buyer, '30', settle=False)
+        self.assertFalse(PriceCandle.objects.exists())
+
+        Transaction.objects.filter(pk=cancelled.pk).update(status='cancelled')
+        Transaction.objects.filter(pk=paid.pk).update(status='paid')
+        settle_transactions([cancelled, paid])
+
+        candle = PriceCandle.objects.get(token_type='CF', interval='1m')
+        self.assertEqual((candle.trades, candle.volume), (1, Decimal('30')))
+        self.assertEqual(candles.rebuild_candles(), len(candles.INTERVALS))
+        self.assertEqual(PriceCandle.objects.get(token_type='CF', interval='1m').volume, Decimal('30'))
+
+    def test_record_trades_merges_into_existing_candle(self):
+        moment = datetime.datetime(2026, 1, 5, 10, 0, tzinfo=UTC)
+        candles.record_trades([self.create_deal('2', '10', moment)])
+        candles.record_trades([
+            self.create_deal('5', '1', moment + datetime.timedelta(seconds=5)),
+            self.create_deal('1', '2', moment + datetime.timedelta(seconds=9)),
+        ])
+
+        candle = PriceCandle.objects.get(token_type='CF', interval='1m', bucket=moment)
+        self.assertEqual(
+            (candle.open, candle.high, candle.low, candle.close),
+            (Decimal('2'), Decimal('5'), Decimal('1'), Decimal('1'))
+        )
+        self.assertEqual(candle.volume, Decimal('13'))
+        self.assertEqual(candle.trades, 3)
+
+    def test_out_of_order_settlement_matches_rebuild(self):
+        """Сделка, рассчитанная позже более новой, не меняет цену закрытия"""
+        moment = datetime.datetime(2026, 1, 5, 10, 0, tzinfo=UTC)
+        first = self.create_deal('1', '1', moment, status='paid')
+        middle = self.create_deal('5', '1', moment + datetime.timedelta(seconds=20), status='paid')
+        last = self.create_deal('3', '1', moment + datetime.timedelta(seconds=40), status='paid')
+        for deal in (last, first, middle):
+            settle_transactions([deal])
+
+        def snapshot():
+            return sorted(PriceCandle.objects.values_list(
+                'interval', 'bucket', 'open', 'high', 'low', 'close', 'volume', 'trades',
+                'first_trade_at', 'last_trade_at',
+            ))
+
+        incremental = snapshot()
+        minute = PriceCandle.objects.get(token_type='CF', interval='1m', bucket=moment)
+        self.assertEqual((minute.open, minute.close), (Decimal('1'), Decimal('3')))
+        candles.rebuild_candles()
+        self.assertEqual(incremental, snapshot())
+
+    def test_backfill_rebuilds_history(self):
+        day = datetime.datetime(2026, 1, 5, 10, 0, tzinfo=UTC)
+        self.create_deal('2', '10', day)
+        self.create_deal('3', '10', day + datetime.timedelta(hours=1))
+        self.create_deal('4', '10', day + datetime.timedelta(days=1))
+        cancelled = self.create_deal('100', '10', day)
+        Transaction.objects.filter(pk=cancelled.pk).update(status='cancelled')
+
+        out = StringIO()
+        call_command('build_candles', stdout=out)
+        # 3 минутные, 3 часовые и 2 дневные свечи
+        self.assertIn('Построено свечей: 8', out.getvalue())
+
+        first_day = PriceCandle.objects.get(interval='1d', bucket=day.replace(hour=0))
+        self.assertEqual((first_day.open, first_day.close, first_day.high), (Decimal('2'), Decimal('3'), Decimal('3')))
+        self.assertEqual(first_day.trades, 2)
+
+        # Повторное построение заменяет свечи, а не дублирует их
+        self.assertEqual(candles.rebuild_candles(), 8)
+        self.assertEqual(PriceCandle.objects.count(), 8)
+
+    def test_daily_chart_carries_last_close_forward(self):
+        today = datetime.date(2026, 1, 10)
+        candles.record_trades([
+            self.create_deal('2', '1', datetime.datetime(2026, 1, 1, 12, tzinfo=UTC)),
+            self.create_deal('3', '1', datetime.datetime(2026, 1, 8, 12, tzinfo=UTC)),
+        ])
+        labels, values = candles.daily_chart('CF', days=4, today=today)
+        self.assertEqual(labels, ['07.01', '08.01', '09.01', '10.01'])
+        self.assertEqual(values, [2.0, 3.0, 3.0, 3.0])
+        self.assertEqual(candles.daily_chart('TON', days=2, today=today)[1], [None, None])
+
+    def test_json_endpoint(self):
+        session = self.client.session
+        session['telegram_id'] = self.buyer.telegram_id
+        session.save()
+        fill_order(self.order.pk, self.buyer, '10')
+
+        response = self.client.get('/p2p/candles/', {'token': 'cf', 'interval': '1m'})
+        data = response.json()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(len(data['candles']), 1)
+        self.assertEqual(data['candles'][0]['close'], 0.5)
+        self.assertEqual(data['candles'][0]['volume'], 10.0)
+
+        response = self.client.get('/p2p/candles/', {'interval': '5m'})
+        self.assertEqual(response.status_code, 400)
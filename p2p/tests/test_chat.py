@@ -0,0 +1,207 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from unittest import mock
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+
+from p2p import chat
+from p2p.models import Message, Order, Transaction
+from users.models import User
+
+
+def parse(event):
+    fields = dict(line.split(': ', 1) for line in event.strip().splitlines())
+    return fields['event'], json.loads(fields['data'])
+
+
+class DealChatStreamTest(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(telegram_id=111111111, username='seller', first_name='Seller')
+        self.buyer = User.objects.create(telegram_id=222222222, username='buyer', first_name='Buyer')
+        order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        self.deal = Transaction.objects.create(
+            order=order,
+            buyer=self.buyer,
+            seller=self.seller,
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            token_type='CF',
+            commission=Decimal('0')
+        )
+        self.first = Message.objects.create(transaction=self.deal, sender=self.seller, content='Привет')
+
+    def login(self, user):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+
+    async def test_stream_resumes_after_last_seen_id(self):
+        stream = chat.event_stream(self.deal.id, self.buyer.pk, last_id=0, poll_seconds=0.01)
+        self.assertTrue((await anext(stream)).startswith('retry:'))
+        event, data = parse(await anext(stream))
+        self.assertEqual(event, 'message')
+        self.assertEqual((data['id'], data['content'], data['is_my_message']), (self.first.id, 'Привет', False))
+        await stream.aclose()
+
+        # Открытый чат отметил входящее сообщение прочитанным
+        await self.first.arefresh_from_db()
+        self.assertTrue(self.first.is_read)
+
+        stream = chat.event_stream(self.deal.id, self.buyer.pk, last_id=self.first.id, poll_seconds=0.01)
+        await anext(stream)
+        self.assertEqual(await anext(stream), ': ping\n\n')
+        await stream.aclose()
+
+    async def test_new_message_wakes_stream(self):
+        stream = chat.event_stream(self.deal.id, self.buyer.pk, last_id=self.first.id, poll_seconds=60)
+        await anext(stream)
+        await anext(stream)
+
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        second = await Message.objects.acreate(transaction=self.deal, sender=self.seller, content='Оплатили?')
+        chat.wake(self.deal.id)
+
+        event, data = parse(await asyncio.wait_for(pending, timeout=5))
+        self.assertEqual((event, data['id']), ('message', second.id))
+        await stream.aclose()
+
+    async def test_read_receipts(self):
+        stream = chat.event_stream(self.deal.id, self.seller.pk, last_id=self.first.id, poll_seconds=0.01)
+        await anext(stream)
+        await anext(stream)
+
+        await Message.objects.filter(pk=self.first.pk).aupdate(is_read=True)
+        event = await anext(stream)
+        self.assertEqual(parse(event), ('read', {'up_to': self.first.id}))
+        self.assertIn(f'id: {self.first.id}', event)
+        # Повторно отметка не отправляется
+        self.assertEqual(await anext(stream), ': ping\n\n')
+        await stream.aclose()
+
+    def test_one_query_per_event(self):
+        @async_to_sync
+        async def read_events(count):
+            stream = chat.event_stream(self.deal.id, self.seller.pk, last_id=self.first.id, poll_seconds=0.01)
+            events = [await anext(stream) for _ in range(count)]
+            await stream.aclose()
+            return events
+
+        # Отметка о прочтении при подключении и по одному запросу на каждую проверку
+        with self.assertNumQueries(4):
+            events = read_events(4)
+        self.assertEqual(events[1:], [': ping\n\n'] * 3)
+
+    def test_endpoint_checks_participant(self):
+        stranger = User.objects.create(telegram_id=333333333, username='stranger', first_name='Stranger')
+        self.login(stranger)
+        response = self.client.get(f'/p2p/transactions/{self.deal.id}/events/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_send_message_notifies_open_streams(self):
+        self.login(self.buyer)
+        with mock.patch('p2p.chat.wake') as wake:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    f'/p2p/transactions/{self.deal.id}/message/', {'content': 'Да'},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+                )
+        wake.assert_called_once_with(self.deal.id)
+
+    def test_deal_page_subscribes_to_stream(self):
+        self.login(self.buyer)
+        response = self.client.get(f'/p2p/transactions/{self.deal.id}/')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertLess(len(content), 100_000)
+        self.assertEqual(content.count('function addMessageToChat('), 1)
+        self.assertEqual(content.count('new EventSource('), 1)
+        self.assertIn(f"/p2p/transactions/{self.deal.id}/events/?after={self.first.id}", content)
+        self.assertContains(response, f'data-message-id="{self.first.id}"')
+
+
+class UnreadCounterTest(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(telegram_id=111111111, username='seller', first_name='Seller')
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        self.deal = Transaction.objects.create(
+            order=order,
+            buyer=self.buyer,
+            seller=self.seller,
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            token_type='CF',
+            commission=Decimal('0')
+        )
+
+    def login(self, user):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+
+    def send(self, user, content):
+        self.login(user)
+        self.client.post(
+            f'/p2p/transactions/{self.deal.id}/message/', {'content': content},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    def test_messages_increment_recipient_counter(self):
+        self.send(self.seller, 'Реквизиты отправил')
+        self.send(self.seller, 'Жду оплату')
+        self.send(self.buyer, 'Оплатил')
+
+        self.deal.refresh_from_db()
+        self.assertEqual(self.deal.message_count, 3)
+        self.assertEqual((self.deal.buyer_unread, self.deal.seller_unread), (2, 1))
+        self.assertEqual(self.deal.unread_for(self.buyer), 2)
+
+    def test_mark_read_clears_counter_with_set_updates(self):
+        self.send(self.seller, 'Первое')
+        self.send(self.seller, 'Второе')
+        self.send(self.buyer, 'Ответ')
+
+        with self.assertNumQueries(4):
+            # SAVEPOINT, UPDATE сделки, UPDATE сообщений, RELEASE
+            self.assertEqual(chat.mark_read(self.deal.id, self.buyer.pk), 2)
+        self.deal.refresh_from_db()
+        self.assertEqual((self.deal.buyer_unread, self.deal.seller_unread), (0, 1))
+        self.assertFalse(Message.objects.filter(sender=self.seller, is_read=False).exists())
+
+    def test_deal_page_resets_counter(self):
+        self.send(self.seller, 'Привет')
+        self.login(self.buyer)
+        self.client.get(f'/p2p/transactions/{self.deal.id}/')
+        self.deal.refresh_from_db()
+        self.assertEqual(self.deal.buyer_unread, 0)
+
+    def test_market_history_shows_badge(self):
+        self.send(self.seller, 'Привет')
+        self.login(self.buyer)
+        response = self.client.get('/p2p/')
+        self.assertContains(response, '<span class="unread-badge" title="Непрочитанные сообщения">1</span>', html=True)
@@ -0,0 +1,124 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from io import StringIO
+
+from notifications.models import Notification, NotificationSettings
+from p2p import orderbook
+from p2p.expiry import _expire_chunk, sweep_expired_orders
+from p2p.models import Order, SweepCheckpoint
+from users.models import User
+
+
+class ExpirySweepTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.user = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('100'),
+            ton_balance=Decimal('10'),
+        )
+        self.other = User.objects.create(
+            telegram_id=222222222,
+            username='other',
+            first_name='Other',
+            cf_balance=Decimal('100'),
+            ton_balance=Decimal('10'),
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def create_order(self, user, order_type, amount, expires_in, token_type='CF'):
+        return Order.objects.create(
+            user=user,
+            type=order_type,
+            token_type=token_type,
+            amount=Decimal(amount),
+            price_per_unit=Decimal('1'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(minutes=expires_in)
+        )
+
+    def test_expires_in_chunks_and_refunds_sell_orders(self):
+        """Истекшие ордера закрываются пачками, средства ордеров на продажу возвращаются"""
+        first = self.create_order(self.user, 'sell', '30', -10)
+        second = self.create_order(self.user, 'sell', '20', -5)
+        ton = self.create_order(self.user, 'sell', '2', -5, token_type='TON')
+        bid = self.create_order(self.other, 'buy', '50', -5)
+        live = self.create_order(self.other, 'sell', '10', 60)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            expired = sweep_expired_orders(chunk_size=2)
+
+        self.assertEqual(expired, 4)
+        for order in (first, second, ton, bid):
+            order.refresh_from_db()
+            self.assertEqual(order.status, 'expired')
+        live.refresh_from_db()
+        self.assertEqual(live.status, 'active')
+
+        self.user.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('150'))
+        self.assertEqual(self.user.ton_balance, Decimal('12'))
+        self.assertEqual(self.other.cf_balance, Decimal('100'))
+        self.assertEqual(Notification.objects.filter(type='order').count(), 4)
+
+    def test_checkpoint_limits_next_pass(self):
+        """Следующий проход не трогает ордера, истекшие до контрольной точки"""
+        sweep_expired_orders()
+        checkpoint = SweepCheckpoint.objects.get(name='order_expiry')
+        self.assertIsNotNone(checkpoint.position)
+
+        # Ордер, истекший раньше контрольной точки, виден только при полном проходе
+        stale = self.create_order(self.user, 'sell', '10', -60)
+        self.assertEqual(sweep_expired_orders(), 0)
+        self.assertEqual(sweep_expired_orders(full=True), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'expired')
+
+    def test_muted_users_get_no_notifications(self):
+        """Пользователи, отключившие уведомления об ордерах, их не получают"""
+        NotificationSettings.objects.create(user=self.user, order_notifications=False)
+        self.create_order(self.user, 'sell', '10', -1)
+        self.create_order(self.other, 'sell', '10', -1)
+
+        sweep_expired_orders()
+        self.assertEqual(list(Notification.objects.values_list('user_id', flat=True)), [self.other.pk])
+
+    def test_expired_orders_leave_the_book(self):
+        """Истекшие ордера удаляются из стакана после фиксации"""
+        order = self.create_order(self.user, 'sell', '10', 60)
+        book = orderbook.get_book('CF')
+        self.assertIn(order.id, book)
+
+        Order.objects.filter(pk=order.pk).update(expires_at=timezone.now() - timezone.timedelta(minutes=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            sweep_expired_orders()
+        self.assertNotIn(order.id, book)
+
+    def test_stale_rows_are_not_refunded_twice(self):
+        """Ордер, закрытый другим процессом после чтения пачки, не возвращает средства повторно"""
+        first = self.create_order(self.user, 'sell', '30', -10)
+        second = self.create_order(self.user, 'sell', '20', -5)
+        rows = list(Order.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk').values(
+            'id', 'user_id', 'type', 'token_type', 'amount'
+        ))
+        # Другой проход уже перевел первый ордер и вернул его средства
+        self.assertEqual(len(_expire_chunk(rows[:1], timezone.now())), 1)
+
+        moved = _expire_chunk(rows, timezone.now())
+        self.assertEqual([row['id'] for row in moved], [second.pk])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('150'))
+        self.assertEqual(Notification.objects.filter(type='order').count(), 2)
+
+    def test_management_command(self):
+        self.create_order(self.user, 'sell', '10', -1)
+        out = StringIO()
+        call_command('expire_orders', stdout=out)
+        self.assertIn('Истекло ордеров: 1', out.getvalue())
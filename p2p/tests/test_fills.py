@@ -0,0 +1,216 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from unittest import mock
+
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from p2p import orderbook, views
+from p2p.api.views import OrderViewSet
+from p2p.matching import FillError, cancel_order, fill_order
+from p2p.models import Order, Transaction
+from users.models import User
+
+
+class PartialFillTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('100'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('10'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def login(self, user):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+
+    def test_partial_fill_through_web_view(self):
+        """buy_order исполняет указанное количество и оставляет ордер активным"""
+        self.login(self.buyer)
+        response = self.client.post(
+            f'/p2p/orders/{self.order.id}/buy/', {'amount': '40'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = response.json()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(data['order_remaining'], '60.00')
+        self.assertEqual(Transaction.objects.get(pk=data['transaction_id']).amount, Decimal('40'))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.amount, Decimal('60'))
+        self.assertEqual(self.order.status, 'active')
+
+        # 40 * 0.5 = 20 TON плюс 3% комиссии
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.ton_balance, Decimal('79.40'))
+        self.assertEqual(self.buyer.cf_balance, Decimal('1040'))
+        self.assertEqual(self.seller.ton_balance, Decimal('120'))
+
+    def test_min_amount_is_enforced(self):
+        """Нельзя купить меньше min_amount, если это не весь остаток"""
+        with self.assertRaisesMessage(FillError, 'Минимальная сумма покупки'):
+            fill_order(self.order.id, self.buyer, '5')
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_remaining_below_min_amount_can_be_taken(self):
+        """Остаток меньше min_amount можно выкупить целиком, после чего ордер завершается"""
+        fill_order(self.order.id, self.buyer, '95')
+        fill_order(self.order.id, self.buyer, '5')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.amount, Decimal('0'))
+        self.assertEqual(self.order.status, 'completed')
+        self.assertIsNotNone(self.order.completed_at)
+
+    def test_default_amount_fills_whole_order(self):
+        """Без количества ордер исполняется целиком"""
+        transaction = fill_order(self.order.id, self.buyer)
+        self.assertEqual(transaction.amount, Decimal('100'))
+        self.assertEqual(transaction.order.status, 'completed')
+
+    def test_cannot_take_more_than_remaining(self):
+        """Второй покупатель не может забрать уже выкупленный объем"""
+        fill_order(self.order.id, self.buyer, '80')
+        with self.assertRaises(FillError):
+            fill_order(self.order.id, self.buyer, '30')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.amount, Decimal('20'))
+
+    def test_insufficient_balance(self):
+        """Покупатель без средств не уменьшает остаток ордера"""
+        User.objects.filter(pk=self.buyer.pk).update(ton_balance=Decimal('1'))
+        with self.assertRaisesMessage(FillError, 'Недостаточно TON'):
+            fill_order(self.order.id, self.buyer, '50')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.amount, Decimal('100'))
+
+    def test_pending_fill_does_not_move_balances(self):
+        """Для API создается ожидающая сделка без перевода средств"""
+        transaction = fill_order(self.order.id, self.buyer, '20', settle=False)
+        self.assertEqual(transaction.status, 'pending')
+
+        self.buyer.refresh_from_db()
+        self.assertEqual(self.buyer.ton_balance, Decimal('100'))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.amount, Decimal('80'))
+
+    def test_expired_order_is_marked(self):
+        """Истекший ордер помечается истекшим, возвращает средства и не исполняется"""
+        Order.objects.filter(pk=self.order.pk).update(expires_at=timezone.now() - timezone.timedelta(minutes=1))
+        with self.assertRaisesMessage(FillError, 'Ордер истек'):
+            fill_order(self.order.id, self.buyer, '20')
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'expired')
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.cf_balance, Decimal('1100'))
+
+
+class CancelOrderTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('900'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        # 100 CF уже заблокированы под ордер
+        self.order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('100'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('10'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def fill_after_read(self, read):
+        """Оборачивает чтение ордера так, что сразу после него проходит исполнение"""
+        def wrapper(*args, **kwargs):
+            order = read(*args, **kwargs)
+            fill_order(self.order.pk, self.buyer, '40')
+            return order
+        return wrapper
+
+    def assert_refunded_remaining(self):
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.amount), ('cancelled', Decimal('60')))
+        self.seller.refresh_from_db()
+        # 900 + 60 неисполненного остатка, а не 900 + 100 прочитанных до исполнения
+        self.assertEqual(self.seller.cf_balance, Decimal('960'))
+
+    def test_api_cancel_refunds_amount_left_after_concurrent_fill(self):
+        view = OrderViewSet.as_view({'post': 'cancel'})
+        request = APIRequestFactory().post(f'/p2p/api/orders/{self.order.pk}/cancel/')
+        force_authenticate(request, user=self.seller)
+        with mock.patch.object(OrderViewSet, 'permission_classes', []), \
+                mock.patch.object(OrderViewSet, 'get_object', self.fill_after_read(OrderViewSet.get_object)):
+            response = view(request, pk=self.order.pk)
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['amount'], '60.00')
+        self.assert_refunded_remaining()
+
+    def test_web_cancel_refunds_amount_left_after_concurrent_fill(self):
+        session = self.client.session
+        session['telegram_id'] = self.seller.telegram_id
+        session.save()
+        with mock.patch.object(views, 'get_object_or_404', self.fill_after_read(views.get_object_or_404)):
+            response = self.client.post(
+                f'/p2p/orders/{self.order.pk}/cancel/', HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+
+        self.assertEqual(response.json()['new_status'], 'cancelled')
+        self.assert_refunded_remaining()
+
+    def test_cancel_is_not_repeated(self):
+        """Повторная отмена не возвращает средства второй раз"""
+        cancel_order(self.order.pk, self.seller.pk)
+        with self.assertRaisesMessage(FillError, 'Можно отменить только активный ордер'):
+            cancel_order(self.order.pk, self.seller.pk)
+        with self.assertRaisesMessage(FillError, 'Ордер не найден'):
+            cancel_order(self.order.pk, self.buyer.pk)
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.cf_balance, Decimal('1000'))
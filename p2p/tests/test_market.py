@@ -0,0 +1,162 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+import threading
+import time
+from unittest import mock
+
+from p2p import candles, market, orderbook, stats
+from p2p.models import Order, Transaction
+from users.models import User
+
+
+class MarketDataTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        stats.reset()
+        cache.clear()
+        self.user = User.objects.create(
+            telegram_id=111111111,
+            username='trader',
+            first_name='Trader',
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.other = User.objects.create(
+            telegram_id=222222222,
+            username='other',
+            first_name='Other',
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+        stats.reset()
+        cache.clear()
+
+    def create_order(self, order_type, price, amount, token_type='CF'):
+        return Order.objects.create(
+            user=self.user,
+            type=order_type,
+            token_type=token_type,
+            amount=Decimal(amount),
+            price_per_unit=Decimal(price),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+
+    def test_depth_aggregates_levels(self):
+        self.create_order('sell', '0.512', '10')
+        self.create_order('sell', '0.518', '5')
+        self.create_order('sell', '0.53', '7')
+        self.create_order('buy', '0.499', '3')
+        self.create_order('buy', '0.491', '4')
+        self.create_order('buy', '0.48', '1')
+
+        depth = market.build_depth('CF', precision=2)
+        self.assertEqual(depth['asks'], [
+            {'price': '0.52', 'amount': '15.00', 'orders': 2},
+            {'price': '0.53', 'amount': '7.00', 'orders': 1},
+        ])
+        self.assertEqual(depth['bids'], [
+            {'price': '0.49', 'amount': '7.00', 'orders': 2},
+            {'price': '0.48', 'amount': '1.00', 'orders': 1},
+        ])
+        self.assertEqual(len(market.get_depth('CF', precision=2, levels=1)['asks']), 1)
+
+    def test_ticker(self):
+        self.create_order('sell', '0.6', '10')
+        self.create_order('buy', '0.5', '10')
+        order = self.create_order('sell', '0.55', '10', token_type='TON')
+        deal = Transaction.objects.create(
+            order=order,
+            buyer=self.other,
+            seller=self.user,
+            amount=Decimal('4'),
+            price_per_unit=Decimal('0.55'),
+            token_type='TON',
+            commission=Decimal('0'),
+            status='completed'
+        )
+        candles.record_trades([deal])
+
+        tickers = {item['token']: item for item in market.build_ticker()['tickers']}
+        self.assertEqual(tickers['CF']['spread'], '0.10000000')
+        self.assertEqual(tickers['CF']['volume_24h'], '0.00')
+        self.assertIsNone(tickers['NOT']['best_bid'])
+        self.assertEqual(tickers['TON']['last_price'], '0.55000000')
+        self.assertEqual(tickers['TON']['volume_24h'], '4.00')
+        self.assertEqual(tickers['TON']['vwap_24h'], '0.55000000')
+        self.assertEqual(tickers['TON']['trades_24h'], 1)
+
+    def test_snapshot_is_cached(self):
+        order = self.create_order('sell', '0.5', '10')
+        self.assertEqual(len(market.get_depth('CF')['asks']), 1)
+        order.status = 'cancelled'
+        order.save()
+        orderbook.reset()
+        # До истечения TTL отдается прежний снимок
+        self.assertEqual(len(market.get_depth('CF')['asks']), 1)
+        self.assertEqual(len(market.build_depth('CF')['asks']), 0)
+
+    def test_concurrent_requests_rebuild_once(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'snapshot'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(market.cached('test:key', build)))
+            for _ in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['snapshot'] * 20)
+
+    def test_stale_snapshot_served_while_other_process_rebuilds(self):
+        market.cached('test:key', lambda: 'old', ttl=0)
+        # Метку перестроения держит другой процесс
+        cache.add('test:key:rebuild', 1)
+        self.assertEqual(market.cached('test:key', lambda: 'new'), 'old')
+        cache.delete('test:key:rebuild')
+        self.assertEqual(market.cached('test:key', lambda: 'new'), 'new')
+
+    def test_waiting_process_does_not_remove_foreign_lock(self):
+        # Метку держит другой процесс, снимка еще нет
+        cache.add('test:key:rebuild', 1)
+        threading.Timer(0.05, lambda: cache.set('test:key', (time.time() + 5, 'theirs'))).start()
+        self.assertEqual(market.cached('test:key', lambda: 'ours'), 'theirs')
+        self.assertEqual(cache.get('test:key:rebuild'), 1)
+
+        cache.delete('test:key')
+        with mock.patch.object(market, 'REBUILD_LOCK_SECONDS', 0.05):
+            # Владелец метки так и не построил снимок: строим сами, но метку не трогаем
+            self.assertEqual(market.cached('test:key', lambda: 'ours'), 'ours')
+        self.assertEqual(cache.get('test:key:rebuild'), 1)
+
+    def test_depth_reads_book_in_chunks(self):
+        """Глубина читает стакан порциями и останавливается на нужном числе уровней"""
+        for index in range(30):
+            self.create_order('sell', f'{index + 1}', '1')
+        book = orderbook.get_book('CF')
+        read = []
+        top = book.top
+
+        def counting_top(*args, **kwargs):
+            entries = top(*args, **kwargs)
+            read.extend(entries)
+            return entries
+
+        with mock.patch.object(book, 'top', counting_top):
+            asks = market.aggregate_levels(
+                market.side_entries(book, 'sell', chunk_size=4), Decimal('1'), market.ROUND_UP, limit=5
+            )
+        self.assertEqual([level['price'] for level in asks], ['1', '2', '3', '4', '5'])
+        self.assertEqual(len(read), 8)
@@ -0,0 +1,182 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from unittest import mock
+
+from p2p import orderbook
+from p2p.matching import match_order
+from p2p.models import Order, Transaction
+from p2p.settlement import lock_funds
+from users.models import LedgerEntry, User
+
+
+class MatchingEngineTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            cf_balance=Decimal('1000'),
+            ton_balance=Decimal('100'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def create_order(self, user, order_type, price, amount='10', **kwargs):
+        defaults = {
+            'user': user,
+            'type': order_type,
+            'token_type': 'CF',
+            'amount': Decimal(amount),
+            'price_per_unit': Decimal(price),
+            'min_amount': Decimal('1'),
+            'expires_at': timezone.now() + timezone.timedelta(days=3),
+        }
+        defaults.update(kwargs)
+        return Order.objects.create(**defaults)
+
+    def test_buy_order_fills_in_price_time_order(self):
+        """Покупка исполняется сначала по лучшей цене, затем по более ранним ордерам"""
+        worse = self.create_order(self.seller, 'sell', '2', amount='10')
+        best = self.create_order(self.seller, 'sell', '1', amount='5')
+        orderbook.get_book('CF')
+
+        taker = self.create_order(self.buyer, 'buy', '2', amount='8')
+        with self.captureOnCommitCallbacks(execute=True):
+            transactions = match_order(taker)
+
+        self.assertEqual([t.order_id for t in transactions], [best.id, worse.id])
+        self.assertEqual([t.amount for t in transactions], [Decimal('5'), Decimal('3')])
+        self.assertEqual(Transaction.objects.filter(status='completed').count(), 2)
+
+        taker.refresh_from_db()
+        best.refresh_from_db()
+        worse.refresh_from_db()
+        self.assertEqual(taker.status, 'completed')
+        self.assertEqual(best.status, 'completed')
+        self.assertEqual(worse.amount, Decimal('7'))
+        self.assertEqual(worse.status, 'active')
+
+        # 5 * 1 + 3 * 2 = 11 TON плюс 3% комиссии
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.ton_balance, Decimal('100') - Decimal('11.33'))
+        self.assertEqual(self.buyer.cf_balance, Decimal('1008'))
+        self.assertEqual(self.seller.ton_balance, Decimal('111'))
+
+        book = orderbook.get_book('CF')
+        self.assertNotIn(best.id, book)
+        self.assertNotIn(taker.id, book)
+        self.assertEqual(book.get(worse.id).amount, Decimal('7'))
+
+    def test_non_crossing_order_rests_in_book(self):
+        """Ордер без пересечения цен остается в стакане без сделок"""
+        self.create_order(self.seller, 'sell', '5')
+        orderbook.get_book('CF')
+
+        taker = self.create_order(self.buyer, 'buy', '4')
+        with self.captureOnCommitCallbacks(execute=True):
+            transactions = match_order(taker)
+
+        self.assertEqual(transactions, [])
+        self.assertIn(taker.id, orderbook.get_book('CF'))
+
+    def test_own_orders_are_not_matched(self):
+        """Ордер не сводится с ордерами того же пользователя"""
+        self.create_order(self.buyer, 'sell', '1')
+        orderbook.get_book('CF')
+
+        taker = self.create_order(self.buyer, 'buy', '2')
+        self.assertEqual(match_order(taker), [])
+
+    def test_sell_order_charges_resting_buyer(self):
+        """Продажа против ордера на покупку списывает оплату с владельца ордера"""
+        bid = self.create_order(self.buyer, 'buy', '2', amount='10')
+        orderbook.get_book('CF')
+
+        taker = self.create_order(self.seller, 'sell', '1', amount='4')
+        with self.captureOnCommitCallbacks(execute=True):
+            transactions = match_order(taker)
+
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0].buyer_id, self.buyer.pk)
+        self.assertEqual(transactions[0].price_per_unit, Decimal('2'))
+
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.ton_balance, Decimal('92'))
+        self.assertEqual(self.buyer.cf_balance, Decimal('1004'))
+        self.assertEqual(self.seller.ton_balance, Decimal('107.76'))
+        bid.refresh_from_db()
+        self.assertEqual(bid.amount, Decimal('6'))
+
+    def test_create_order_view_matches(self):
+        """Создание ордера через веб-интерфейс запускает сведение"""
+        ask = self.create_order(self.seller, 'sell', '1', amount='5')
+        orderbook.get_book('CF')
+
+        session = self.client.session
+        session['telegram_id'] = self.buyer.telegram_id
+        session.save()
+
+        response = self.client.post(
+            '/p2p/orders/create/',
+            {'type': 'buy', 'token_type': 'CF', 'amount': '5', 'price': '1', 'min_amount': '1'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = response.json()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(data['order_status'], 'completed')
+        self.assertEqual(len(data['matched_transactions']), 1)
+        ask.refresh_from_db()
+        self.assertEqual(ask.status, 'completed')
+
+    def post_order(self, user, data):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+        return self.client.post('/p2p/orders/create/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+
+    def test_create_sell_order_view_locks_funds(self):
+        """Ордер на продажу через веб-интерфейс блокирует точную сумму в Decimal"""
+        data = self.post_order(
+            self.seller, {'type': 'sell', 'token_type': 'CF', 'amount': '10.5', 'price': '0.3', 'min_amount': '1'}
+        )
+        self.assertEqual(data['status'], 'success', data)
+        self.assertEqual(Order.objects.get(pk=data['order_id']).status, 'active')
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.cf_balance, Decimal('989.5'))
+        self.assertEqual(
+            LedgerEntry.objects.get(user=self.seller, reason='p2p_lock').delta, Decimal('-10.5')
+        )
+
+    def test_create_order_view_rolls_back_on_error(self):
+        """Ошибка после сохранения ордера не оставляет активный ордер без блокировки"""
+        with mock.patch('p2p.views.match_order', side_effect=RuntimeError('boom')):
+            data = self.post_order(
+                self.seller, {'type': 'sell', 'token_type': 'CF', 'amount': '10', 'price': '1', 'min_amount': '1'}
+            )
+        self.assertEqual(data['status'], 'error')
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(LedgerEntry.objects.exists())
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.cf_balance, Decimal('1000'))
+
+    def test_lock_funds_checks_balance_in_update(self):
+        """Блокировка не уводит баланс в минус, даже если проверка в памяти устарела"""
+        order = self.create_order(self.seller, 'sell', '1', amount='600')
+        self.assertTrue(lock_funds(order))
+        self.assertFalse(lock_funds(order))
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.cf_balance, Decimal('400'))
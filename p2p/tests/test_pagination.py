@@ -0,0 +1,130 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from p2p import orderbook
+from p2p.models import Order, Transaction
+from p2p.pagination import (
+    InvalidCursor, KeysetPagination, decode_cursor, encode_cursor, paginate_keyset
+)
+from users.models import User
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('100'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        # Часть сделок создана в одну и ту же секунду: порядок решает id
+        moment = timezone.now().replace(microsecond=0)
+        self.deals = []
+        for index in range(7):
+            deal = Transaction.objects.create(
+                order=self.order,
+                buyer=self.buyer,
+                seller=self.seller,
+                amount=Decimal('1'),
+                price_per_unit=Decimal('0.5'),
+                token_type='CF',
+                commission=Decimal('0'),
+                status='completed'
+            )
+            created_at = moment + timezone.timedelta(seconds=index // 3)
+            Transaction.objects.filter(pk=deal.pk).update(created_at=created_at)
+            self.deals.append(deal.pk)
+        self.newest_first = list(reversed(self.deals))
+
+    def tearDown(self):
+        orderbook.reset()
+
+    def ids(self, page):
+        return [deal.pk for deal in page]
+
+    def test_forward_and_backward_traversal(self):
+        queryset = Transaction.objects.all()
+        first = paginate_keyset(queryset, page_size=3)
+        self.assertEqual(self.ids(first), self.newest_first[:3])
+        self.assertFalse(first.has_previous())
+
+        second = paginate_keyset(queryset, first.next_cursor, page_size=3)
+        third = paginate_keyset(queryset, second.next_cursor, page_size=3)
+        self.assertEqual(self.ids(second), self.newest_first[3:6])
+        self.assertEqual(self.ids(third), self.newest_first[6:])
+        self.assertFalse(third.has_next())
+
+        back = paginate_keyset(queryset, third.previous_cursor, page_size=3)
+        self.assertEqual(self.ids(back), self.newest_first[3:6])
+        back = paginate_keyset(queryset, back.previous_cursor, page_size=3)
+        self.assertEqual(self.ids(back), self.newest_first[:3])
+        self.assertFalse(back.has_previous())
+
+    def test_ascending_order(self):
+        page = paginate_keyset(Transaction.objects.all(), page_size=4, ascending=True)
+        self.assertEqual(self.ids(page), self.deals[:4])
+        page = paginate_keyset(Transaction.objects.all(), page.next_cursor, page_size=4, ascending=True)
+        self.assertEqual(self.ids(page), self.deals[4:])
+
+    def test_page_is_one_query_without_count(self):
+        cursor = paginate_keyset(Transaction.objects.all(), page_size=3).next_cursor
+        with self.assertNumQueries(1) as context:
+            paginate_keyset(Transaction.objects.all(), cursor, page_size=3)
+        self.assertNotIn('COUNT(', context.captured_queries[0]['sql'].upper())
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage!', 'eHx5fHo', encode_cursor(self.order).upper()):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+    def test_market_history_follows_cursor(self):
+        session = self.client.session
+        session['telegram_id'] = self.buyer.telegram_id
+        session.save()
+
+        response = self.client.get('/p2p/')
+        page = response.context['transactions']
+        self.assertEqual(self.ids(page), self.newest_first)
+        self.assertFalse(page.has_next())
+
+        # Поврежденный курсор не ломает страницу
+        response = self.client.get('/p2p/', {'cursor': 'garbage!'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_drf_pagination_links(self):
+        factory = APIRequestFactory()
+        paginator = KeysetPagination()
+        paginator.page_size = 5
+
+        request = Request(factory.get('/p2p/api/transactions/'))
+        rows = paginator.paginate_queryset(Transaction.objects.all(), request)
+        data = paginator.get_paginated_response([row.pk for row in rows]).data
+        self.assertEqual(data['results'], self.newest_first[:5])
+        self.assertIsNone(data['previous'])
+
+        cursor = data['next'].split('cursor=')[1]
+        request = Request(factory.get('/p2p/api/transactions/', {'cursor': cursor}))
+        rows = paginator.paginate_queryset(Transaction.objects.all(), request)
+        data = paginator.get_paginated_response([row.pk for row in rows]).data
+        self.assertEqual(data['results'], self.newest_first[5:])
+        self.assertIsNone(data['next'])
+        self.assertIsNotNone(data['previous'])
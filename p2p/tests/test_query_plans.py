@@ -0,0 +1,44 @@
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+from django.utils import timezone
+from unittest import skipUnless
+
+from p2p.models import Order, Transaction, Message
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Планы запросов проверяются на SQLite')
+class HotQueryPlanTest(TestCase):
+    """Горячие запросы биржи должны использовать индексы, а не сканировать таблицы"""
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, msg=f"План запроса не использует {index_name}:\n{plan}")
+
+    def test_order_book_side(self):
+        queryset = Order.objects.filter(
+            status='active', token_type='CF', type='sell', price_per_unit__lte=10
+        ).order_by('price_per_unit', 'created_at')
+        self.assertUsesIndex(queryset, 'p2p_order_book_idx')
+
+    def test_expired_orders(self):
+        queryset = Order.objects.filter(status='active', expires_at__lte=timezone.now()).order_by('expires_at')
+        self.assertUsesIndex(queryset, 'p2p_order_expiry_idx')
+
+    def test_my_orders(self):
+        queryset = Order.objects.filter(user_id=1, status='active').order_by('-created_at')
+        self.assertUsesIndex(queryset, 'p2p_order_user_idx')
+
+    def test_trade_history(self):
+        queryset = Transaction.objects.filter(Q(buyer_id=1) | Q(seller_id=1)).order_by('-created_at')
+        self.assertUsesIndex(queryset, 'p2p_tx_buyer_idx')
+        self.assertUsesIndex(queryset, 'p2p_tx_seller_idx')
+
+    def test_chat_messages(self):
+        queryset = Message.objects.filter(transaction_id=1).order_by('created_at')
+        self.assertUsesIndex(queryset, 'p2p_msg_chat_idx')
+
+    def test_unread_messages(self):
+        # Форма запроса отметки прочтения: сообщения собеседника без сортировки
+        queryset = Message.objects.filter(transaction_id=1, is_read=False, sender_id=2).order_by()
+        self.assertUsesIndex(queryset, 'p2p_msg_unread_idx')
@@ -0,0 +1,91 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from p2p.api.renderers import FastJSONRenderer
+from p2p.api.serializers import (
+    ORDER_LIST_FIELDS, TRANSACTION_LIST_FIELDS,
+    OrderListSerializer, OrderSerializer, TransactionListSerializer
+)
+from p2p.models import Order, Transaction
+from p2p.pagination import KeysetPagination
+from users.models import User
+
+
+class CompactSerializerTest(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(telegram_id=111111111, username='seller', first_name='Seller')
+        self.buyer = User.objects.create(telegram_id=222222222, username='buyer', first_name='Buyer')
+        self.order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('100'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            payment_details='Карта',
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+
+    def test_order_row_matches_full_serializer(self):
+        now = timezone.now()
+        row = Order.objects.values(*ORDER_LIST_FIELDS).get(pk=self.order.pk)
+        compact = OrderListSerializer(row, context={'now': now}).data
+        full = OrderSerializer(self.order).data
+
+        for field in ('id', 'type', 'token_type', 'amount', 'price_per_unit', 'min_amount',
+                      'payment_details', 'status', 'created_at', 'expires_at', 'is_expired', 'total_price'):
+            self.assertEqual(compact[field], full[field], field)
+        self.assertEqual((compact['user_id'], compact['username']), (self.seller.pk, 'seller'))
+        self.assertAlmostEqual(compact['expires_in'], full['expires_in'], delta=1)
+
+    def test_transaction_row_is_flat(self):
+        Transaction.objects.create(
+            order=self.order,
+            buyer=self.buyer,
+            seller=self.seller,
+            amount=Decimal('4'),
+            price_per_unit=Decimal('0.5'),
+            token_type='CF',
+            commission=Decimal('0.06'),
+            buyer_unread=2,
+        )
+        request = Request(APIRequestFactory().get('/p2p/api/transactions/'))
+        request.user = self.buyer
+        rows = Transaction.objects.values(*TRANSACTION_LIST_FIELDS)
+        data = TransactionListSerializer(rows, many=True, context={'request': request}).data[0]
+
+        self.assertEqual(data['buyer_username'], 'buyer')
+        self.assertEqual(data['order_type'], 'sell')
+        self.assertEqual(data['total_price'], '2.00')
+        self.assertEqual(data['commission'], '0.06000000')
+        self.assertEqual(data['unread_count'], 2)
+
+    def test_values_rows_paginate_with_cursor(self):
+        for _ in range(3):
+            Order.objects.create(
+                user=self.seller, type='buy', token_type='CF', amount=Decimal('1'),
+                price_per_unit=Decimal('0.4'), min_amount=Decimal('1'),
+                expires_at=timezone.now() + timezone.timedelta(days=3)
+            )
+        paginator = KeysetPagination()
+        paginator.page_size = 2
+        queryset = Order.objects.values(*ORDER_LIST_FIELDS)
+        request = Request(APIRequestFactory().get('/p2p/api/orders/my_orders/'))
+        first = paginator.paginate_queryset(queryset, request)
+
+        request = Request(APIRequestFactory().get('/p2p/api/orders/my_orders/', {'cursor': paginator.page.next_cursor}))
+        second = paginator.paginate_queryset(queryset, request)
+        self.assertEqual(len({row['id'] for row in first + second}), 4)
+
+    def test_fast_renderer_matches_standard_output(self):
+        data = {
+            'results': OrderSerializer([self.order], many=True).data,
+            'price': Decimal('0.5'),
+            'moment': self.order.created_at,
+            'text': 'строка\u2028перенос',
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
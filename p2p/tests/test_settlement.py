@@ -0,0 +1,148 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+
+from p2p import alerts
+from p2p.models import Order, Transaction
+from p2p.settlement import apply_balance_deltas, new_deltas, settle_transactions
+from users.models import LedgerEntry, User
+
+
+class SettlementTest(TestCase):
+    def setUp(self):
+        # Индекс оповещений загружается лениво; сбрасываем, чтобы число запросов не зависело от порядка тестов
+        alerts.reset()
+        self.users = [
+            User.objects.create(
+                telegram_id=100000000 + i,
+                username=f'user{i}',
+                first_name='User',
+                cf_balance=Decimal('1000'),
+                ton_balance=Decimal('100'),
+            )
+            for i in range(4)
+        ]
+        self.seller, self.buyer = self.users[0], self.users[1]
+
+    def create_deal(self, maker, taker, order_type, amount='10', price='2', status='paid'):
+        order = Order.objects.create(
+            user=maker,
+            type=order_type,
+            token_type='CF',
+            amount=Decimal('100'),
+            price_per_unit=Decimal(price),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        return Transaction.objects.create(
+            order=order,
+            buyer=taker if order_type == 'sell' else maker,
+            seller=maker if order_type == 'sell' else taker,
+            amount=Decimal(amount),
+            price_per_unit=Decimal(price),
+            token_type='CF',
+            commission=Decimal(amount) * Decimal(price) * Decimal('0.03'),
+            status=status
+        )
+
+    def test_settles_sell_order_deal(self):
+        """Покупатель платит цену и комиссию, продавец получает оплату"""
+        deal = self.create_deal(self.seller, self.buyer, 'sell')
+        settled = settle_transactions([deal])
+
+        self.assertEqual(len(settled), 1)
+        deal.refresh_from_db()
+        self.assertEqual(deal.status, 'completed')
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.cf_balance, Decimal('1010'))
+        self.assertEqual(self.buyer.ton_balance, Decimal('79.40'))
+        self.assertEqual(self.seller.ton_balance, Decimal('120'))
+        self.assertEqual(self.seller.cf_balance, Decimal('1000'))
+
+        # Движения по сделке записаны в журнал балансов
+        entries = LedgerEntry.objects.filter(ref=f'p2p.transaction:{deal.pk}', reason='p2p_trade')
+        self.assertEqual(
+            sorted((entry.user_id, entry.asset, entry.delta) for entry in entries),
+            sorted([
+                (self.buyer.pk, 'CF', Decimal('10')),
+                (self.buyer.pk, 'TON', Decimal('-20.6')),
+                (self.seller.pk, 'TON', Decimal('20')),
+            ])
+        )
+
+    def test_settles_buy_order_deal(self):
+        """Владелец ордера на покупку платит и получает токены, продавец получает оплату за вычетом комиссии"""
+        deal = self.create_deal(self.buyer, self.seller, 'buy')
+        settle_transactions([deal])
+
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.cf_balance, Decimal('1010'))
+        self.assertEqual(self.buyer.ton_balance, Decimal('80'))
+        self.assertEqual(self.seller.cf_balance, Decimal('990'))
+        self.assertEqual(self.seller.ton_balance, Decimal('119.40'))
+
+    def test_settled_deal_is_not_paid_twice(self):
+        """Повторный расчет уже завершенной сделки ничего не меняет"""
+        deal = self.create_deal(self.seller, self.buyer, 'sell')
+        settle_transactions([deal])
+        self.assertEqual(settle_transactions([deal]), [])
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.ton_balance, Decimal('120'))
+
+    def test_only_requested_statuses_are_settled(self):
+        deal = self.create_deal(self.seller, self.buyer, 'sell', status='pending')
+        self.assertEqual(settle_transactions([deal]), [])
+
+    def test_uncovered_deal_is_skipped(self):
+        """Сделка, которую баланс покупателя уже не покрывает, остается оплаченной"""
+        first = self.create_deal(self.seller, self.buyer, 'sell', amount='30', price='2')
+        second = self.create_deal(self.seller, self.buyer, 'sell', amount='30', price='2')
+        # Каждая сделка стоит 61.8 TON, на балансе покупателя 100 TON
+        settled = settle_transactions([first, second])
+
+        self.assertEqual(settled, [first])
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'paid')
+        self.buyer.refresh_from_db()
+        self.assertEqual(self.buyer.ton_balance, Decimal('38.20'))
+        self.assertFalse(LedgerEntry.objects.filter(ref=f'p2p.transaction:{second.pk}').exists())
+
+        # После пополнения сделка рассчитывается
+        User.objects.filter(pk=self.buyer.pk).update(ton_balance=Decimal('100'))
+        self.assertEqual(settle_transactions([second]), [second])
+
+    def test_batch_cost_does_not_grow_with_deals(self):
+        """Пачка сделок рассчитывается фиксированным числом запросов"""
+        deals = []
+        for maker in self.users:
+            for taker in self.users:
+                if maker != taker:
+                    deals.append(self.create_deal(maker, taker, 'sell', amount='1', price='1'))
+
+        # SAVEPOINT, SELECT сделок, SELECT балансов, UPDATE балансов, INSERT в журнал,
+        # UPDATE статусов, SELECT оповещений, RELEASE и по 4 запроса на новую свечу
+        # каждого из 3 интервалов (UPDATE, SAVEPOINT, INSERT, RELEASE)
+        with self.assertNumQueries(20):
+            settled = settle_transactions(deals)
+        self.assertEqual(len(settled), len(deals))
+
+        # Каждый продал 3 раза и купил 3 раза по 1 CF за 1 TON
+        for user in User.objects.all():
+            self.assertEqual(user.cf_balance, Decimal('1003'))
+            self.assertEqual(user.ton_balance, Decimal('100') - Decimal('0.09'))
+
+    def test_apply_balance_deltas(self):
+        deltas = new_deltas()
+        deltas[self.buyer.pk]['cf_balance'] += Decimal('5')
+        deltas[self.seller.pk]['ton_balance'] -= Decimal('0.5')
+        with self.assertNumQueries(1):
+            apply_balance_deltas(deltas)
+
+        self.buyer.refresh_from_db()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.buyer.cf_balance, Decimal('1005'))
+        self.assertEqual(self.buyer.ton_balance, Decimal('100'))
+        self.assertEqual(self.seller.ton_balance, Decimal('99.5'))
@@ -0,0 +1,91 @@
+from django.test import TestCase
+from django.utils import timezone
+from decimal import Decimal
+
+from p2p import orderbook, stats
+from p2p.candles import bucket_start
+from p2p.matching import fill_order
+from p2p.models import Order, PriceCandle
+from users.models import User
+
+
+class RollingStatsTest(TestCase):
+    def setUp(self):
+        orderbook.reset()
+        stats.reset()
+        self.seller = User.objects.create(
+            telegram_id=111111111,
+            username='seller',
+            first_name='Seller',
+            cf_balance=Decimal('1000'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+        self.buyer = User.objects.create(
+            telegram_id=222222222,
+            username='buyer',
+            first_name='Buyer',
+            ton_balance=Decimal('1000'),
+            staking_until=timezone.now() + timezone.timedelta(days=10)
+        )
+
+    def tearDown(self):
+        orderbook.reset()
+        stats.reset()
+
+    def trade(self, price, amount):
+        order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal(amount),
+            price_per_unit=Decimal(price),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            return fill_order(order.pk, self.buyer, amount)
+
+    def test_window_sums_and_expiry(self):
+        window = stats.RollingWindow()
+        start = bucket_start(timezone.now(), '1m')
+        window.set(start, Decimal('10'), Decimal('5'), 2)
+        window.set(start + timezone.timedelta(minutes=1), Decimal('30'), Decimal('18'), 1)
+        # Повторная установка корзины заменяет ее значения, а не складывает
+        window.set(start, Decimal('10'), Decimal('5'), 2)
+
+        summary = window.summary()
+        self.assertEqual(summary['volume_24h'], Decimal('40.00'))
+        self.assertEqual(summary['vwap_24h'], Decimal('0.57500000'))
+        self.assertEqual(summary['trades_24h'], 3)
+
+        window.expire(start + timezone.timedelta(minutes=1))
+        self.assertEqual(window.summary()['trades_24h'], 1)
+        self.assertEqual(window.summary()['vwap_24h'], Decimal('0.60000000'))
+
+    def test_trades_update_stats(self):
+        self.assertEqual(stats.get_stats('CF')['trades_24h'], 0)
+        self.trade('0.5', '10')
+        self.trade('0.6', '30')
+
+        summary = stats.get_stats('CF')
+        self.assertEqual(summary['volume_24h'], Decimal('40.00'))
+        self.assertEqual(summary['vwap_24h'], Decimal('0.57500000'))
+        self.assertEqual(summary['trades_24h'], 2)
+        self.assertIsNone(stats.get_stats('TON')['vwap_24h'])
+
+    def test_reads_between_syncs_do_not_query(self):
+        self.trade('0.5', '10')
+        stats.get_stats('CF')
+        with self.assertNumQueries(0):
+            stats.get_stats('CF')
+            stats.get_stats('TON')
+
+    def test_old_buckets_leave_window(self):
+        now = timezone.now()
+        PriceCandle.objects.create(
+            token_type='CF', interval='1m', bucket=bucket_start(now - timezone.timedelta(hours=23, minutes=59), '1m'),
+            open=Decimal('1'), high=Decimal('1'), low=Decimal('1'), close=Decimal('1'),
+            volume=Decimal('5'), quote_volume=Decimal('5'), trades=1,
+        )
+        self.assertEqual(stats.get_stats('CF', now=now)['trades_24h'], 1)
+        self.assertEqual(stats.get_stats('CF', now=now + timezone.timedelta(minutes=2))['trades_24h'], 0)
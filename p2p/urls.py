@@ -16,6 +16,8 @@ urlpatterns = [
     path('transactions/<int:transaction_id>/confirm-payment/', views.toggle_order, name='confirm_payment'),  # Использует похожую функцию
     path('transactions/<int:transaction_id>/confirm-receipt/', views.toggle_order, name='confirm_receipt'),  # Использует похожую функцию
     path('transactions/<int:deal_id>/message/', views.send_message, name='send_message'),
+    path('transactions/<int:deal_id>/events/', views.deal_events, name='deal_events'),
+    path('candles/', views.price_candles, name='candles'),
     
     # API
     path('api/', include('p2p.api.urls')),
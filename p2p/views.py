@@ -1,15 +1,20 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
 from .models import Order, Transaction, Message
+from . import candles, chat, orderbook, stats
+from .matching import FillError, cancel_order, fill_order, match_order
+from .pagination import InvalidCursor, paginate_keyset
+from .settlement import lock_funds
+from users import ledger
+from users.idempotency import idempotent
 from django.utils import timezone
 from django.conf import settings
 from django.db import transaction
 from django.db import models
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.urls import reverse
-import datetime
 import json
+from decimal import Decimal
 
 def p2p_market(request):
     """Страница P2P-биржи"""
@@ -24,17 +29,17 @@ def p2p_market(request):
     # Нормализуем crypto
     crypto = crypto.upper()
     
-    # Получаем активные ордера для выбранной криптовалюты
+    # Получаем лучшие ордера из стакана: истекшие отсекаются самим стаканом,
+    # а из базы загружается только одна страница
+    page_size = settings.GAME_SETTINGS.get('P2P_MARKET_PAGE_SIZE', 50)
+    book = orderbook.get_book(crypto)
     if action == 'buy':
         # Если пользователь хочет купить, показываем ордера на продажу
-        orders = Order.objects.filter(type='sell', status='active', token_type=crypto)
-        # Исключаем истекшие ордера
-        orders = [order for order in orders if not order.is_expired()]
+        entries = book.top('sell', limit=page_size)
     else:
         # Если пользователь хочет продать, показываем ордера на покупку
-        orders = Order.objects.filter(type='buy', status='active', token_type=crypto)
-        # Исключаем истекшие ордера
-        orders = [order for order in orders if not order.is_expired()]
+        entries = book.top('buy', limit=page_size)
+    orders = orderbook.load_orders(entries)
     
     # Получаем активные транзакции пользователя
     active_deals = Transaction.objects.filter(
@@ -44,46 +49,31 @@ def p2p_market(request):
     # Подготавливаем данные о сделках
     my_deals = []
     for deal in active_deals:
-        is_buyer = (deal.buyer == request.user)
+        is_buyer = (deal.buyer_id == request.user.pk)
         my_deals.append({
             'id': deal.id,
             'order': deal.order,
             'amount': deal.amount,
             'total_price': deal.amount * deal.price_per_unit,
             'is_buyer': is_buyer,
+            'unread': deal.unread_for(request.user),
             'created_at': deal.created_at
         })
     
     # Получаем историю транзакций пользователя
     transactions = Transaction.objects.filter(
         models.Q(buyer=request.user) | models.Q(seller=request.user)
-    ).select_related('order').order_by('-created_at')
-    
-    # Пагинация для истории транзакций
-    paginator = Paginator(transactions, 10)  # 10 транзакций на страницу
-    page = request.GET.get('page')
+    ).select_related('order')
     
+    # Курсорная пагинация истории: без COUNT(*) и OFFSET
     try:
-        transactions = paginator.page(page)
-    except PageNotAnInteger:
-        # Если page не является целым числом, выдаем первую страницу
-        transactions = paginator.page(1)
-    except EmptyPage:
-        # Если page больше, чем общее количество страниц, выдаем последнюю
-        transactions = paginator.page(paginator.num_pages)
-    
-    # Генерируем данные для графика цены CF (для демонстрации)
-    chart_labels = []
-    chart_values = []
-    
-    # Получаем последние 7 дней
-    today = datetime.date.today()
-    for i in range(7, 0, -1):
-        day = today - datetime.timedelta(days=i-1)
-        chart_labels.append(day.strftime('%d.%m'))
-        # Простая модель: базовая цена + день (ежедневный рост на 1 CF)
-        base_price = 100  # Базовая цена CF
-        chart_values.append(base_price + i)
+        transactions = paginate_keyset(transactions, request.GET.get('cursor'), page_size=10)
+    except InvalidCursor:
+        # Поврежденный курсор — показываем первую страницу
+        transactions = paginate_keyset(transactions, page_size=10)
+    
+    # График цены строится по готовым дневным свечам
+    chart_labels, chart_values = candles.daily_chart(crypto)
     
     chart_data = {
         'labels': json.dumps(chart_labels),
@@ -97,9 +87,12 @@ def p2p_market(request):
         'my_deals': my_deals,
         'transactions': transactions,
         'user': request.user,
-        'chart_data': chart_data
+        'chart_data': chart_data,
+        # Объем, VWAP и число сделок за 24 часа — из скользящего окна, без агрегации сделок
+        'market_stats': stats.get_stats(crypto)
     })
 
+@idempotent
 def create_order(request):
     """Создание нового ордера"""
     if request.method != 'POST':
@@ -122,10 +115,13 @@ def create_order(request):
         return JsonResponse({'status': 'error', 'message': 'Все поля обязательны'})
     
     try:
-        amount = float(amount)
-        price_per_unit = float(price_per_unit)
-        min_amount = float(min_amount)
-    except ValueError:
+        amount = Decimal(amount)
+        price_per_unit = Decimal(price_per_unit)
+        min_amount = Decimal(str(min_amount))
+    except ArithmeticError:
+        return JsonResponse({'status': 'error', 'message': 'Некорректный формат чисел'})
+    
+    if not all(value.is_finite() for value in (amount, price_per_unit, min_amount)):
         return JsonResponse({'status': 'error', 'message': 'Некорректный формат чисел'})
     
     if amount <= 0 or price_per_unit <= 0 or min_amount <= 0:
@@ -138,23 +134,26 @@ def create_order(request):
             return JsonResponse({'status': 'error', 'message': f'Недостаточно {token_type} на балансе'})
     
     try:
-        # Создаем ордер
-        order = Order(
-            user=request.user,
-            type=order_type,
-            token_type=token_type,
-            amount=amount,
-            price_per_unit=price_per_unit,
-            min_amount=min_amount,
-            payment_details=payment_details
-        )
-        order.save()  # Дата истечения будет установлена автоматически
-        
-        # Если это ордер на продажу, блокируем средства
-        if order_type == 'sell':
-            balance_field = f"{token_type.lower()}_balance"
-            setattr(request.user, balance_field, getattr(request.user, balance_field) - amount)
-            request.user.save()
+        # Ордер, блокировка средств и сведение со стаканом фиксируются вместе:
+        # при любой ошибке не остается активного ордера без заблокированных средств
+        with transaction.atomic():
+            order = Order(
+                user=request.user,
+                type=order_type,
+                token_type=token_type,
+                amount=amount,
+                price_per_unit=price_per_unit,
+                min_amount=min_amount,
+                payment_details=payment_details
+            )
+            order.save()  # Дата истечения будет установлена автоматически
+            
+            # Если это ордер на продажу, блокируем средства, только если их все еще хватает
+            if not lock_funds(order):
+                raise FillError(f'Недостаточно {token_type} на балансе')
+            
+            # Сводим ордер со встречными ордерами стакана (и добавляем остаток в стакан)
+            matched = match_order(order)
             
         # Проверяем, является ли запрос AJAX
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -162,13 +161,17 @@ def create_order(request):
                 'status': 'success',
                 'message': 'Ордер успешно создан',
                 'order_id': order.id,
+                'order_status': order.status,
+                'matched_transactions': [t.id for t in matched],
                 'redirect_url': None  # Не перенаправляем при AJAX-запросе
             })
         else:
             # Для обычного запроса устанавливаем сообщение и перенаправляем
             messages.success(request, 'Ордер успешно создан')
             return redirect('p2p_market')
-            
+    
+    except FillError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)})
     except Exception as e:
         # Логируем ошибку
         print(f"Error creating order: {str(e)}")
@@ -177,9 +180,10 @@ def create_order(request):
             'message': f'Произошла ошибка при создании ордера: {str(e)}'
         })
 
+@idempotent
 @transaction.atomic
 def buy_order(request, order_id):
-    """Покупка по существующему ордеру"""
+    """Покупка по существующему ордеру (целиком или частично)"""
     if request.method != 'POST':
         return JsonResponse({'status': 'error', 'message': 'Требуется метод POST'})
     
@@ -188,92 +192,8 @@ def buy_order(request, order_id):
         return JsonResponse({'status': 'error', 'message': 'Доступ к бирже закрыт'})
     
     try:
-        # Получаем ордер
-        order = get_object_or_404(Order, id=order_id, status='active')
-        
-        # Нельзя купить свой ордер
-        if order.user == request.user:
-            return JsonResponse({'status': 'error', 'message': 'Нельзя купить свой ордер'})
-        
-        # Проверяем, что ордер активен и не истек
-        if order.is_expired():
-            order.mark_as_expired()
-            return JsonResponse({'status': 'error', 'message': 'Ордер истек'})
-        
-        # Проверяем, достаточно ли средств у покупателя
-        total_cost = order.amount * order.price_per_unit
-        
-        if order.type == 'sell':  # Покупаем токены
-            # Проверяем, достаточно ли TON/NOT для покупки CF
-            if order.token_type == 'CF':
-                payment_token = 'TON'  # Предполагаем, что CF покупается за TON
-                if request.user.ton_balance < total_cost:
-                    return JsonResponse({'status': 'error', 'message': 'Недостаточно TON для покупки'})
-            else:
-                payment_token = 'CF'  # TON и NOT покупаются за CF
-                if request.user.cf_balance < total_cost:
-                    return JsonResponse({'status': 'error', 'message': 'Недостаточно CF для покупки'})
-        else:  # Продаем токены (покупаем ордер на покупку)
-            # Проверяем, достаточно ли токенов для продажи
-            token_balance = getattr(request.user, f"{order.token_type.lower()}_balance")
-            if token_balance < order.amount:
-                return JsonResponse({'status': 'error', 'message': f'Недостаточно {order.token_type} для продажи'})
-            
-            payment_token = 'TON' if order.token_type == 'CF' else 'CF'
-        
-        # Рассчитываем комиссию
-        commission_rate = settings.GAME_SETTINGS.get('P2P_COMMISSION', 0.03)
-        commission = total_cost * commission_rate
-        
-        # Выполняем транзакцию
-        if order.type == 'sell':  # Покупаем токены
-            # Списываем средства у покупателя
-            if payment_token == 'TON':
-                request.user.ton_balance -= (total_cost + commission)
-            else:
-                request.user.cf_balance -= (total_cost + commission)
-                
-            # Начисляем токены покупателю
-            setattr(request.user, f"{order.token_type.lower()}_balance", 
-                    getattr(request.user, f"{order.token_type.lower()}_balance") + order.amount)
-            
-            # Начисляем средства продавцу
-            if payment_token == 'TON':
-                order.user.ton_balance += total_cost
-            else:
-                order.user.cf_balance += total_cost
-        else:  # Продаем токены
-            # Списываем токены у продавца
-            setattr(request.user, f"{order.token_type.lower()}_balance", 
-                    getattr(request.user, f"{order.token_type.lower()}_balance") - order.amount)
-            
-            # Начисляем средства продавцу
-            if payment_token == 'TON':
-                request.user.ton_balance += (total_cost - commission)
-            else:
-                request.user.cf_balance += (total_cost - commission)
-                
-            # Начисляем токены покупателю
-            setattr(order.user, f"{order.token_type.lower()}_balance", 
-                    getattr(order.user, f"{order.token_type.lower()}_balance") + order.amount)
-        
-        # Сохраняем изменения
-        request.user.save()
-        order.user.save()
-        
-        # Создаем запись о транзакции
-        transaction = Transaction.objects.create(
-            order=order,
-            buyer=request.user if order.type == 'sell' else order.user,
-            seller=order.user if order.type == 'sell' else request.user,
-            amount=order.amount,
-            price_per_unit=order.price_per_unit,
-            token_type=order.token_type,
-            commission=commission
-        )
-        
-        # Отмечаем ордер как завершенный
-        order.mark_as_completed()
+        # Исполняем ордер на указанное количество (по умолчанию — весь остаток)
+        transaction = fill_order(order_id, request.user, request.POST.get('amount'))
         
         # Проверяем, является ли запрос AJAX
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -281,13 +201,17 @@ def buy_order(request, order_id):
                 'status': 'success',
                 'message': 'Сделка успешно завершена',
                 'transaction_id': transaction.id,
-                'redirect_url': reverse('deal_detail', args=[transaction.id])
+                'order_status': transaction.order.status,
+                'order_remaining': str(transaction.order.amount),
+                'redirect_url': reverse('p2p:transaction_detail', args=[transaction.id])
             })
         else:
             # Для обычного запроса устанавливаем сообщение и перенаправляем
             messages.success(request, 'Сделка успешно завершена')
-            return redirect('deal_detail', deal_id=transaction.id)
-            
+            return redirect('p2p:transaction_detail', deal_id=transaction.id)
+    
+    except FillError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)})
     except Exception as e:
         # Логируем ошибку
         print(f"Error completing order: {str(e)}")
@@ -309,12 +233,12 @@ def order_detail(request, order_id):
         'user': request.user
     })
 
-def toggle_order(request):
+def toggle_order(request, order_id=None):
     """Активация/деактивация ордера"""
     if request.method != 'POST':
         return JsonResponse({'status': 'error', 'message': 'Требуется метод POST'})
     
-    order_id = request.POST.get('order_id')
+    order_id = order_id or request.POST.get('order_id')
     if not order_id:
         return JsonResponse({'status': 'error', 'message': 'ID ордера не указан'})
     
@@ -323,13 +247,8 @@ def toggle_order(request):
         
         # Меняем статус
         if order.status == 'active':
-            order.status = 'cancelled'
-            
-            # Возвращаем средства, если это ордер на продажу
-            if order.type == 'sell':
-                balance_field = f"{order.token_type.lower()}_balance"
-                setattr(request.user, balance_field, getattr(request.user, balance_field) + order.amount)
-                request.user.save()
+            # Отмена и возврат неисполненного остатка выполняются атомарно
+            order = cancel_order(order.pk, request.user.pk)
         else:
             # Проверяем баланс для ордера продажи при активации
             if order.type == 'sell':
@@ -340,13 +259,14 @@ def toggle_order(request):
                 # Блокируем средства снова
                 setattr(request.user, balance_field, getattr(request.user, balance_field) - order.amount)
                 request.user.save()
+                ledger.record(request.user.pk, order.token_type, -order.amount, 'p2p_lock', order)
             
             order.status = 'active'
             # Обновляем дату истечения
             days = settings.GAME_SETTINGS.get('ORDER_EXPIRY', 3)
             order.expires_at = timezone.now() + timezone.timedelta(days=days)
-        
-        order.save()
+            order.save()
+            orderbook.sync_order(order)
         
         # Формируем сообщение в зависимости от нового статуса
         message = 'Ордер отменен' if order.status == 'cancelled' else 'Ордер активирован'
@@ -386,18 +306,45 @@ def deal_detail(request, deal_id):
     chat_messages = deal.messages.all()
     
     # Отмечаем сообщения как прочитанные
-    unread_messages = chat_messages.filter(is_read=False).exclude(sender=request.user)
-    for msg in unread_messages:
-        msg.is_read = True
-        msg.save()
+    chat.mark_read(deal.id, request.user.pk)
     
+    chat_messages = list(chat_messages)
     return render(request, 'p2p/deal_detail.html', {
         'deal': deal,
         'is_buyer': is_buyer,
         'user': request.user,
-        'chat_messages': chat_messages
+        'chat_messages': chat_messages,
+        'last_message_id': chat_messages[-1].id if chat_messages else 0
     })
 
+async def deal_events(request, deal_id):
+    """
+    Поток обновлений чата сделки (Server-Sent Events): новые сообщения
+    и отметки о прочтении. Продолжает с ``Last-Event-ID`` или ``?after=``.
+    """
+    deal = await Transaction.objects.filter(id=deal_id).values('buyer_id', 'seller_id').afirst()
+    if deal is None:
+        raise Http404('Сделка не найдена')
+    
+    # Проверяем, является ли пользователь участником сделки
+    if request.user.pk not in (deal['buyer_id'], deal['seller_id']):
+        return JsonResponse({'status': 'error', 'message': 'У вас нет доступа к этой сделке'}, status=403)
+    
+    last_id = request.headers.get('Last-Event-ID') or request.GET.get('after') or 0
+    try:
+        last_id = int(last_id)
+    except ValueError:
+        last_id = 0
+    
+    response = StreamingHttpResponse(
+        chat.event_stream(deal_id, request.user.pk, last_id),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Отключаем буферизацию ответа в nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def send_message(request, deal_id):
     """Отправка сообщения в чате сделки"""
     if request.method != 'POST':
@@ -415,11 +362,13 @@ def send_message(request, deal_id):
     
     try:
         # Создаем сообщение
-        message = Message.objects.create(
-            transaction=deal,
-            sender=request.user,
-            content=content
-        )
+        with transaction.atomic():
+            message = Message.objects.create(
+                transaction=deal,
+                sender=request.user,
+                content=content
+            )
+            chat.count_message(deal, request.user.pk)
         
         # Проверяем, является ли запрос AJAX
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -444,3 +393,36 @@ def send_message(request, deal_id):
             'status': 'error',
             'message': f'Произошла ошибка при отправке сообщения: {str(e)}'
         })
+
+
+def price_candles(request):
+    """Свечи OHLCV токена в формате JSON"""
+    token_type = request.GET.get('token', 'CF').upper()
+    interval = request.GET.get('interval', '1h')
+    if token_type not in dict(Order.TOKEN_CHOICES):
+        return JsonResponse({'status': 'error', 'message': 'Неизвестный токен'}, status=400)
+    if interval not in candles.INTERVALS:
+        return JsonResponse({'status': 'error', 'message': 'Неизвестный интервал'}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Некорректный лимит'}, status=400)
+    
+    return JsonResponse({
+        'status': 'success',
+        'token': token_type,
+        'interval': interval,
+        'candles': [
+            {
+                'time': candle.bucket.isoformat(),
+                'open': float(candle.open),
+                'high': float(candle.high),
+                'low': float(candle.low),
+                'close': float(candle.close),
+                'volume': float(candle.volume),
+                'quote_volume': float(candle.quote_volume),
+                'trades': candle.trades,
+            }
+            for candle in candles.get_candles(token_type, interval, limit)
+        ]
+    })
@@ -4,8 +4,10 @@ from django.utils import timezone
 from django.urls import reverse
 from django.db.models import Sum, Count, F, Q
 from datetime import timedelta
+from decimal import Decimal
 
 from .models import Referral
+from users import ledger
 
 
 @admin.register(Referral)
@@ -218,13 +220,15 @@ class ReferralAdmin(admin.ModelAdmin):
         amount = request.POST.get('amount')
         
         if 'apply' in request.POST and amount:
-            amount = float(amount)
+            amount = Decimal(amount)
             count = 0
+            entries = []
             
             for referral in queryset:
                 inviter = referral.inviter
                 inviter.cf_balance += amount
                 inviter.save()
+                entries.append(ledger.entry(inviter.pk, 'CF', amount, 'admin', referral))
                 
                 # Обновляем информацию о бонусе
                 if referral.bonus_cf:
@@ -235,6 +239,7 @@ class ReferralAdmin(admin.ModelAdmin):
                 
                 count += 1
             
+            ledger.write(entries)
             self.message_user(request, f'Успешно выдано {amount} CF {count} приглашающим пользователям.')
     
     give_bonus_to_inviters.short_description = "Выдать бонус приглашающим"
@@ -2,6 +2,8 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse
 from django.contrib import messages
 from .models import ShopItem, Purchase
+from users import ledger
+from users.idempotency import idempotent
 from django.utils import timezone
 
 def shop(request):
@@ -14,6 +16,7 @@ def shop(request):
         'user': request.user
     })
 
+@idempotent
 def buy_item(request, item_id):
     """Покупка товара"""
     if request.method != 'POST':
@@ -40,6 +43,7 @@ def buy_item(request, item_id):
         user.not_balance -= item.price
     
     user.save()
+    ledger.record(user.pk, item.price_token_type, -item.price, 'shop', item)
     
     # Обрабатываем покупку в зависимости от типа товара
     valid_until = None
@@ -55,8 +59,7 @@ def buy_item(request, item_id):
         from trees.models import Tree
         try:
             tree = Tree.objects.get(user=user, type='CF')
-            tree.fertilized_until = timezone.now() + timezone.timedelta(hours=item.duration)
-            tree.save()
+            tree.fertilize(hours=item.duration)
         except Tree.DoesNotExist:
             pass
     
@@ -90,6 +93,7 @@ def buy_item(request, item_id):
         'new_balance': getattr(user, f"{item.price_token_type.lower()}_balance")
     })
 
+@idempotent
 def buy_autowater(request, tree_id):
     """Покупка автополива для конкретного дерева"""
     from trees.models import Tree
@@ -135,9 +139,10 @@ def buy_autowater(request, tree_id):
     
     # Устанавливаем автополив для конкретного дерева
     valid_until = timezone.now() + timezone.timedelta(hours=item.duration)
+    tree.settle(auto_water_until=valid_until)
     tree.auto_water_until = valid_until
-    tree.save()
     user.save()
+    ledger.record(user.pk, item.price_token_type, -item.price, 'shop', item)
     
     # Записываем покупку
     purchase = Purchase.objects.create(
@@ -153,6 +158,7 @@ def buy_autowater(request, tree_id):
         'new_balance': getattr(user, f"{item.price_token_type.lower()}_balance")
     })
 
+@idempotent
 def buy_tree(request, tree_type):
     """Покупка дерева определенного типа"""
     if request.method != 'POST':
@@ -217,6 +223,7 @@ def buy_tree(request, tree_type):
             user.not_balance -= item.price
         
         user.save()
+        ledger.record(user.pk, item.price_token_type, -item.price, 'shop', item)
         
         # Создаем дерево
         Tree.objects.create(user=user, type=tree_type.upper())
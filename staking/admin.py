@@ -6,6 +6,7 @@ from django.db.models import Sum, Count, F, Q
 from datetime import timedelta
 
 from .models import Staking
+from users import ledger
 
 
 @admin.register(Staking)
@@ -141,6 +142,7 @@ class StakingAdmin(admin.ModelAdmin):
         """Завершение стейкинга"""
         active_stakings = queryset.filter(status='active')
         count = active_stakings.count()
+        entries = []
         
         for staking in active_stakings:
             # Определяем награду (если не установлена)
@@ -166,7 +168,11 @@ class StakingAdmin(admin.ModelAdmin):
             # Сохраняем изменения
             user.save()
             staking.save()
+            entries.append(ledger.entry(
+                user.pk, staking.token_type, staking.amount + staking.reward_amount, 'staking_reward', staking
+            ))
         
+        ledger.write(entries)
         self.message_user(request, f'Успешно завершено {count} стейкингов. Средства возвращены пользователям.')
     
     complete_staking.short_description = "Завершить стейкинг и выплатить награду"
@@ -175,6 +181,7 @@ class StakingAdmin(admin.ModelAdmin):
         """Отмена стейкинга"""
         active_stakings = queryset.filter(status='active')
         count = active_stakings.count()
+        entries = []
         
         for staking in active_stakings:
             # Возвращаем только вложенные средства без награды
@@ -193,6 +200,9 @@ class StakingAdmin(admin.ModelAdmin):
             # Сохраняем изменения
             user.save()
             staking.save()
+            entries.append(ledger.entry(user.pk, staking.token_type, staking.amount, 'staking_refund', staking))
+        
+        ledger.write(entries)
         
         self.message_user(request, f'Успешно отменено {count} стейкингов. Средства возвращены пользователям без награды.')
     
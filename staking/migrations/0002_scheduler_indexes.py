@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staking', '0001_initial'),
+        ('users', '0005_scheduler_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='staking',
+            index=models.Index(condition=models.Q(('status', 'active')), fields=['end_date'], name='staking_active_end_idx'),
+        ),
+    ]
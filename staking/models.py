@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils import timezone
-from django.conf import settings
+
+from users.rules import get_rules
 
 class Staking(models.Model):
     """Модель стейкинга токенов"""
@@ -23,6 +24,10 @@ class Staking(models.Model):
         verbose_name = 'Стейкинг'
         verbose_name_plural = 'Стейкинги'
         ordering = ['-start_date']
+        indexes = [
+            # Планировщик сроков: ближайшие окончания активных стейкингов
+            models.Index(fields=['end_date'], condition=models.Q(status='active'), name='staking_active_end_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user} - {self.amount} {self.token_type} ({self.get_status_display()})"
@@ -30,12 +35,11 @@ class Staking(models.Model):
     def save(self, *args, **kwargs):
         # Если это новый стейкинг, рассчитываем дату окончания и награду
         if not self.pk and not self.end_date:
-            staking_days = settings.GAME_SETTINGS.get('STAKING_DURATION', 7)
-            self.end_date = timezone.now() + timezone.timedelta(days=staking_days)
+            rules = get_rules()
+            self.end_date = timezone.now() + rules.staking_duration
             
             # Рассчитываем награду
-            staking_bonus = settings.GAME_SETTINGS.get('STAKING_BONUS', 0.1)
-            self.reward_amount = self.amount * staking_bonus
+            self.reward_amount = self.amount * rules.staking_bonus
             
         super().save(*args, **kwargs)
     
@@ -59,10 +63,12 @@ class Staking(models.Model):
             self.save()
             
             # Обновляем баланс пользователя
+            from users import ledger
             user = self.user
             if self.token_type == 'CF':
                 user.cf_balance += (self.amount + self.reward_amount)
                 user.save()
+                ledger.record(user.pk, self.token_type, self.amount + self.reward_amount, 'staking_reward', self)
             
             return True
         return False
@@ -2,8 +2,10 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse
 from django.contrib import messages
 from .models import Staking
+from users import ledger
+from users.idempotency import idempotent
 from django.utils import timezone
-from django.conf import settings
+from users.rules import get_rules
 
 def staking(request):
     """Страница стейкинга"""
@@ -12,7 +14,7 @@ def staking(request):
     
     if not can_access:
         return render(request, 'staking/locked.html', {
-            'min_cf': settings.GAME_SETTINGS.get('MIN_CF_FOR_STAKING', 300)
+            'min_cf': get_rules().min_cf_for_staking
         })
     
     # Получаем активные стейкинги пользователя
@@ -29,9 +31,10 @@ def staking(request):
         'completed_stakings': completed_stakings,
         'staking_history': staking_history,
         'user': request.user,
-        'staking_bonus': settings.GAME_SETTINGS.get('STAKING_BONUS', 0.1) * 100  # Для отображения в процентах
+        'staking_bonus': get_rules().staking_bonus * 100  # Для отображения в процентах
     })
 
+@idempotent
 def create_staking(request):
     """Создание нового стейкинга"""
     if request.method != 'POST':
@@ -69,6 +72,8 @@ def create_staking(request):
         token_type=token_type
     )
     staking.save()  # Дата окончания и награда будут рассчитаны автоматически
+    if token_type == 'CF':
+        ledger.record(request.user.pk, token_type, -amount, 'staking', staking)
     
     return JsonResponse({
         'status': 'success',
@@ -92,17 +92,22 @@ function initP2PForms() {
         form.addEventListener('submit', function(e) {
             e.preventDefault();
             
-            const formData = new FormData(this);
-            const action = this.getAttribute('action');
+            const form = this;
+            const formData = new FormData(form);
+            const action = form.getAttribute('action');
             
             fetch(action, {
                 method: 'POST',
                 body: formData,
                 headers: {
-                    'X-CSRFToken': getCookie('csrftoken')
+                    'X-CSRFToken': getCookie('csrftoken'),
+                    'Idempotency-Key': idempotencyKey(form)
                 }
             })
-            .then(response => response.json())
+            .then(response => {
+                resetIdempotencyKey(form);
+                return response.json();
+            })
             .then(data => {
                 if (data.success) {
                     // Показываем уведомление об успехе
@@ -204,6 +209,23 @@ function getCookie(name) {
     return cookieValue;
 }
 
+// Ключ идемпотентности операции: один на действие пользователя. Ключ живет,
+// пока не получен ответ, поэтому повторная отправка после обрыва связи
+// не выполнит списание дважды
+function idempotencyKey(element) {
+    if (!element.dataset.idempotencyKey) {
+        element.dataset.idempotencyKey = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : Date.now().toString(16) + Math.random().toString(16).slice(2);
+    }
+    return element.dataset.idempotencyKey;
+}
+
+// Сервер ответил — следующее действие получит новый ключ
+function resetIdempotencyKey(element) {
+    delete element.dataset.idempotencyKey;
+}
+
 // Функция для создания анимации роста дерева
 function animateTreeGrowth(treeElement) {
     treeElement.style.transform = 'scale(0.8)';
@@ -0,0 +1,92 @@
+"""
+Полив и сбор дохода со всех деревьев пользователя за один запрос.
+
+Деревья пользователя читаются одним ``SELECT ... FOR UPDATE``, доход каждого
+считается в памяти (``Tree.income_between``), а изменения записываются
+одним ``UPDATE`` деревьев с ``Case``/``When`` по id. Доход всех деревьев
+начисляется одним ``F()``-обновлением пользователя, записи журнала балансов
+создаются одной вставкой.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, Value, When
+from django.utils import timezone
+
+from users import ledger
+from users.models import User
+
+from .models import Tree
+
+
+def _per_tree(values, output_field, default):
+    """Выражение, подставляющее для каждого дерева свое значение"""
+    return Case(
+        *(When(pk=pk, then=Value(value)) for pk, value in values.items()),
+        default=Value(default),
+        output_field=output_field,
+    )
+
+
+def water_all(user_id, now=None):
+    """
+    Поливает все деревья пользователя. Доход, накопленный до полива,
+    переносится в ``accrued_income`` (как в ``Tree.settle``).
+    Возвращает деревья и id деревьев, на которых выпала ветка.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        trees = list(Tree.objects.select_for_update().filter(user_id=user_id).order_by('pk'))
+        if not trees:
+            return [], set()
+        owed = {tree.pk: tree.income_between(tree.accrued_since, now) for tree in trees}
+        dropped = {tree.pk for tree in trees if tree.roll_branch()}
+        Tree.objects.filter(pk__in=owed).update(
+            last_watered=now,
+            accrued_since=now,
+            accrued_income=F('accrued_income') + _per_tree(owed, DecimalField(max_digits=20, decimal_places=8), 0),
+            branches_collected=F('branches_collected') + _per_tree(
+                {pk: 1 for pk in dropped}, IntegerField(), 0
+            ),
+        )
+    for tree in trees:
+        tree.accrued_income += owed[tree.pk]
+        tree.accrued_since = tree.last_watered = now
+        tree.branches_collected += tree.pk in dropped
+    return trees, dropped
+
+
+def collect_all(user_id, now=None):
+    """
+    Начисляет пользователю весь доход со всех деревьев. Возвращает
+    начисленные суммы по активам: ``{'CF': Decimal, 'TON': Decimal}``.
+    """
+    now = now or timezone.now()
+    totals = defaultdict(Decimal)
+    with transaction.atomic():
+        trees = list(Tree.objects.select_for_update().filter(user_id=user_id).order_by('pk'))
+        incomes = {}
+        remainders = {}
+        for tree in trees:
+            income, remainder = tree.split_income(tree.owed_income(now))
+            if income > 0:
+                incomes[tree] = income
+                remainders[tree.pk] = remainder
+                totals[tree.type] += income
+        if not incomes:
+            return {}
+
+        Tree.objects.filter(pk__in=remainders).update(
+            accrued_since=now,
+            accrued_income=_per_tree(remainders, DecimalField(max_digits=20, decimal_places=8), 0),
+        )
+        User.objects.filter(pk=user_id).update(**{
+            ledger.BALANCE_FIELDS[asset]: F(ledger.BALANCE_FIELDS[asset]) + total
+            for asset, total in totals.items()
+        })
+        ledger.write([
+            ledger.entry(user_id, tree.type, income, 'tree_income', tree)
+            for tree, income in incomes.items()
+        ])
+    return dict(totals)
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from trees.ticks import DEFAULT_CHUNK_SIZE, make_rng, run_tick
+
+
+class Command(BaseCommand):
+    help = 'Поливает деревья под автополивом и разыгрывает выпадение веток'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Количество деревьев в одной пачке')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Начальное значение генератора случайных чисел')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Повторять тик с указанным интервалом')
+
+    def handle(self, *args, **options):
+        rng = make_rng(options['seed'])
+        while True:
+            started = time.perf_counter()
+            watered, branches = run_tick(chunk_size=options['chunk_size'], rng=rng)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f'Полито деревьев: {watered}, выпало веток: {branches} ({elapsed:.2f} с)'
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trees', '0003_tree_auto_water_until'),
+        ('users', '0005_scheduler_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['fertilized_until'], name='trees_fertilized_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['auto_water_until'], name='trees_auto_water_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trees', '0004_scheduler_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tree',
+            name='accrued_income',
+            field=models.DecimalField(decimal_places=8, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='tree',
+            name='accrued_since',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,8 +1,24 @@
-from django.db import models
-from django.conf import settings
+from decimal import ROUND_DOWN, Decimal
+
+from django.db import models, transaction
+from django.db.models import F
 from django.utils import timezone
 import random
 
+from users.rules import get_rules
+
+INCOME_STEP = Decimal('0.00000001')
+
+
+def _overlap(*intervals):
+    """Длительность пересечения интервалов [начало, конец) в секундах; None — пустой интервал"""
+    if any(interval is None for interval in intervals):
+        return 0
+    start = max(interval[0] for interval in intervals)
+    end = min(interval[1] for interval in intervals)
+    return max((end - start).total_seconds(), 0)
+
+
 class Tree(models.Model):
     """Модель дерева в игре"""
     TYPE_CHOICES = [
@@ -19,12 +35,19 @@ class Tree(models.Model):
     last_watered = models.DateTimeField(null=True, blank=True)
     fertilized_until = models.DateTimeField(null=True, blank=True)  # Время действия удобрения
     auto_water_until = models.DateTimeField(null=True, blank=True)  # Время действия автополива
+    accrued_since = models.DateTimeField(default=timezone.now)  # С какого момента доход еще не начислен
+    accrued_income = models.DecimalField(max_digits=20, decimal_places=8, default=0)  # Доход, накопленный до accrued_since
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         verbose_name = 'Дерево'
         verbose_name_plural = 'Деревья'
         unique_together = ['user', 'type']  # У пользователя может быть только одно дерево каждого типа
+        indexes = [
+            # Планировщик сроков: ближайшие окончания удобрения и автополива
+            models.Index(fields=['fertilized_until'], name='trees_fertilized_idx'),
+            models.Index(fields=['auto_water_until'], name='trees_auto_water_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_type_display()} (Level {self.level}) - {self.user}"
@@ -34,10 +57,7 @@ class Tree(models.Model):
         if not self.last_watered:
             return False
         
-        watering_duration = settings.GAME_SETTINGS.get('WATERING_DURATION', 5)
-        watering_expires = self.last_watered + timezone.timedelta(hours=watering_duration)
-        
-        return timezone.now() < watering_expires
+        return timezone.now() < self.last_watered + get_rules().watering_duration
     
     def is_fertilized(self):
         """Проверяет, удобрено ли дерево"""
@@ -60,53 +80,159 @@ class Tree(models.Model):
             base_income *= 2
             
         return base_income
+
+    def income_between(self, since, until):
+        """
+        Доход за интервал [since, until) при текущих уровне, поливе и удобрении.
+        Доход идет, пока дерево полито (окно полива или автополив), и
+        удваивается, пока действует удобрение. Автополив и удобрение
+        считаются действующими с ``since``: перед их изменением накопленный
+        доход переносится в ``accrued_income`` (``settle``).
+        """
+        if until <= since:
+            return Decimal(0)
+        period = (since, until)
+        watering = None
+        if self.last_watered:
+            watering = (self.last_watered, self.last_watered + get_rules().watering_duration)
+        auto = (since, self.auto_water_until) if self.auto_water_until else None
+        fertilizer = (since, self.fertilized_until) if self.fertilized_until else None
+
+        def watered(*extra):
+            return (_overlap(period, watering, *extra) + _overlap(period, auto, *extra)
+                    - _overlap(period, watering, auto, *extra))
+
+        # Секунды полива плюс секунды полива под удобрением (удвоенный доход)
+        seconds = watered() + watered(fertilizer)
+        income = Decimal(str(self.income_per_hour)) * Decimal(str(seconds)) / 3600
+        return income.quantize(INCOME_STEP, rounding=ROUND_DOWN)
+
+    def owed_income(self, now=None):
+        """Весь доход, еще не начисленный владельцу"""
+        return self.accrued_income + self.income_between(self.accrued_since, now or timezone.now())
+
+    def settle(self, now=None, expected=None, **changes):
+        """
+        Переносит доход, накопленный с ``accrued_since``, в ``accrued_income``
+        и тем же условным ``UPDATE`` записывает ``changes``. Вызывается при
+        изменении уровня, полива, автополива или удобрения, чтобы новые
+        значения не применялись к прошедшему времени.
+
+        ``expected`` — значения полей, прочитанные перед изменением: если
+        другой запрос успел их изменить, ничего не записывается и
+        возвращается False.
+        """
+        now = now or timezone.now()
+        expected = expected or {}
+        while changes or now > self.accrued_since:
+            owed = self.income_between(self.accrued_since, now)
+            since = max(now, self.accrued_since)
+            updated = Tree.objects.filter(pk=self.pk, accrued_since=self.accrued_since, **expected).update(
+                accrued_income=F('accrued_income') + owed, accrued_since=since, **changes
+            )
+            if updated:
+                self.accrued_income += owed
+                self.accrued_since = since
+                break
+            # Доход одновременно собрали или перенесли в другом запросе
+            self.refresh_from_db(fields=['accrued_since', 'accrued_income', *expected])
+            if any(getattr(self, field) != value for field, value in expected.items()):
+                return False
+        return True
+
+    def split_income(self, owed):
+        """
+        Делит доход на часть, которую можно начислить с точностью поля
+        баланса, и остаток, который остается накопленным
+        """
+        from users import ledger
+        from users.models import User
+
+        places = User._meta.get_field(ledger.BALANCE_FIELDS[self.type]).decimal_places
+        income = owed.quantize(Decimal(1).scaleb(-places), rounding=ROUND_DOWN)
+        return income, owed - income
+
+    def collect(self, now=None):
+        """
+        Начисляет владельцу весь доход с прошлого сбора одним условным
+        ``UPDATE`` дерева. Остаток меньше точности баланса остается
+        накопленным. Возвращает начисленную сумму; 0, если начислять нечего
+        или доход одновременно собрали в другом запросе.
+        """
+        from users import ledger
+        from users.models import User
+
+        now = now or timezone.now()
+        income, remainder = self.split_income(self.owed_income(now))
+        field = ledger.BALANCE_FIELDS[self.type]
+        if income <= 0:
+            return Decimal(0)
+
+        with transaction.atomic():
+            updated = Tree.objects.filter(pk=self.pk, accrued_since=self.accrued_since).update(
+                accrued_since=now, accrued_income=remainder
+            )
+            if not updated:
+                return Decimal(0)
+            User.objects.filter(pk=self.user_id).update(**{field: F(field) + income})
+            ledger.record(self.user_id, self.type, income, 'tree_income', self)
+        self.accrued_since = now
+        self.accrued_income = remainder
+        return income
     
     def can_upgrade(self):
         """Проверяет, можно ли улучшить дерево"""
-        if self.level >= 5:  # Максимальный уровень
+        rules = get_rules()
+        if self.level >= rules.max_level:  # Максимальный уровень
             return False
-            
-        tree_levels = settings.GAME_SETTINGS.get('TREE_LEVELS', {})
-        required_branches = tree_levels.get(self.level + 1, {}).get('branches', 0)
         
-        return self.branches_collected >= required_branches
+        return self.branches_collected >= rules.branches_for(self.level + 1)
     
     def upgrade(self):
         """Улучшает дерево на следующий уровень"""
         if not self.can_upgrade():
             return False
             
-        self.level += 1
-        tree_levels = settings.GAME_SETTINGS.get('TREE_LEVELS', {})
-        self.income_per_hour = tree_levels.get(self.level, {}).get('income', self.income_per_hour)
-        self.save()
+        level = self.level + 1
+        income_per_hour = get_rules().income_for(level, self.income_per_hour)
+        # Условие на уровень не дает двум одновременным запросам улучшить дерево дважды
+        if not self.settle(expected={'level': self.level}, level=level, income_per_hour=income_per_hour):
+            return False
+        self.level = level
+        self.income_per_hour = income_per_hour
         
         return True
     
+    def roll_branch(self):
+        """Определяет, выпала ли ветка при поливе"""
+        # Ветка выпадает только до максимального уровня;
+        # при автополиве шанс увеличивается
+        rules = get_rules()
+        if self.level >= rules.max_level:
+            return False
+        return random.random() < rules.branch_chance(self.is_auto_watered())
+
     def water(self):
-        """Поливает дерево"""
-        # Проверяем, активен ли автополив
-        is_auto = self.is_auto_watered()
+        """
+        Поливает дерево одним условным ``UPDATE``: время полива, ветка и
+        перенос накопленного дохода. Выпадение ветки разыгрывается заранее,
+        а счетчик веток увеличивается через ``F()``, поэтому одновременные
+        поливы не теряют ветки.
+        """
+        # Шанс ветки зависит от автополива до полива
+        dropped = self.roll_branch()
         
-        self.last_watered = timezone.now()
-        self.save()
+        now = timezone.now()
+        self.settle(now, last_watered=now, branches_collected=F('branches_collected') + int(dropped))
+        self.last_watered = now
+        self.branches_collected += int(dropped)
         
-        # С вероятностью 10% выпадает ветка (только если уровень < 5)
-        # Если автополив активен, увеличиваем шанс выпадения ветки
-        if self.level < 5:
-            branch_drop_chance = settings.GAME_SETTINGS.get('BRANCH_DROP_CHANCE', 0.1)
-            if is_auto:
-                branch_drop_chance *= 1.5  # Увеличиваем шанс на 50% при автополиве
-                
-            if random.random() < branch_drop_chance:
-                self.branches_collected += 1
-                self.save()
-                return True  # Ветка выпала
-                
-        return False  # Ветка не выпала
+        return dropped
     
     def fertilize(self, hours=24):
         """Применяет удобрение к дереву"""
-        self.fertilized_until = timezone.now() + timezone.timedelta(hours=hours)
-        self.save()
+        now = timezone.now()
+        fertilized_until = now + timezone.timedelta(hours=hours)
+        self.settle(now, fertilized_until=fertilized_until)
+        self.fertilized_until = fertilized_until
         return True
@@ -1,3 +1,256 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from decimal import Decimal
+
+from trees import bulk, ticks, views
+from trees.models import Tree
+from users.models import LedgerEntry, User
+from users.rules import get_rules
+
+
+class TreeAccrualTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = User.objects.create(telegram_id=111111111, username='user', first_name='User')
+        self.tree = Tree.objects.create(user=self.user, type='CF', income_per_hour=2.0, accrued_since=self.now)
+
+    def hours(self, value):
+        return self.now + timezone.timedelta(hours=value)
+
+    def test_income_only_while_watered(self):
+        self.tree.last_watered = self.hours(1)
+        # Полив действует 5 часов: с 1-го по 6-й час
+        self.assertEqual(self.tree.income_between(self.now, self.hours(10)), Decimal('10'))
+        self.assertEqual(self.tree.income_between(self.now, self.hours(3)), Decimal('4'))
+
+    def test_fertilizer_doubles_income_and_auto_water_extends_window(self):
+        self.tree.last_watered = self.now
+        self.tree.fertilized_until = self.hours(2)
+        self.tree.auto_water_until = self.hours(8)
+        # 8 часов полива, из них 2 под удобрением: (8 + 2) * 2
+        self.assertEqual(self.tree.income_between(self.now, self.hours(12)), Decimal('20'))
+
+    def test_collect_credits_everything_since_last_claim(self):
+        Tree.objects.filter(pk=self.tree.pk).update(last_watered=self.now)
+        self.tree.refresh_from_db()
+
+        self.assertEqual(self.tree.collect(self.hours(3)), Decimal('6'))
+        self.assertEqual(self.tree.collect(self.hours(10)), Decimal('4'))
+        self.assertEqual(self.tree.collect(self.hours(11)), Decimal('0'))
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('10'))
+        self.assertEqual(LedgerEntry.objects.filter(reason='tree_income').count(), 2)
+
+    def test_stale_copy_cannot_collect_twice(self):
+        Tree.objects.filter(pk=self.tree.pk).update(last_watered=self.now)
+        first = Tree.objects.get(pk=self.tree.pk)
+        second = Tree.objects.get(pk=self.tree.pk)
+
+        self.assertEqual(first.collect(self.hours(5)), Decimal('10'))
+        self.assertEqual(second.collect(self.hours(5)), Decimal('0'))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('10'))
+
+    def test_upgrade_does_not_apply_to_past_income(self):
+        Tree.objects.filter(pk=self.tree.pk).update(last_watered=self.now - timezone.timedelta(hours=1))
+        tree = Tree.objects.get(pk=self.tree.pk)
+        tree.settle(self.hours(1))
+        tree.income_per_hour = 4.0
+        tree.save(update_fields=['income_per_hour'])
+
+        tree.refresh_from_db()
+        # Час по 2 до улучшения и три часа по 4 после
+        self.assertEqual(tree.owed_income(self.hours(10)), Decimal('14'))
+
+
+class BulkTreeActionsTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = User.objects.create(telegram_id=111111111, username='user', first_name='User')
+        self.cf = Tree.objects.create(user=self.user, type='CF', income_per_hour=2.0, accrued_since=self.now)
+        self.ton = Tree.objects.create(user=self.user, type='TON', income_per_hour=0.5, accrued_since=self.now)
+        # Правила сверяются с базой при первом обращении, а не внутри подсчета запросов
+        get_rules()
+        cache.clear()
+        session = self.client.session
+        session['telegram_id'] = self.user.telegram_id
+        session.save()
+
+    def hours(self, value):
+        return self.now + timezone.timedelta(hours=value)
+
+    def test_water_all_updates_every_tree_in_one_statement(self):
+        with self.assertNumQueries(4):
+            # SAVEPOINT, SELECT ... FOR UPDATE, UPDATE, RELEASE
+            trees, _ = bulk.water_all(self.user.pk, self.now)
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(Tree.objects.filter(last_watered=self.now).count(), 2)
+
+    def test_collect_all_credits_summed_income(self):
+        bulk.water_all(self.user.pk, self.now)
+
+        with self.assertNumQueries(6):
+            # SAVEPOINT, SELECT ... FOR UPDATE, UPDATE деревьев, UPDATE пользователя, INSERT журнала, RELEASE
+            income = bulk.collect_all(self.user.pk, self.hours(2))
+        self.assertEqual(income, {'CF': Decimal('4'), 'TON': Decimal('1')})
+
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.cf_balance, self.user.ton_balance), (Decimal('4'), Decimal('1')))
+        self.assertEqual(bulk.collect_all(self.user.pk, self.hours(2)), {})
+
+    def test_endpoints(self):
+        response = self.client.post(reverse('water_all'))
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(len(response.json()['trees']), 2)
+
+        Tree.objects.update(accrued_since=self.hours(-1), last_watered=self.hours(-1))
+        response = self.client.post(reverse('collect_all'))
+        self.assertEqual(response.json()['status'], 'success')
+        income = response.json()['income']
+        self.assertAlmostEqual(income['CF'], 2.0, places=2)
+        self.assertAlmostEqual(income['TON'], 0.5, places=3)
+
+
+class TickTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = User.objects.create(telegram_id=111111111, username='user', first_name='User')
+        self.other = User.objects.create(
+            telegram_id=222222222, username='other', first_name='Other', auto_water_until=self.now + timezone.timedelta(days=1)
+        )
+
+    def test_waters_only_trees_under_auto_water(self):
+        own = Tree.objects.create(
+            user=self.user, type='CF', accrued_since=self.now, auto_water_until=self.now + timezone.timedelta(days=1)
+        )
+        plain = Tree.objects.create(user=self.user, type='TON', accrued_since=self.now)
+        by_user = Tree.objects.create(user=self.other, type='CF', accrued_since=self.now)
+
+        watered, _ = ticks.run_tick(self.now, chunk_size=1)
+        self.assertEqual(watered, 2)
+        self.assertEqual(
+            set(Tree.objects.filter(last_watered=self.now).values_list('id', flat=True)), {own.id, by_user.id}
+        )
+        self.assertIsNone(Tree.objects.get(pk=plain.pk).last_watered)
+        # Повторный тик не поливает деревья, окно полива которых еще не закончилось
+        self.assertEqual(ticks.run_tick(self.now)[0], 0)
+
+    def test_income_before_watering_is_kept(self):
+        tree = Tree.objects.create(user=self.other, type='CF', income_per_hour=2.0)
+        Tree.objects.filter(pk=tree.pk).update(
+            accrued_since=self.now - timezone.timedelta(hours=8), last_watered=self.now - timezone.timedelta(hours=6)
+        )
+        ticks.run_tick(self.now)
+        tree.refresh_from_db()
+        self.assertEqual(tree.accrued_income, Decimal('10'))
+        self.assertEqual(tree.accrued_since, self.now)
+
+    def test_branch_draw_uses_boosted_chance(self):
+        rng = ticks.make_rng(42)
+        drops = ticks.draw_branches(rng, [1] * 10000 + [5] * 100, 0.15, max_level=5)
+        self.assertFalse(any(drops[10000:]))
+        self.assertAlmostEqual(sum(drops[:10000]) / 10000, 0.15, delta=0.02)
+
+
+class TreeWriteTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(telegram_id=111111111, username='user', first_name='User')
+        self.tree = Tree.objects.create(user=self.user, type='CF', branches_collected=5)
+
+    def test_water_is_single_update(self):
+        with mock.patch.object(Tree, 'roll_branch', return_value=True):
+            with self.assertNumQueries(1):
+                self.assertTrue(self.tree.water())
+        self.tree.refresh_from_db()
+        self.assertEqual(self.tree.branches_collected, 6)
+        self.assertIsNotNone(self.tree.last_watered)
+
+    def test_stale_copies_keep_every_branch(self):
+        copies = [Tree.objects.get(pk=self.tree.pk) for _ in range(3)]
+        with mock.patch.object(Tree, 'roll_branch', return_value=True):
+            for tree in copies:
+                tree.water()
+        self.assertEqual(Tree.objects.get(pk=self.tree.pk).branches_collected, 8)
+
+    def test_stale_upgrade_is_rejected(self):
+        stale = Tree.objects.get(pk=self.tree.pk)
+        self.assertTrue(self.tree.upgrade())
+        self.assertFalse(stale.upgrade())
+        self.assertEqual(Tree.objects.get(pk=self.tree.pk).level, 2)
+
+    def test_upgrade_view_reports_concurrent_upgrade(self):
+        session = self.client.session
+        session['telegram_id'] = self.user.telegram_id
+        session.save()
+        url = reverse('upgrade_tree', args=[self.tree.pk])
+
+        # Другой запрос улучшает дерево между чтением и улучшением
+        read = views.get_object_or_404
+
+        def read_then_upgrade(*args, **kwargs):
+            tree = read(*args, **kwargs)
+            Tree.objects.get(pk=tree.pk).upgrade()
+            return tree
+        with mock.patch.object(views, 'get_object_or_404', read_then_upgrade):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(Tree.objects.get(pk=self.tree.pk).level, 2)
+
+        # Ответ об успешном улучшении строится по сохраненному дереву
+        Tree.objects.filter(pk=self.tree.pk).update(branches_collected=100)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        tree = Tree.objects.get(pk=self.tree.pk)
+        self.assertEqual(response.json()['new_level'], tree.level)
+        self.assertEqual(Decimal(str(response.json()['new_income'])), tree.income_per_hour)
+
+
+class ConcurrentWateringTest(TransactionTestCase):
+    def retry_locked(self, action):
+        # Тестовая база SQLite в памяти не ждет блокировку, а сразу отвечает
+        # «database table is locked»; неудавшийся запрос ничего не записал,
+        # поэтому его можно повторить
+        for attempt in range(100):
+            try:
+                return action()
+            except OperationalError as error:
+                if 'locked' not in str(error):
+                    raise
+                time.sleep(0.01)
+        return action()
+
+    def test_parallel_waterings_keep_every_branch(self):
+        user = User.objects.create(telegram_id=111111111, username='user', first_name='User')
+        tree = Tree.objects.create(user=user, type='CF')
+        workers = 8
+        barrier = threading.Barrier(workers)
+        errors = []
+
+        def water():
+            try:
+                instance = self.retry_locked(lambda: Tree.objects.get(pk=tree.pk))
+                barrier.wait()
+                self.retry_locked(instance.water)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        with mock.patch.object(Tree, 'roll_branch', return_value=True):
+            threads = [threading.Thread(target=water) for _ in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Tree.objects.get(pk=tree.pk).branches_collected, workers)
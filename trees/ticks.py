@@ -0,0 +1,108 @@
+"""
+Игровой тик: фоновый автополив деревьев и выпадение веток.
+
+Тик выбирает пачками (по id) деревья с действующим автополивом — своим
+(``Tree.auto_water_until``) или пользователя (``User.auto_water_until``), —
+у которых закончилось окно прошлого полива, и поливает их. Ветки для всей
+пачки разыгрываются одним вызовом векторного генератора NumPy с шансом
+``BRANCH_DROP_CHANCE``, увеличенным для автополива, как при ручном поливе
+(``Tree.roll_branch``). Без NumPy используется ``random``.
+Пачка записывается несколькими set-based ``UPDATE``: время полива и
+ветки одинаковы для многих деревьев, а ``bulk_update`` нужен только для
+накопленного дохода, который у каждого дерева свой.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from users.rules import get_rules
+
+from .models import Tree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def make_rng(seed=None):
+    """Генератор случайных чисел: NumPy, если установлен, иначе ``random.Random``"""
+    if np is not None:
+        return np.random.default_rng(seed)
+    return random.Random(seed)
+
+
+def draw_branches(rng, levels, chance, max_level):
+    """Для каждого уровня дерева определяет, выпала ли ветка"""
+    if np is not None and isinstance(rng, np.random.Generator):
+        levels = np.fromiter(levels, dtype=np.int16, count=len(levels))
+        return ((levels < max_level) & (rng.random(len(levels)) < chance)).tolist()
+    return [level < max_level and rng.random() < chance for level in levels]
+
+
+def due_trees(now):
+    """Деревья под автополивом, окно полива которых уже закончилось"""
+    return Tree.objects.filter(
+        Q(auto_water_until__gt=now) | Q(user__auto_water_until__gt=now),
+        Q(last_watered__isnull=True) | Q(last_watered__lte=now - get_rules().watering_duration),
+    )
+
+
+def water_chunk(trees, now, rng):
+    """Поливает пачку деревьев; возвращает количество выпавших веток"""
+    rules = get_rules()
+    dropped = draw_branches(rng, [tree.level for tree in trees], rules.branch_chance(True), rules.max_level)
+    # Свой автополив дерева уже учтен в доходе с accrued_since (Tree.income_between),
+    # поэтому новый полив не меняет прошлый доход. Доход остальных деревьев
+    # переносится в accrued_income, как в Tree.settle; bulk_update строит
+    # выражение на каждую строку, поэтому в него попадают только деревья
+    # с ненулевым доходом
+    settled = []
+    for tree in trees:
+        if not (tree.auto_water_until and tree.auto_water_until > now):
+            income = tree.income_between(tree.accrued_since, now)
+            if income:
+                tree.accrued_income += income
+                settled.append(tree)
+        tree.last_watered = now
+
+    settled_ids = {tree.pk for tree in settled}
+    Tree.objects.filter(pk__in=[tree.pk for tree in trees if tree.pk not in settled_ids]).update(last_watered=now)
+    if settled:
+        Tree.objects.bulk_update(settled, ['accrued_income'])
+        Tree.objects.filter(pk__in=settled_ids).update(last_watered=now, accrued_since=now)
+    branch_ids = [tree.pk for tree, branch in zip(trees, dropped) if branch]
+    if branch_ids:
+        Tree.objects.filter(pk__in=branch_ids).update(branches_collected=F('branches_collected') + 1)
+    return len(branch_ids)
+
+
+def run_tick(now=None, chunk_size=DEFAULT_CHUNK_SIZE, rng=None):
+    """
+    Поливает все деревья под автополивом, которым нужен полив. Каждая
+    пачка обрабатывается в своей транзакции под ``SELECT ... FOR UPDATE``,
+    чтобы сбор дохода не пересекся с переносом ``accrued_income``.
+    Возвращает количество политых деревьев и выпавших веток.
+    """
+    now = now or timezone.now()
+    rng = rng or make_rng()
+    queryset = due_trees(now).order_by('pk').only(
+        'id', 'level', 'income_per_hour', 'last_watered', 'fertilized_until', 'auto_water_until',
+        'branches_collected', 'accrued_since', 'accrued_income',
+    )
+    watered = branches = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            trees = list(queryset.filter(pk__gt=last_id).select_for_update(of=('self',))[:chunk_size])
+            if trees:
+                branches += water_chunk(trees, now, rng)
+                watered += len(trees)
+        if len(trees) < chunk_size:
+            break
+        last_id = trees[-1].pk
+    return watered, branches
@@ -9,4 +9,6 @@ urlpatterns = [
     path('tree/<int:tree_id>/water/', views.water_tree, name='water_tree'),
     path('tree/<int:tree_id>/upgrade/', views.upgrade_tree, name='upgrade_tree'),
     path('tree/<int:tree_id>/collect/', views.collect_income, name='collect_income'),
+    path('trees/water-all/', views.water_all, name='water_all'),
+    path('trees/collect-all/', views.collect_all, name='collect_all'),
 ]
\ No newline at end of file
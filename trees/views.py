@@ -3,9 +3,10 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import JsonResponse
 from .models import Tree
+from . import bulk
 from users.models import User as TelegramUser
 from django.utils import timezone
-from django.conf import settings
+from users.rules import get_rules
 
 def get_current_user(request):
     """
@@ -106,9 +107,8 @@ def tree_detail(request, tree_id):
     # Уровень воды (для прогресс-бара)
     water_level = 0
     if tree.is_watered():
-        watering_duration = settings.GAME_SETTINGS.get('WATERING_DURATION', 5)
         time_since_watering = timezone.now() - tree.last_watered
-        elapsed_percent = (time_since_watering.total_seconds() / (watering_duration * 3600)) * 100
+        elapsed_percent = time_since_watering / get_rules().watering_duration * 100
         water_level = max(0, 100 - elapsed_percent)
     
     context["water_level"] = int(water_level)
@@ -151,7 +151,14 @@ def upgrade_tree(request, tree_id):
             "message": "Недостаточно веток для улучшения. Накопите ещё веток."
         }, status=400)
 
-    tree.upgrade()
+    # Дерево могли улучшить или изменить параллельным запросом после чтения
+    if not tree.upgrade():
+        return JsonResponse({
+            "status": "error",
+            "message": "Дерево уже изменено другим запросом. Обновите страницу и попробуйте снова."
+        }, status=409)
+
+    tree.refresh_from_db(fields=["level", "income_per_hour", "branches_collected"])
     return JsonResponse({
         "status": "success",
         "message": f"Дерево улучшено до уровня {tree.level}",
@@ -169,36 +176,70 @@ def collect_income(request, tree_id):
     if request.method != "POST":
         return JsonResponse({"status": "error", "message": "Требуется метод POST"}, status=400)
     
-    # Проверяем, полито ли дерево
-    if not tree.is_watered():
-        return JsonResponse({"status": "error", "message": "Дерево нужно сначала полить"}, status=400)
-    
-    # Рассчитываем доход (базовый доход с учетом удобрений)
-    income = tree.get_current_income()
-    
-    # Начисляем токены пользователю в зависимости от типа дерева
-    if tree.type == "CF":
-        user.cf_balance += income
-    elif tree.type == "TON":
-        user.ton_balance += income
-    
-    # Сохраняем изменения
-    user.save()
-    
-    # Отмечаем дерево как "не политое" для необходимости нового полива
-    tree.last_watered = None
-    tree.save()
-    
-    # Определяем тип токена для сообщения
-    token_type = tree.type
-    
+    # Начисляем весь доход, накопленный с прошлого сбора
+    income = tree.collect()
+    if not income:
+        return JsonResponse({"status": "error", "message": "Доход еще не накоплен. Полейте дерево"}, status=400)
+
+    user.refresh_from_db(fields=["cf_balance", "ton_balance"])
     return JsonResponse({
         "status": "success",
-        "message": f"Собрано {income} {token_type}",
-        "income": income,
+        "message": f"Собрано {income} {tree.type}",
+        "income": float(income),
         "new_balance": user.cf_balance if tree.type == "CF" else user.ton_balance
     })
 
+def water_all(request):
+    """Поливает все деревья пользователя одним запросом"""
+    # Пользователь уже загружен TelegramAuthMiddleware
+    user = request.user
+    if not isinstance(user, TelegramUser):
+        return JsonResponse({"status": "error", "message": "Сначала авторизуйтесь"}, status=403)
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Требуется метод POST"}, status=400)
+
+    trees, dropped = bulk.water_all(user.pk)
+    if not trees:
+        return JsonResponse({"status": "error", "message": "У вас нет деревьев"}, status=400)
+
+    message = f"Полито деревьев: {len(trees)}"
+    if dropped:
+        message += f". Найдено веток: {len(dropped)}"
+    return JsonResponse({
+        "status": "success",
+        "message": message,
+        "trees": [
+            {
+                "id": tree.id,
+                "branch_dropped": tree.id in dropped,
+                "branches_collected": tree.branches_collected,
+            }
+            for tree in trees
+        ],
+    })
+
+def collect_all(request):
+    """Собирает доход со всех деревьев пользователя одним запросом"""
+    user = request.user
+    if not isinstance(user, TelegramUser):
+        return JsonResponse({"status": "error", "message": "Сначала авторизуйтесь"}, status=403)
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Требуется метод POST"}, status=400)
+
+    income = bulk.collect_all(user.pk)
+    if not income:
+        return JsonResponse({"status": "error", "message": "Доход еще не накоплен. Полейте деревья"}, status=400)
+
+    user.refresh_from_db(fields=["cf_balance", "ton_balance"])
+    collected = ", ".join(f"{amount} {asset}" for asset, amount in income.items())
+    return JsonResponse({
+        "status": "success",
+        "message": f"Собрано {collected}",
+        "income": {asset: float(amount) for asset, amount in income.items()},
+        "cf_balance": user.cf_balance,
+        "ton_balance": user.ton_balance,
+    })
+
 def create_tree(request):
     """
     Создает новое дерево для пользователя.
@@ -11,6 +11,7 @@ django.setup()
 
 # Импортируем модель пользователя
 from users.models import User
+from users import ledger
 
 def main():
     """Обновляет баланс CF пользователей"""
@@ -18,6 +19,7 @@ def main():
     
     print(f"Всего пользователей: {users.count()}")
     print("-" * 50)
+    entries = []
     
     for user in users:
         # Обновляем баланс только для пользователей с нулевым балансом
@@ -25,6 +27,7 @@ def main():
             old_balance = user.cf_balance
             user.cf_balance = Decimal('100.00')
             user.save()
+            entries.append(ledger.entry(user.pk, 'CF', user.cf_balance - old_balance, 'admin'))
             
             print(f"Пользователь: {user}")
             print(f"ID: {user.telegram_id}")
@@ -34,6 +37,8 @@ def main():
         else:
             print(f"Пользователь {user} уже имеет ненулевой баланс: {user.cf_balance}")
             print("-" * 50)
+    
+    ledger.write(entries)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -4,8 +4,10 @@ from django.utils import timezone
 from django.urls import reverse
 from django.db.models import Sum, Count, F, Q
 from datetime import timedelta
+from decimal import Decimal
 
-from .models import User
+from .models import BalanceSnapshot, GameSettingOverride, LedgerEntry, User
+from . import ledger
 
 
 @admin.register(User)
@@ -228,14 +230,18 @@ class UserAdmin(admin.ModelAdmin):
         amount = request.POST.get('amount')
         
         if 'apply' in request.POST and amount:
-            amount = float(amount)
+            amount = Decimal(amount)
             updated = 0
+            entries = []
             
             for user in queryset:
                 user.cf_balance += amount
                 user.save()
+                entries.append(ledger.entry(user.pk, 'CF', amount, 'admin'))
                 updated += 1
             
+            ledger.write(entries)
+            
             self.message_user(request, f'Выдано {amount} CF токенов {updated} пользователям.')
     
     give_cf_tokens.short_description = "Выдать CF токены"
@@ -252,14 +258,18 @@ class UserAdmin(admin.ModelAdmin):
         amount = request.POST.get('amount')
         
         if 'apply' in request.POST and amount:
-            amount = float(amount)
+            amount = Decimal(amount)
             updated = 0
+            entries = []
             
             for user in queryset:
                 user.ton_balance += amount
                 user.save()
+                entries.append(ledger.entry(user.pk, 'TON', amount, 'admin'))
                 updated += 1
             
+            ledger.write(entries)
+            
             self.message_user(request, f'Выдано {amount} TON токенов {updated} пользователям.')
     
     give_ton_tokens.short_description = "Выдать TON токены"
@@ -324,3 +334,50 @@ class UserAdmin(admin.ModelAdmin):
         css = {
             'all': ('https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css',)
         }
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    """
+    Журнал балансов: только просмотр, записи не изменяются и не удаляются
+    """
+    list_display = ('id', 'user', 'asset', 'delta', 'reason', 'ref', 'created_at')
+    list_filter = ('asset', 'reason', 'created_at')
+    search_fields = ('user__telegram_id', 'user__username', 'ref')
+    raw_id_fields = ('user',)
+    list_per_page = 50
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    """
+    Снимки остатков по журналу балансов
+    """
+    list_display = ('user', 'asset', 'balance', 'last_entry_id', 'created_at')
+    list_filter = ('asset', 'created_at')
+    search_fields = ('user__telegram_id', 'user__username')
+    raw_id_fields = ('user',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(GameSettingOverride)
+class GameSettingOverrideAdmin(admin.ModelAdmin):
+    """
+    Переопределения игровых настроек: применяются без перезапуска
+    """
+    list_display = ('key', 'value', 'updated_at')
+    search_fields = ('key',)
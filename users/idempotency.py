@@ -0,0 +1,133 @@
+"""
+Идемпотентные запросы, изменяющие балансы.
+
+Клиент передает уникальный ключ операции в заголовке ``Idempotency-Key``
+(или в поле формы ``idempotency_key``) и повторяет запрос с тем же ключом
+после обрыва связи. Представление, обернутое ``idempotent``, выполняется в
+одной транзакции БД с созданием строки ``IdempotencyKey`` и сохраняет в нее
+свой ответ. Повтор получает сохраненный ответ и балансов не касается, а
+параллельный повтор ждет на уникальном индексе, пока первый запрос не
+зафиксирует транзакцию. Ответы с ошибкой сервера (5xx) не сохраняются:
+транзакция откатывается целиком, и повтор выполнится заново.
+
+Ключи хранятся ``KEY_TTL`` и удаляются командой ``purge_idempotency_keys``.
+Запросы без ключа обрабатываются как обычно.
+"""
+import json
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+FORM_FIELD = 'idempotency_key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+KEY_TTL = timezone.timedelta(hours=24)
+PURGE_BATCH_SIZE = 1000
+
+
+class _Discard(Exception):
+    """Откатывает транзакцию запроса, не сохраняя ответ"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+def get_key(request):
+    """Ключ идемпотентности из заголовка или поля формы"""
+    data = request.data if isinstance(request, Request) else request.POST
+    return request.headers.get(HEADER) or data.get(FORM_FIELD)
+
+
+def claim(user_id, key, path):
+    """
+    Создает строку ключа или возвращает уже сохраненную: ``(record, created)``.
+    Просроченный ключ заменяется новым.
+    """
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(user_id=user_id, key=key, path=path), True
+    except IntegrityError:
+        record = IdempotencyKey.objects.get(user_id=user_id, key=key)
+    if record.created_at < timezone.now() - KEY_TTL:
+        record.delete()
+        return IdempotencyKey.objects.create(user_id=user_id, key=key, path=path), True
+    return record, False
+
+
+def store(record, response):
+    """Сохраняет ответ представления в строку ключа"""
+    if isinstance(response, Response):
+        # Ответ DRF еще не отрисован: сохраняем его данные как JSON
+        record.body = json.dumps(response.data, cls=JSONEncoder, ensure_ascii=False)
+        record.content_type = 'application/json'
+    else:
+        record.body = response.content.decode(response.charset)
+        record.content_type = response.get('Content-Type', '')
+    record.status_code = response.status_code
+    record.location = response.get('Location', '')
+    record.save(update_fields=['body', 'content_type', 'status_code', 'location'])
+
+
+def replay(record):
+    """Ответ на повторный запрос из сохраненной строки"""
+    response = HttpResponse(record.body, status=record.status_code, content_type=record.content_type or None)
+    if record.location:
+        response['Location'] = record.location
+    response[REPLAY_HEADER] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Декоратор представления (функции или метода ViewSet), изменяющего
+    балансы: POST-запрос с ключом выполняется не больше одного раза.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, (HttpRequest, Request)))
+        key = request.method == 'POST' and get_key(request)
+        if not key or not getattr(request.user, 'pk', None):
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({'status': 'error', 'message': 'Слишком длинный ключ идемпотентности'}, status=400)
+
+        try:
+            with transaction.atomic():
+                record, created = claim(request.user.pk, key, request.path)
+                if not created:
+                    if record.path != request.path:
+                        return JsonResponse({
+                            'status': 'error',
+                            'message': 'Ключ идемпотентности уже использован для другого запроса'
+                        }, status=422)
+                    return replay(record)
+
+                response = view(*args, **kwargs)
+                if response.status_code >= 500:
+                    raise _Discard(response)
+                store(record, response)
+                return response
+        except _Discard as discarded:
+            return discarded.response
+
+    return wrapper
+
+
+def purge_expired(now=None, batch_size=PURGE_BATCH_SIZE):
+    """Удаляет просроченные ключи пачками; возвращает количество удаленных"""
+    cutoff = (now or timezone.now()) - KEY_TTL
+    expired = IdempotencyKey.objects.filter(created_at__lt=cutoff).order_by('created_at')
+    deleted = 0
+    while True:
+        ids = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
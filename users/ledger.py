@@ -0,0 +1,152 @@
+"""
+Журнал балансов пользователей.
+
+Каждое изменение ``cf_balance``/``ton_balance`` сопровождается записью
+``LedgerEntry`` (пользователь, актив, изменение, причина, ссылка на объект).
+Массовые операции собирают записи в список и пишут их одним
+``bulk_create``. Периодические снимки ``BalanceSnapshot`` фиксируют
+остаток на определенную запись журнала, поэтому остаток на момент T
+считается по последнему снимку и записям после него, а не по всей истории.
+"""
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from .models import BalanceSnapshot, LedgerEntry, User
+
+WRITE_BATCH_SIZE = 500
+# Сколько секунд запись журнала должна «отлежаться» перед попаданием в снимок
+SETTLE_SECONDS = 60
+
+# Поле баланса пользователя для каждого актива журнала
+BALANCE_FIELDS = {
+    'CF': 'cf_balance',
+    'TON': 'ton_balance',
+}
+ASSETS = {field: asset for asset, field in BALANCE_FIELDS.items()}
+
+
+def quantize(asset, value):
+    """Округляет сумму до точности поля баланса актива"""
+    places = User._meta.get_field(BALANCE_FIELDS[asset]).decimal_places
+    return Decimal(str(value)).quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP)
+
+
+def make_ref(obj):
+    """Ссылка на объект, вызвавший изменение баланса: ``app.model:pk``"""
+    if obj is None:
+        return ''
+    if isinstance(obj, str):
+        return obj
+    return f"{obj._meta.label_lower}:{obj.pk}"
+
+
+def entry(user_id, asset, delta, reason, ref=None):
+    """
+    Создает несохраненную запись журнала с суммой, округленной до точности
+    поля баланса. Для нулевого изменения и для активов без баланса у
+    пользователя возвращает None.
+    """
+    if asset not in BALANCE_FIELDS:
+        return None
+    delta = quantize(asset, delta)
+    if not delta:
+        return None
+    return LedgerEntry(user_id=user_id, asset=asset, delta=delta, reason=reason, ref=make_ref(ref))
+
+
+def entries_from_deltas(deltas, reason, ref=None):
+    """Записи журнала по изменениям балансов вида ``{user_id: {поле_баланса: delta}}``"""
+    entries = []
+    for user_id, fields in deltas.items():
+        for field, delta in fields.items():
+            if field in ASSETS:
+                item = entry(user_id, ASSETS[field], delta, reason, ref)
+                if item is not None:
+                    entries.append(item)
+    return entries
+
+
+def write(entries):
+    """Пишет записи журнала пачками; пустые значения пропускаются"""
+    entries = [item for item in entries if item is not None]
+    if entries:
+        LedgerEntry.objects.bulk_create(entries, batch_size=WRITE_BATCH_SIZE)
+    return entries
+
+
+def record(user_id, asset, delta, reason, ref=None):
+    """Записывает одно изменение баланса"""
+    return write([entry(user_id, asset, delta, reason, ref)])
+
+
+def balance_at(user_id, asset, when=None):
+    """
+    Остаток пользователя по журналу на момент ``when`` (по умолчанию сейчас):
+    последний снимок, сделанный не позже ``when``, плюс записи после него.
+    """
+    snapshots = BalanceSnapshot.objects.filter(user_id=user_id, asset=asset)
+    entries = LedgerEntry.objects.filter(user_id=user_id, asset=asset)
+    if when is not None:
+        snapshots = snapshots.filter(created_at__lte=when)
+        entries = entries.filter(created_at__lte=when)
+
+    snapshot = snapshots.order_by('-last_entry_id').first()
+    balance = Decimal('0')
+    if snapshot is not None:
+        balance = snapshot.balance
+        entries = entries.filter(id__gt=snapshot.last_entry_id)
+    return balance + (entries.aggregate(total=Sum('delta'))['total'] or Decimal('0'))
+
+
+def latest_snapshots(user_ids):
+    """Последние снимки пользователей: ``{(user_id, asset): BalanceSnapshot}``"""
+    latest = {}
+    snapshots = BalanceSnapshot.objects.filter(user_id__in=user_ids).order_by('user_id', 'asset', '-last_entry_id')
+    for snapshot in snapshots:
+        latest.setdefault((snapshot.user_id, snapshot.asset), snapshot)
+    return latest
+
+
+def take_snapshots(settle_seconds=SETTLE_SECONDS, chunk_size=WRITE_BATCH_SIZE):
+    """
+    Делает снимки остатков пользователей, у которых появились записи
+    журнала после предыдущего прохода. Все снимки прохода фиксируются на
+    одной записи журнала и создаются в одной транзакции, поэтому следующий
+    проход читает только записи после нее. Записи моложе ``settle_seconds``
+    в проход не попадают: их транзакции могут быть еще не зафиксированы.
+    Возвращает количество созданных снимков.
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=settle_seconds)
+    since = BalanceSnapshot.objects.aggregate(last=Max('last_entry_id'))['last'] or 0
+    upto = LedgerEntry.objects.filter(id__gt=since, created_at__lte=cutoff).aggregate(last=Max('id'))['last']
+    if upto is None:
+        return 0
+
+    totals = defaultdict(dict)
+    rows = LedgerEntry.objects.filter(id__gt=since, id__lte=upto).values('user_id', 'asset').annotate(
+        total=Sum('delta')
+    ).order_by()
+    for row in rows:
+        totals[row['user_id']][row['asset']] = row['total']
+    user_ids = sorted(totals)
+
+    created = 0
+    with transaction.atomic():
+        for start in range(0, len(user_ids), chunk_size):
+            batch = user_ids[start:start + chunk_size]
+            previous = latest_snapshots(batch)
+            snapshots = []
+            for user_id in batch:
+                for asset, total in totals[user_id].items():
+                    snapshot = previous.get((user_id, asset))
+                    balance = (snapshot.balance if snapshot else Decimal('0')) + total
+                    snapshots.append(BalanceSnapshot(
+                        user_id=user_id, asset=asset, balance=balance, last_entry_id=upto
+                    ))
+            BalanceSnapshot.objects.bulk_create(snapshots)
+            created += len(snapshots)
+    return created
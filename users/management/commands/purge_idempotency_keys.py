@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from users.idempotency import PURGE_BATCH_SIZE, purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Удаляет просроченные ключи идемпотентности'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE,
+                            help='Количество ключей, удаляемых одним запросом')
+
+    def handle(self, *args, **options):
+        deleted = purge_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Удалено ключей: {deleted}'))
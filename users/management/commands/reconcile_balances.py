@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from users.reconcile import DEFAULT_CHUNK_SIZE, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Сверяет балансы пользователей с журналом и доменными таблицами, расхождения выводятся в JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Количество пользователей в одной пачке')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Количество процессов (по умолчанию — число ядер, 1 — без пула)')
+        parser.add_argument('--output', default='-',
+                            help='Файл для отчета в формате JSONL (по умолчанию — stdout)')
+
+    def handle(self, *args, **options):
+        if options['output'] == '-':
+            report, summary = self.stdout, self.stderr
+        else:
+            report = open(options['output'], 'w', encoding='utf-8')
+            summary = self.stdout
+
+        count = 0
+        try:
+            for mismatch in reconcile(chunk_size=options['chunk_size'], workers=options['workers'] or None):
+                report.write(json.dumps(mismatch, ensure_ascii=False) + '\n')
+                count += 1
+        finally:
+            if report is not self.stdout:
+                report.close()
+
+        style = self.style.ERROR if count else self.style.SUCCESS
+        summary.write(style(f'Расхождений: {count}'))
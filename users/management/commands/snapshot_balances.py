@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.ledger import SETTLE_SECONDS, WRITE_BATCH_SIZE, take_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Делает снимки остатков пользователей по журналу балансов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=WRITE_BATCH_SIZE,
+                            help='Количество пользователей в одной пачке')
+        parser.add_argument('--settle', type=int, default=SETTLE_SECONDS, metavar='SECONDS',
+                            help='Не включать в снимок записи моложе указанного числа секунд')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Повторять проход с указанным интервалом')
+
+    def handle(self, *args, **options):
+        while True:
+            created = take_snapshots(settle_seconds=options['settle'], chunk_size=options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(f'Создано снимков: {created}'))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
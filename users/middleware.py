@@ -1,7 +1,11 @@
 # users/middleware.py
 
+import math
+
 from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import redirect
+from . import ratelimit
 from .models import User
 
 class TelegramAuthMiddleware:
@@ -35,6 +39,11 @@ class TelegramAuthMiddleware:
                     ton_balance=1.00    # Добавляем начальный баланс TON
                 )
                 test_user.save()
+                from . import ledger
+                ledger.write([
+                    ledger.entry(test_id, "CF", test_user.cf_balance, "signup"),
+                    ledger.entry(test_id, "TON", test_user.ton_balance, "signup"),
+                ])
                 from trees.models import Tree
                 Tree.objects.create(user=test_user, type="CF")
             request.user = test_user
@@ -58,3 +67,37 @@ class TelegramAuthMiddleware:
 
         # Всё ок – продолжаем
         return self.get_response(request)
+
+
+class RateLimitMiddleware:
+    """
+    Ограничивает частоту запросов пользователя по маршрутам (см. users.ratelimit).
+    Работает после TelegramAuthMiddleware, поэтому охватывает и шаблонные
+    представления, и API. При превышении бюджета возвращает 429 с Retry-After.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        telegram_id = request.session.get("telegram_id")
+        match = request.resolver_match
+        if not telegram_id or match is None or match.namespace == "admin":
+            return None
+
+        budget = ratelimit.get_budget(match.view_name, request.method)
+        if budget is None:
+            return None
+
+        retry_after = ratelimit.consume(f"ratelimit:{telegram_id}:{match.view_name}", *budget)
+        if not retry_after:
+            return None
+        response = JsonResponse(
+            {"status": "error", "message": "Слишком много запросов, попробуйте позже"},
+            status=429,
+        )
+        response["Retry-After"] = str(math.ceil(retry_after))
+        return response
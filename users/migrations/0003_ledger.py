@@ -0,0 +1,60 @@
+# Generated by Django 5.1.1 on 2026-10-17 05:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def record_opening_balances(apps, schema_editor):
+    """Записывает текущие балансы пользователей как начальные остатки журнала"""
+    User = apps.get_model('users', 'User')
+    LedgerEntry = apps.get_model('users', 'LedgerEntry')
+    entries = []
+    for user_id, cf_balance, ton_balance in User.objects.values_list('pk', 'cf_balance', 'ton_balance').iterator():
+        for asset, balance in (('CF', cf_balance), ('TON', ton_balance)):
+            if balance:
+                entries.append(LedgerEntry(user_id=user_id, asset=asset, delta=balance, reason='opening'))
+    LedgerEntry.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_remove_user_not_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset', models.CharField(choices=[('CF', 'CF'), ('TON', 'TON')], max_length=10)),
+                ('balance', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('last_entry_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='users.user')),
+            ],
+            options={
+                'verbose_name': 'Снимок баланса',
+                'verbose_name_plural': 'Снимки балансов',
+                'indexes': [models.Index(fields=['user', 'asset', 'last_entry_id'], name='users_snapshot_user_idx'), models.Index(fields=['last_entry_id'], name='users_snapshot_entry_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset', models.CharField(choices=[('CF', 'CF'), ('TON', 'TON')], max_length=10)),
+                ('delta', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('reason', models.CharField(choices=[('opening', 'Начальный остаток'), ('signup', 'Регистрация'), ('referral', 'Реферальный бонус'), ('tree_income', 'Доход с дерева'), ('shop', 'Покупка в магазине'), ('staking', 'Стейкинг'), ('staking_reward', 'Награда за стейкинг'), ('staking_refund', 'Возврат стейкинга'), ('p2p_lock', 'Блокировка под ордер'), ('p2p_refund', 'Возврат по ордеру'), ('p2p_trade', 'Сделка P2P'), ('admin', 'Изменение администратором')], max_length=20)),
+                ('ref', models.CharField(blank=True, default='', max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='users.user')),
+            ],
+            options={
+                'verbose_name': 'Запись журнала балансов',
+                'verbose_name_plural': 'Журнал балансов',
+                'indexes': [models.Index(fields=['user', 'asset', 'id'], name='users_ledger_user_idx'), models.Index(fields=['created_at'], name='users_ledger_time_idx'), models.Index(fields=['ref'], name='users_ledger_ref_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-17 06:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100)),
+                ('path', models.CharField(max_length=255)),
+                ('status_code', models.PositiveSmallIntegerField(default=200)),
+                ('content_type', models.CharField(blank=True, default='', max_length=100)),
+                ('body', models.TextField(blank=True, default='')),
+                ('location', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to='users.user')),
+            ],
+            options={
+                'verbose_name': 'Ключ идемпотентности',
+                'verbose_name_plural': 'Ключи идемпотентности',
+                'indexes': [models.Index(fields=['created_at'], name='users_idempotency_time_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'key'), name='users_idempotency_key_uniq')],
+            },
+        ),
+    ]
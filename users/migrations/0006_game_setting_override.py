@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_scheduler_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameSettingOverride',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True)),
+                ('value', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Переопределение игровой настройки',
+                'verbose_name_plural': 'Переопределения игровых настроек',
+            },
+        ),
+    ]
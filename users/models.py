@@ -35,6 +35,10 @@ class User(models.Model):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            # Планировщик сроков: ближайшие окончания автополива
+            models.Index(fields=['auto_water_until'], name='users_auto_water_idx'),
+        ]
     
     def __str__(self):
         if self.username:
@@ -60,11 +64,130 @@ class User(models.Model):
     
     def can_access_staking(self):
         """Проверяет, может ли пользователь использовать стейкинг"""
-        from django.conf import settings
-        min_cf = settings.GAME_SETTINGS.get('MIN_CF_FOR_STAKING', 300)
-        return self.cf_balance >= min_cf
+        from .rules import get_rules
+        return self.cf_balance >= get_rules().min_cf_for_staking
     
     def can_access_p2p(self):
         """Проверяет, имеет ли пользователь доступ к P2P-бирже"""
         # Доступ открывается после стейкинга
         return self.staking_until is not None
+
+
+class LedgerEntry(models.Model):
+    """
+    Запись журнала балансов. Журнал только дополняется: каждое изменение
+    баланса пользователя записывается отдельной строкой с причиной и
+    ссылкой на объект, который его вызвал.
+    """
+    ASSET_CHOICES = (
+        ('CF', 'CF'),
+        ('TON', 'TON'),
+    )
+
+    REASON_CHOICES = (
+        ('opening', 'Начальный остаток'),
+        ('signup', 'Регистрация'),
+        ('referral', 'Реферальный бонус'),
+        ('tree_income', 'Доход с дерева'),
+        ('shop', 'Покупка в магазине'),
+        ('staking', 'Стейкинг'),
+        ('staking_reward', 'Награда за стейкинг'),
+        ('staking_refund', 'Возврат стейкинга'),
+        ('p2p_lock', 'Блокировка под ордер'),
+        ('p2p_refund', 'Возврат по ордеру'),
+        ('p2p_trade', 'Сделка P2P'),
+        ('admin', 'Изменение администратором'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ledger_entries')
+    asset = models.CharField(max_length=10, choices=ASSET_CHOICES)
+    delta = models.DecimalField(max_digits=20, decimal_places=8)
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    ref = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Запись журнала балансов'
+        verbose_name_plural = 'Журнал балансов'
+        indexes = [
+            # Остаток на момент T: записи пользователя после последнего снимка
+            models.Index(fields=['user', 'asset', 'id'], name='users_ledger_user_idx'),
+            models.Index(fields=['created_at'], name='users_ledger_time_idx'),
+            models.Index(fields=['ref'], name='users_ledger_ref_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.delta:+} {self.asset} ({self.reason})"
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Снимок остатка пользователя по активу: сумма всех записей журнала
+    с ``id <= last_entry_id``.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_snapshots')
+    asset = models.CharField(max_length=10, choices=LedgerEntry.ASSET_CHOICES)
+    balance = models.DecimalField(max_digits=20, decimal_places=8)
+    last_entry_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Снимок баланса'
+        verbose_name_plural = 'Снимки балансов'
+        indexes = [
+            models.Index(fields=['user', 'asset', 'last_entry_id'], name='users_snapshot_user_idx'),
+            models.Index(fields=['last_entry_id'], name='users_snapshot_entry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.asset}: {self.balance}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    Сохраненный ответ на запрос с заголовком ``Idempotency-Key``: повтор
+    запроса с тем же ключом получает этот ответ, не выполняясь заново.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=100)
+    path = models.CharField(max_length=255)
+    status_code = models.PositiveSmallIntegerField(default=200)
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    body = models.TextField(blank=True, default='')
+    location = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='users_idempotency_key_uniq'),
+        ]
+        indexes = [
+            # Удаление устаревших ключей
+            models.Index(fields=['created_at'], name='users_idempotency_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.key} ({self.path})"
+
+
+class GameSettingOverride(models.Model):
+    """
+    Значение игровой настройки, заменяющее ``GAME_SETTINGS[key]`` без
+    перезапуска (см. ``users.rules``)
+    """
+    key = models.CharField(max_length=50, unique=True)
+    value = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Переопределение игровой настройки'
+        verbose_name_plural = 'Переопределения игровых настроек'
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
+
+    def clean(self):
+        from .rules import validate_override
+        validate_override(self.key, self.value)
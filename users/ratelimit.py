@@ -0,0 +1,72 @@
+"""
+Ограничение частоты запросов пользователя (token bucket).
+
+Для каждого пользователя (``telegram_id`` из сессии) и маршрута хранится
+корзина токенов: ``capacity`` токенов, пополняемых со скоростью ``rate``
+в секунду. Каждый запрос забирает токен; пустая корзина означает отказ
+с 429. Бюджеты маршрутов задаются в ``GAME_SETTINGS['RATE_LIMITS']`` по
+имени маршрута (``water_tree``, ``p2p:buy_order``, ``p2p:order-buy``);
+бюджет ``default`` применяется к остальным изменяющим запросам.
+
+Состояние корзины — пара ``(токены, время обновления)`` в кеше Django.
+Чтение и запись корзины выполняются под меткой ``<ключ>:lock``, которую
+ставит атомарный ``cache.add``, поэтому лимит соблюдается для всех
+процессов с общим кешем. Если метку не удалось получить за
+``LOCK_WAIT_SECONDS`` (например, ее оставил упавший процесс), запрос
+отклоняется так же, как при пустой корзине.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# Сколько живет метка корзины и сколько ее ждет запрос
+LOCK_SECONDS = 1
+LOCK_WAIT_SECONDS = 0.2
+LOCK_POLL_SECONDS = 0.002
+
+
+def get_budget(view_name, method):
+    """Бюджет ``(capacity, rate)`` маршрута или None, если запрос не ограничивается"""
+    limits = settings.GAME_SETTINGS.get('RATE_LIMITS', {})
+    if view_name in limits:
+        return limits[view_name]
+    if method in UNSAFE_METHODS:
+        return limits.get('default')
+    return None
+
+
+def _acquire(lock_key):
+    """Ставит метку корзины; возвращает False, если не дождались ее снятия"""
+    deadline = time.monotonic() + LOCK_WAIT_SECONDS
+    while not cache.add(lock_key, 1, timeout=LOCK_SECONDS):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_SECONDS)
+    return True
+
+
+def consume(key, capacity, rate, now=None):
+    """
+    Забирает токен из корзины ``key``. Возвращает 0, если запрос разрешен,
+    иначе — через сколько секунд в корзине появится токен.
+    """
+    lock_key = f'{key}:lock'
+    if not _acquire(lock_key):
+        return LOCK_SECONDS
+    try:
+        now = time.time() if now is None else now
+        # Полная корзина больше не нужна: кеш может ее забыть
+        timeout = math.ceil(capacity / rate) + 1
+        tokens, updated = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+        if tokens >= 1:
+            cache.set(key, (tokens - 1, now), timeout=timeout)
+            return 0
+        cache.set(key, (tokens, now), timeout=timeout)
+        return (1 - tokens) / rate
+    finally:
+        cache.delete(lock_key)
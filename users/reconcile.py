@@ -0,0 +1,251 @@
+"""
+Сверка балансов пользователей с журналом и доменными таблицами.
+
+Пользователи читаются пачками по первичному ключу, каждая пачка
+проверяется независимо, поэтому пачки раздаются пулу процессов. Для
+пачки выполняются проверки:
+
+* ``balance`` — остаток по журналу (снимок + записи после него) совпадает
+  с ``cf_balance``/``ton_balance``;
+* ``shop``, ``staking``, ``referral`` — сумма записей журнала по причине
+  совпадает с суммой, пересчитанной по ``shop.Purchase``,
+  ``staking.Staking`` и ``referrals.ReferralBonus``;
+* ``p2p_trade`` — каждая завершенная ``p2p.Transaction`` проведена по
+  журналу с правильными суммами.
+
+Доход с деревьев не хранится в отдельной таблице и проверяется только
+сверкой ``balance``. Доменные записи, созданные до появления журнала,
+уже учтены начальными остатками и в сверку не попадают.
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from decimal import Decimal
+
+import django
+from django.db import connections
+from django.db.models import BigIntegerField, F, Min, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import ledger
+from .models import BalanceSnapshot, LedgerEntry, User
+
+DEFAULT_CHUNK_SIZE = 1000
+
+STAKING_REASONS = ('staking', 'staking_reward', 'staking_refund')
+ZERO = Decimal('0')
+
+
+def ledger_start():
+    """Момент появления журнала: время самой ранней записи"""
+    return LedgerEntry.objects.aggregate(start=Min('created_at'))['start']
+
+
+def iter_user_chunks(chunk_size=DEFAULT_CHUNK_SIZE, after=None):
+    """Выдает id пользователей пачками по возрастанию первичного ключа"""
+    queryset = User.objects.order_by('pk').values_list('pk', flat=True)
+    while True:
+        page = queryset.filter(pk__gt=after) if after is not None else queryset
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1]
+
+
+def ledger_balances(user_ids):
+    """Остатки по журналу: последний снимок плюс записи после него"""
+    balances = defaultdict(Decimal)
+    for (user_id, asset), snapshot in ledger.latest_snapshots(user_ids).items():
+        balances[user_id, asset] += snapshot.balance
+
+    last_snapshot = BalanceSnapshot.objects.filter(
+        user_id=OuterRef('user_id'), asset=OuterRef('asset')
+    ).order_by('-last_entry_id').values('last_entry_id')[:1]
+    rows = LedgerEntry.objects.filter(user_id__in=user_ids).annotate(
+        since=Coalesce(Subquery(last_snapshot), Value(0), output_field=BigIntegerField())
+    ).filter(id__gt=F('since')).values('user_id', 'asset').annotate(total=Sum('delta')).order_by()
+    for row in rows:
+        balances[row['user_id'], row['asset']] += row['total']
+    return balances
+
+
+def ledger_totals(user_ids, reasons):
+    """Сумма записей журнала с указанными причинами по пользователю и активу"""
+    rows = LedgerEntry.objects.filter(user_id__in=user_ids, reason__in=reasons).values(
+        'user_id', 'asset'
+    ).annotate(total=Sum('delta')).order_by()
+    return {(row['user_id'], row['asset']): row['total'] for row in rows}
+
+
+def shop_expected(user_ids, since):
+    """Списания за покупки в магазине"""
+    from shop.models import Purchase
+
+    rows = Purchase.objects.filter(user_id__in=user_ids, created_at__gte=since).values(
+        'user_id', 'item__price_token_type'
+    ).annotate(total=Sum('price_paid')).order_by()
+    return {
+        (row['user_id'], row['item__price_token_type']): -row['total']
+        for row in rows if row['item__price_token_type'] in ledger.BALANCE_FIELDS
+    }
+
+
+def staking_expected(user_ids, since):
+    """
+    Движения по стейкингу CF: списание при создании, возврат с наградой
+    при получении и возврат без награды при отмене администратором.
+    """
+    from staking.models import Staking
+
+    expected = defaultdict(Decimal)
+    stakings = Staking.objects.filter(user_id__in=user_ids, token_type='CF').filter(
+        Q(start_date__gte=since) | Q(claimed_date__gte=since)
+    ).values('user_id', 'amount', 'reward_amount', 'status', 'start_date', 'claimed_date')
+    for staking in stakings:
+        key = (staking['user_id'], 'CF')
+        if staking['start_date'] >= since:
+            expected[key] -= staking['amount']
+        if staking['claimed_date'] is None or staking['claimed_date'] < since:
+            continue
+        if staking['status'] == 'claimed':
+            expected[key] += staking['amount'] + (staking['reward_amount'] or ZERO)
+        elif staking['status'] == 'completed':
+            expected[key] += staking['amount']
+    return expected
+
+
+def referral_expected(user_ids, since):
+    """Реферальные бонусы, начисленные пригласившим"""
+    from referrals.models import ReferralBonus
+
+    rows = ReferralBonus.objects.filter(
+        referral__inviter_id__in=user_ids, created_at__gte=since
+    ).values('referral__inviter_id').annotate(total=Sum('amount')).order_by()
+    return {(row['referral__inviter_id'], 'CF'): row['total'] for row in rows}
+
+
+def p2p_mismatches(user_ids, since):
+    """
+    Сверяет проводки завершенных сделок пользователей с журналом.
+
+    Токены продавца могут быть списаны при сделке или заблокированы раньше
+    под его ордер, поэтому эта нога сделки не сверяется; остальные
+    движения однозначно определяются сделкой.
+    """
+    from p2p.models import Transaction
+    from p2p.settlement import add_transaction_deltas, balance_field, is_supported, new_deltas
+
+    deals = Transaction.objects.filter(status='completed', created_at__gte=since).filter(
+        Q(buyer_id__in=user_ids) | Q(seller_id__in=user_ids)
+    ).select_related('order')
+    expected = {}
+    for deal in deals:
+        if not is_supported(deal.token_type):
+            continue
+        ref = ledger.make_ref(deal)
+        skip = (deal.seller_id, ledger.ASSETS[balance_field(deal.token_type)])
+        for user_id, fields in add_transaction_deltas(new_deltas(), deal).items():
+            for field, delta in fields.items():
+                key = (user_id, ledger.ASSETS[field])
+                if user_id in user_ids and key != skip and delta:
+                    expected[ref, user_id, key[1]] = ledger.quantize(key[1], delta)
+    if not expected:
+        return []
+
+    refs = {ref for ref, _, _ in expected}
+    rows = LedgerEntry.objects.filter(reason='p2p_trade', ref__in=refs, user_id__in=user_ids).values(
+        'ref', 'user_id', 'asset'
+    ).annotate(total=Sum('delta')).order_by()
+    booked = {(row['ref'], row['user_id'], row['asset']): row['total'] for row in rows}
+
+    mismatches = []
+    for (ref, user_id, asset), delta in expected.items():
+        actual = booked.get((ref, user_id, asset), ZERO)
+        if actual != delta:
+            mismatches.append(mismatch(user_id, asset, 'p2p_trade', delta, actual, ref=ref))
+    return mismatches
+
+
+def mismatch(user_id, asset, check, expected, actual, ref=None):
+    """Описание расхождения для отчета; суммы приводятся к точности баланса актива"""
+    expected, actual = ledger.quantize(asset, expected), ledger.quantize(asset, actual)
+    item = {
+        'user_id': user_id,
+        'asset': asset,
+        'check': check,
+        'expected': str(expected),
+        'actual': str(actual),
+        'difference': str(actual - expected),
+    }
+    if ref:
+        item['ref'] = ref
+    return item
+
+
+def compare(check, expected, actual):
+    """Расхождения между двумя словарями сумм ``{(user_id, asset): Decimal}``"""
+    mismatches = []
+    for key in sorted(set(expected) | set(actual)):
+        if expected.get(key, ZERO) != actual.get(key, ZERO):
+            mismatches.append(mismatch(key[0], key[1], check, expected.get(key, ZERO), actual.get(key, ZERO)))
+    return mismatches
+
+
+def reconcile_chunk(user_ids, since=None):
+    """Проверяет пачку пользователей и возвращает список расхождений"""
+    user_ids = set(user_ids)
+    actual = {}
+    for row in User.objects.filter(pk__in=user_ids).values('pk', *ledger.BALANCE_FIELDS.values()):
+        for asset, field in ledger.BALANCE_FIELDS.items():
+            actual[row['pk'], asset] = row[field]
+
+    mismatches = compare('balance', ledger_balances(user_ids), actual)
+    if since is None:
+        return mismatches
+
+    mismatches += compare('shop', shop_expected(user_ids, since), ledger_totals(user_ids, ['shop']))
+    mismatches += compare(
+        'staking', staking_expected(user_ids, since), ledger_totals(user_ids, STAKING_REASONS)
+    )
+    mismatches += compare(
+        'referral', referral_expected(user_ids, since), ledger_totals(user_ids, ['referral'])
+    )
+    mismatches += p2p_mismatches(user_ids, since)
+    return mismatches
+
+
+def _init_worker(settings_module):
+    """Инициализация процесса пула: настройка Django и собственные соединения с БД"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+    connections.close_all()
+
+
+def reconcile(chunk_size=DEFAULT_CHUNK_SIZE, workers=None):
+    """
+    Сверяет всех пользователей и выдает расхождения по мере готовности пачек.
+    При ``workers=1`` пачки проверяются в текущем процессе, иначе — в пуле
+    процессов; в работе одновременно не больше двух пачек на процесс.
+    """
+    since = ledger_start()
+    chunks = iter_user_chunks(chunk_size)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in chunks:
+            yield from reconcile_chunk(chunk, since)
+        return
+
+    # Дочерние процессы не должны наследовать открытые соединения
+    connections.close_all()
+    settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'cryptofarm.settings')
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings_module,)) as pool:
+        pending = set()
+        for chunk in chunks:
+            pending.add(pool.submit(reconcile_chunk, chunk, since))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
@@ -0,0 +1,203 @@
+"""
+Игровые правила, собранные из ``settings.GAME_SETTINGS``.
+
+Вместо разбора ``GAME_SETTINGS`` и построения ``timedelta`` при каждом
+вызове модели обращаются к объекту ``GameRules``: длительности уже
+переведены в ``timedelta``, а таблица уровней деревьев разложена в массивы,
+индексируемые уровнем. Объект строится один раз на процесс.
+
+Значения из ``GAME_SETTINGS`` можно переопределить записями
+``GameSettingOverride`` без перезапуска. Раз в
+``GAME_SETTINGS['GAME_RULES_RELOAD']`` секунд процесс сверяет версию
+переопределений (количество записей и время последнего изменения) и
+пересобирает правила, если она изменилась; 0 отключает чтение из базы.
+Значения переопределений проверяются при сохранении (``validate_override``),
+а если правила все же не собрались, процесс продолжает работать с
+последними удачно собранными.
+"""
+import logging
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from .models import GameSettingOverride
+
+DEFAULTS = {
+    'WATERING_DURATION': 5,
+    'TREE_LEVELS': {},
+    'BRANCH_DROP_CHANCE': 0.1,
+    'AUTO_WATER_BRANCH_BOOST': 1.5,
+    'STAKING_DURATION': 7,
+    'STAKING_BONUS': 0.1,
+    'MIN_CF_FOR_STAKING': 300,
+}
+
+# Допустимые значения числовых настроек: (минимум, максимум или None)
+NUMBER_RANGES = {
+    'WATERING_DURATION': (0, None),
+    'BRANCH_DROP_CHANCE': (0, 1),
+    'AUTO_WATER_BRANCH_BOOST': (0, None),
+    'STAKING_DURATION': (0, None),
+    'STAKING_BONUS': (0, None),
+    'MIN_CF_FOR_STAKING': (0, None),
+}
+# Параметры уровня дерева и их допустимые типы
+LEVEL_PARAMS = {'branches': (int,), 'income': (int, float)}
+
+logger = logging.getLogger(__name__)
+
+
+class GameRules:
+    """Неизменяемый снимок игровых правил"""
+
+    __slots__ = (
+        'version', 'watering_duration', 'branch_drop_chance', 'auto_water_boost',
+        'max_level', 'level_branches', 'level_income',
+        'staking_duration', 'staking_bonus', 'min_cf_for_staking',
+    )
+
+    def __init__(self, values, version=None):
+        values = dict(DEFAULTS, **values)
+        # Ключи уровней из JSON-переопределений приходят строками
+        levels = {int(level): params for level, params in values['TREE_LEVELS'].items()}
+        self.version = version
+        self.watering_duration = timezone.timedelta(hours=values['WATERING_DURATION'])
+        self.branch_drop_chance = float(values['BRANCH_DROP_CHANCE'])
+        self.auto_water_boost = float(values['AUTO_WATER_BRANCH_BOOST'])
+        self.max_level = max(levels, default=1)
+        # Индекс — уровень; None — параметр уровня не задан
+        self.level_branches = tuple(levels.get(level, {}).get('branches') for level in range(self.max_level + 1))
+        self.level_income = tuple(levels.get(level, {}).get('income') for level in range(self.max_level + 1))
+        self.staking_duration = timezone.timedelta(days=values['STAKING_DURATION'])
+        self.staking_bonus = Decimal(str(values['STAKING_BONUS']))
+        self.min_cf_for_staking = values['MIN_CF_FOR_STAKING']
+
+    def branches_for(self, level):
+        """Сколько веток нужно для уровня (0, если уровень не описан)"""
+        if 0 < level <= self.max_level:
+            return self.level_branches[level] or 0
+        return 0
+
+    def income_for(self, level, default):
+        """Доход в час на уровне или ``default``, если уровень не описан"""
+        if 0 < level <= self.max_level and self.level_income[level] is not None:
+            return self.level_income[level]
+        return default
+
+    def branch_chance(self, auto_watered):
+        """Шанс выпадения ветки при поливе"""
+        if auto_watered:
+            return self.branch_drop_chance * self.auto_water_boost
+        return self.branch_drop_chance
+
+
+def _is_number(value, types=(int, float)):
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _validate_levels(value):
+    if not isinstance(value, dict):
+        raise ValidationError({'value': 'Ожидается объект {уровень: {"branches": ..., "income": ...}}'})
+    for level, params in value.items():
+        try:
+            level = int(level)
+        except (TypeError, ValueError):
+            raise ValidationError({'value': f'Уровень должен быть числом: {level}'})
+        if level < 1 or not isinstance(params, dict):
+            raise ValidationError({'value': f'Некорректное описание уровня {level}'})
+        for name, param in params.items():
+            if name not in LEVEL_PARAMS:
+                raise ValidationError({'value': f'Неизвестный параметр уровня {level}: {name}'})
+            if not _is_number(param, LEVEL_PARAMS[name]) or param < 0:
+                raise ValidationError({'value': f'Некорректное значение {name} уровня {level}: {param}'})
+
+
+def validate_override(key, value):
+    """
+    Проверяет переопределение ``GameSettingOverride``: ключ должен быть
+    из ``DEFAULTS``, значение — подходящего типа и диапазона.
+    Выбрасывает ``ValidationError``.
+    """
+    if key not in DEFAULTS:
+        raise ValidationError({'key': f"Неизвестная настройка. Допустимые: {', '.join(DEFAULTS)}"})
+    if key == 'TREE_LEVELS':
+        _validate_levels(value)
+    else:
+        low, high = NUMBER_RANGES[key]
+        if not _is_number(value) or value < low or (high is not None and value > high):
+            bounds = f'от {low} до {high}' if high is not None else f'не меньше {low}'
+            raise ValidationError({'value': f'Ожидается число {bounds}'})
+    try:
+        GameRules(dict(settings.GAME_SETTINGS, **{key: value}))
+    except (ArithmeticError, TypeError, ValueError, OverflowError):
+        raise ValidationError({'value': 'Правила с этим значением не собираются'})
+
+
+_rules = None
+_checked_at = None
+_lock = threading.Lock()
+
+
+def _override_version():
+    stats = GameSettingOverride.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+    return stats['count'], stats['updated']
+
+
+def _build(version):
+    values = dict(settings.GAME_SETTINGS)
+    if version is not None and version[0]:
+        values.update(GameSettingOverride.objects.values_list('key', 'value'))
+    return GameRules(values, version)
+
+
+def get_rules():
+    """Текущие правила; при необходимости перечитывает переопределения из базы"""
+    global _rules, _checked_at
+    rules = _rules
+    reload_seconds = settings.GAME_SETTINGS.get('GAME_RULES_RELOAD', 0)
+    if rules is not None and (not reload_seconds or time.monotonic() - _checked_at < reload_seconds):
+        return rules
+    with _lock:
+        if _rules is None or time.monotonic() - _checked_at >= reload_seconds:
+            version = _override_version() if reload_seconds else None
+            if _rules is None or version != _rules.version:
+                try:
+                    _rules = _build(version)
+                except Exception:
+                    # Некорректное переопределение не должно ломать игру:
+                    # остаются последние собранные правила (или правила из settings)
+                    logger.exception("Не удалось собрать игровые правила из переопределений")
+                    if _rules is None:
+                        _rules = GameRules(settings.GAME_SETTINGS)
+            _checked_at = time.monotonic()
+        return _rules
+
+
+def reset():
+    """Сбрасывает правила; при следующем обращении они будут собраны заново"""
+    global _rules, _checked_at
+    with _lock:
+        _rules = None
+        _checked_at = None
+
+
+def _settings_changed(setting, **kwargs):
+    if setting == 'GAME_SETTINGS':
+        reset()
+
+
+def _override_changed(**kwargs):
+    # Свой процесс видит изменение сразу, остальные — при следующей сверке версии
+    reset()
+
+
+setting_changed.connect(_settings_changed)
+post_save.connect(_override_changed, sender=GameSettingOverride)
+post_delete.connect(_override_changed, sender=GameSettingOverride)
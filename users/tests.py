@@ -1,3 +1,436 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+import json
+import os
+import tempfile
+import threading
 
-# Create your tests here.
+from django.http import JsonResponse
+from django.urls import reverse
+
+from p2p.models import Order, Transaction
+from p2p.settlement import settle_transactions
+from shop.models import Purchase, ShopItem
+from staking.models import Staking
+from trees.models import Tree
+from users import ledger, ratelimit, rules
+from users.idempotency import REPLAY_HEADER, idempotent
+from users.models import BalanceSnapshot, GameSettingOverride, IdempotencyKey, LedgerEntry, User
+from users.reconcile import iter_user_chunks, reconcile
+
+
+class LedgerTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(telegram_id=111111111, username='first', first_name='First')
+        self.other = User.objects.create(telegram_id=222222222, username='second', first_name='Second')
+
+    def test_entries_from_deltas(self):
+        """Нулевые изменения и поля без актива журнала не записываются"""
+        deltas = {
+            self.user.pk: {'cf_balance': Decimal('5'), 'ton_balance': Decimal('0')},
+            self.other.pk: {'ton_balance': Decimal('-1.5'), 'staking_cf': Decimal('3')},
+        }
+        entries = ledger.entries_from_deltas(deltas, 'p2p_trade', 'p2p.transaction:1')
+        self.assertEqual(
+            sorted((item.user_id, item.asset, item.delta) for item in entries),
+            [(self.user.pk, 'CF', Decimal('5')), (self.other.pk, 'TON', Decimal('-1.5'))]
+        )
+
+        with self.assertNumQueries(1):
+            ledger.write(entries + [None])
+        self.assertEqual(LedgerEntry.objects.filter(ref='p2p.transaction:1').count(), 2)
+
+    def test_balance_at_uses_latest_snapshot(self):
+        ledger.record(self.user.pk, 'CF', '100', 'signup')
+        ledger.record(self.user.pk, 'CF', '-30', 'shop')
+        self.assertEqual(ledger.take_snapshots(settle_seconds=0), 1)
+        snapshot = BalanceSnapshot.objects.get(user=self.user, asset='CF')
+        self.assertEqual(snapshot.balance, Decimal('70'))
+
+        ledger.record(self.user.pk, 'CF', '5', 'tree_income')
+        self.assertEqual(ledger.balance_at(self.user.pk, 'CF'), Decimal('75'))
+        self.assertEqual(ledger.balance_at(self.user.pk, 'TON'), Decimal('0'))
+
+        # До снимка остаток считается по записям журнала
+        past = timezone.now() - timezone.timedelta(days=1)
+        self.assertEqual(ledger.balance_at(self.user.pk, 'CF', when=past), Decimal('0'))
+
+    def test_snapshots_only_cover_new_entries(self):
+        """Следующий проход создает снимки только для пользователей с новыми записями"""
+        ledger.record(self.user.pk, 'CF', '10', 'signup')
+        ledger.record(self.other.pk, 'TON', '2', 'signup')
+        self.assertEqual(ledger.take_snapshots(settle_seconds=0), 2)
+        self.assertEqual(ledger.take_snapshots(settle_seconds=0), 0)
+
+        ledger.record(self.user.pk, 'CF', '-4', 'shop')
+        self.assertEqual(ledger.take_snapshots(settle_seconds=0), 1)
+        latest = ledger.latest_snapshots([self.user.pk, self.other.pk])
+        self.assertEqual(latest[(self.user.pk, 'CF')].balance, Decimal('6'))
+        self.assertEqual(latest[(self.other.pk, 'TON')].balance, Decimal('2'))
+
+    def test_fresh_entries_wait_for_next_pass(self):
+        ledger.record(self.user.pk, 'CF', '10', 'signup')
+        self.assertEqual(ledger.take_snapshots(settle_seconds=60), 0)
+
+    def test_management_command(self):
+        ledger.record(self.user.pk, 'CF', '10', 'signup')
+        out = StringIO()
+        call_command('snapshot_balances', '--settle', '0', stdout=out)
+        self.assertIn('Создано снимков: 1', out.getvalue())
+
+
+class TelegramLoginLedgerTest(TestCase):
+    def test_signup_and_referral_bonus_are_recorded(self):
+        referrer = User.objects.create(telegram_id=333333333, username='ref', first_name='Ref')
+        self.client.get('/telegram_login/', {'tg_id': '444444444', 'ref': str(referrer.pk)})
+
+        self.assertEqual(ledger.balance_at(444444444, 'CF'), Decimal('100'))
+        self.assertEqual(ledger.balance_at(referrer.pk, 'CF'), Decimal('10'))
+        referrer.refresh_from_db()
+        self.assertEqual(referrer.cf_balance, Decimal('10'))
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(telegram_id=111111111, username='seller', first_name='Seller')
+        self.buyer = User.objects.create(telegram_id=222222222, username='buyer', first_name='Buyer')
+        # Начальные остатки проводятся через журнал, как при регистрации
+        for user in (self.seller, self.buyer):
+            User.objects.filter(pk=user.pk).update(cf_balance=Decimal('500'), ton_balance=Decimal('50'))
+            ledger.write([
+                ledger.entry(user.pk, 'CF', '500', 'opening'),
+                ledger.entry(user.pk, 'TON', '50', 'opening'),
+            ])
+
+    def login(self, user):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+
+    def create_deal(self):
+        order = Order.objects.create(
+            user=self.seller,
+            type='sell',
+            token_type='CF',
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            min_amount=Decimal('1'),
+            expires_at=timezone.now() + timezone.timedelta(days=3)
+        )
+        return Transaction.objects.create(
+            order=order,
+            buyer=self.buyer,
+            seller=self.seller,
+            amount=Decimal('10'),
+            price_per_unit=Decimal('0.5'),
+            token_type='CF',
+            commission=Decimal('0.15'),
+            status='paid'
+        )
+
+    def run_reconcile(self):
+        return list(reconcile(chunk_size=1, workers=1))
+
+    def test_consistent_history_has_no_mismatches(self):
+        settle_transactions([self.create_deal()])
+
+        item = ShopItem.objects.create(name='Удобрение', type='fertilizer', price=Decimal('20'), duration=24)
+        self.login(self.buyer)
+        response = self.client.post(reverse('buy_item', args=[item.id]))
+        self.assertEqual(response.json()['status'], 'success')
+
+        Staking.objects.create(
+            user=self.seller, amount=Decimal('100'), reward_amount=Decimal('10'), token_type='CF',
+            status='claimed', end_date=timezone.now(), claimed_date=timezone.now()
+        )
+        User.objects.filter(pk=self.seller.pk).update(cf_balance=Decimal('510'))
+        ledger.write([
+            ledger.entry(self.seller.pk, 'CF', '-100', 'staking'),
+            ledger.entry(self.seller.pk, 'CF', '110', 'staking_reward'),
+        ])
+        ledger.take_snapshots(settle_seconds=0)
+
+        self.assertEqual(self.run_reconcile(), [])
+
+    def test_reports_balance_and_source_mismatches(self):
+        item = ShopItem.objects.create(name='Удобрение', type='fertilizer', price=Decimal('20'), duration=24)
+        self.login(self.buyer)
+        self.client.post(reverse('buy_item', args=[item.id]))
+        # Запись журнала потеряна, а баланс продавца изменен в обход журнала
+        LedgerEntry.objects.filter(reason='shop').delete()
+        User.objects.filter(pk=self.seller.pk).update(cf_balance=Decimal('505'))
+
+        found = {(item['user_id'], item['asset'], item['check']): item for item in self.run_reconcile()}
+        self.assertEqual(set(found), {
+            (self.buyer.pk, 'CF', 'balance'),
+            (self.buyer.pk, 'CF', 'shop'),
+            (self.seller.pk, 'CF', 'balance'),
+        })
+        self.assertEqual(found[self.seller.pk, 'CF', 'balance']['difference'], '5.00')
+        self.assertEqual(found[self.buyer.pk, 'CF', 'shop']['expected'], '-20.00')
+
+    def test_reports_deals_missing_from_ledger(self):
+        deal = self.create_deal()
+        Transaction.objects.filter(pk=deal.pk).update(status='completed')
+
+        checks = {
+            (item['user_id'], item['asset'], item['expected'])
+            for item in self.run_reconcile() if item['check'] == 'p2p_trade'
+        }
+        self.assertEqual(checks, {
+            (self.buyer.pk, 'CF', '10.00'),
+            (self.buyer.pk, 'TON', '-5.15000000'),
+            (self.seller.pk, 'TON', '5.00000000'),
+        })
+
+    def test_iter_user_chunks(self):
+        User.objects.create(telegram_id=333333333, first_name='Third')
+        chunks = list(iter_user_chunks(chunk_size=2))
+        self.assertEqual(chunks, [[111111111, 222222222], [333333333]])
+
+    def test_management_command_writes_jsonl(self):
+        User.objects.filter(pk=self.buyer.pk).update(ton_balance=Decimal('49'))
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            out = StringIO()
+            call_command('reconcile_balances', '--workers', '1', '--output', path, stdout=out)
+            with open(path, encoding='utf-8') as report:
+                lines = [json.loads(line) for line in report]
+        finally:
+            os.remove(path)
+
+        self.assertIn('Расхождений: 1', out.getvalue())
+        self.assertEqual(lines[0]['user_id'], self.buyer.pk)
+        self.assertEqual(lines[0]['check'], 'balance')
+        self.assertEqual(lines[0]['difference'], '-1.00000000')
+
+
+class IdempotencyTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            telegram_id=111111111, username='buyer', first_name='Buyer', cf_balance=Decimal('100')
+        )
+        self.item = ShopItem.objects.create(name='Удобрение', type='fertilizer', price=Decimal('20'), duration=24)
+        cache.clear()
+        session = self.client.session
+        session['telegram_id'] = self.user.telegram_id
+        session.save()
+
+    def buy(self, key=None, item=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(reverse('buy_item', args=[(item or self.item).id]), **headers)
+
+    def test_retry_returns_stored_response(self):
+        first = self.buy('retry-1')
+        second = self.buy('retry-1')
+
+        self.assertEqual(first.json()['status'], 'success')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second[REPLAY_HEADER], 'true')
+        self.assertEqual(Purchase.objects.count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(reason='shop').count(), 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('80'))
+
+    def test_requests_without_key_are_not_deduplicated(self):
+        self.buy()
+        self.buy()
+        self.assertEqual(Purchase.objects.count(), 2)
+
+    def test_key_reused_for_another_request(self):
+        other = ShopItem.objects.create(name='Полив', type='fertilizer', price=Decimal('5'), duration=24)
+        self.buy('retry-1')
+        response = self.buy('retry-1', item=other)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Purchase.objects.count(), 1)
+
+    def test_expired_key_runs_again(self):
+        self.buy('retry-1')
+        IdempotencyKey.objects.update(created_at=timezone.now() - timezone.timedelta(days=2))
+        self.assertNotIn(REPLAY_HEADER, self.buy('retry-1'))
+        self.assertEqual(Purchase.objects.count(), 2)
+
+    def test_server_error_is_rolled_back(self):
+        calls = []
+
+        @idempotent
+        def view(request):
+            calls.append(1)
+            User.objects.filter(pk=request.user.pk).update(cf_balance=Decimal('0'))
+            return JsonResponse({'status': 'error'}, status=503)
+
+        request = RequestFactory().post('/fail/', HTTP_IDEMPOTENCY_KEY='retry-1')
+        request.user = self.user
+        view(request)
+        view(request)
+
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cf_balance, Decimal('100'))
+
+    def test_purge_command(self):
+        self.buy('old')
+        self.buy('new')
+        IdempotencyKey.objects.filter(key='old').update(created_at=timezone.now() - timezone.timedelta(days=2))
+        out = StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Удалено ключей: 1', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+@override_settings(GAME_SETTINGS=dict(
+    settings.GAME_SETTINGS, RATE_LIMITS={'default': (3, 1.0), 'water_tree': (2, 0.01)}
+))
+class RateLimitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(telegram_id=111111111, username='farmer', first_name='Farmer')
+        self.tree = Tree.objects.create(user=self.user, type='CF')
+        self.login(self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def login(self, user):
+        session = self.client.session
+        session['telegram_id'] = user.telegram_id
+        session.save()
+
+    def test_bucket_refills_over_time(self):
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=100), 0)
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=100), 0)
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=100), 2)
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=101), 1)
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=102), 0)
+
+    def test_bucket_is_shared_between_concurrent_requests(self):
+        """Параллельные запросы не забирают из корзины больше ее емкости"""
+        results = []
+        start = threading.Barrier(10)
+
+        def request():
+            start.wait()
+            results.append(ratelimit.consume('bucket', 5, 0.001, now=100))
+
+        threads = [threading.Thread(target=request) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(0), 5)
+
+    def test_busy_bucket_is_refused(self):
+        """Пока корзину держит другой процесс, запрос отклоняется и корзину не трогает"""
+        cache.add('bucket:lock', 1)
+        with mock.patch.object(ratelimit, 'LOCK_WAIT_SECONDS', 0):
+            self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=100), ratelimit.LOCK_SECONDS)
+        self.assertIsNone(cache.get('bucket'))
+
+        cache.delete('bucket:lock')
+        self.assertEqual(ratelimit.consume('bucket', 2, 0.5, now=100), 0)
+
+    def test_route_budget_returns_429(self):
+        url = reverse('water_tree', args=[self.tree.id])
+        self.assertEqual(self.client.post(url).status_code, 200)
+        self.assertEqual(self.client.post(url).status_code, 200)
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(response['Retry-After'], '100')
+
+    def test_buckets_are_per_user(self):
+        url = reverse('water_tree', args=[self.tree.id])
+        self.client.post(url)
+        self.client.post(url)
+
+        other = User.objects.create(telegram_id=222222222, username='other', first_name='Other')
+        tree = Tree.objects.create(user=other, type='CF')
+        self.login(other)
+        self.assertEqual(self.client.post(reverse('water_tree', args=[tree.id])).status_code, 200)
+
+    def test_default_budget_covers_only_unsafe_methods(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get(reverse('shop')).status_code, 200)
+        url = reverse('collect_income', args=[self.tree.id])
+        statuses = [self.client.post(url).status_code for _ in range(4)]
+        self.assertEqual(statuses[-1], 429)
+        self.assertNotIn(429, statuses[:3])
+
+
+class GameRulesTest(TestCase):
+    def tearDown(self):
+        rules.reset()
+
+    def test_level_tables_are_indexed_by_level(self):
+        game_rules = rules.GameRules(settings.GAME_SETTINGS)
+        self.assertEqual(game_rules.max_level, 5)
+        self.assertEqual(game_rules.level_branches[2], 5)
+        self.assertEqual(game_rules.income_for(3, 1.0), 2.0)
+        self.assertEqual(game_rules.income_for(6, 3.0), 3.0)
+        self.assertEqual(game_rules.watering_duration, timezone.timedelta(hours=5))
+        self.assertAlmostEqual(game_rules.branch_chance(True), 0.15)
+        with self.assertRaises(AttributeError):
+            game_rules.extra = 1
+
+    def test_override_applies_without_restart(self):
+        GameSettingOverride.objects.create(key='TREE_LEVELS', value={'1': {'branches': 0, 'income': 1.0}, '2': {'branches': 3}})
+        self.assertEqual(rules.get_rules().max_level, 2)
+        self.assertEqual(rules.get_rules().branches_for(2), 3)
+
+    @override_settings(GAME_SETTINGS=dict(settings.GAME_SETTINGS, GAME_RULES_RELOAD=1e-6))
+    def test_override_from_other_process_is_picked_up_by_version(self):
+        override = GameSettingOverride.objects.create(key='BRANCH_DROP_CHANCE', value=0.2)
+        self.assertEqual(rules.get_rules().branch_drop_chance, 0.2)
+
+        # Изменение другим процессом: сигналы этого процесса не срабатывают
+        GameSettingOverride.objects.filter(pk=override.pk).update(
+            value=0.3, updated_at=timezone.now() + timezone.timedelta(seconds=1)
+        )
+        self.assertEqual(rules.get_rules().branch_drop_chance, 0.3)
+
+    def test_settings_are_read_once(self):
+        rules.get_rules()
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                rules.get_rules()
+
+    def test_override_values_are_validated(self):
+        GameSettingOverride(key='BRANCH_DROP_CHANCE', value=0.2).full_clean()
+        GameSettingOverride(key='TREE_LEVELS', value={'1': {'branches': 0, 'income': 1}}).full_clean()
+        invalid = [
+            ('UNKNOWN', 1),
+            ('BRANCH_DROP_CHANCE', 'often'),
+            ('BRANCH_DROP_CHANCE', 2),
+            ('STAKING_DURATION', True),
+            ('TREE_LEVELS', [1, 2]),
+            ('TREE_LEVELS', {'one': {'branches': 1}}),
+            ('TREE_LEVELS', {'2': {'branches': 'many'}}),
+        ]
+        for key, value in invalid:
+            with self.subTest(key=key, value=value), self.assertRaises(ValidationError):
+                GameSettingOverride(key=key, value=value).full_clean()
+
+    @override_settings(GAME_SETTINGS=dict(settings.GAME_SETTINGS, GAME_RULES_RELOAD=1e-6))
+    def test_bad_override_keeps_last_good_rules(self):
+        GameSettingOverride.objects.create(key='BRANCH_DROP_CHANCE', value=0.2)
+        self.assertEqual(rules.get_rules().branch_drop_chance, 0.2)
+
+        # Запись в обход проверки модели (например, другим процессом)
+        GameSettingOverride.objects.bulk_create([GameSettingOverride(key='WATERING_DURATION', value='long')])
+        with self.assertLogs('users.rules', 'ERROR'):
+            game_rules = rules.get_rules()
+        self.assertEqual(game_rules.branch_drop_chance, 0.2)
+
+        rules.reset()
+        with self.assertLogs('users.rules', 'ERROR'):
+            self.assertEqual(rules.get_rules().watering_duration, timezone.timedelta(hours=5))
@@ -2,6 +2,7 @@
 
 from django.shortcuts import render, redirect, get_object_or_404
 from .models import User
+from . import ledger
 from trees.models import Tree
 from referrals.models import Referral, ReferralBonus
 
@@ -31,6 +32,7 @@ def telegram_login(request):
         Tree.objects.create(user=user, type="CF")
         user.cf_balance = 100
         user.save()
+        entries = [ledger.entry(user.pk, "CF", user.cf_balance, "signup")]
         ref_code = request.GET.get("ref")
         if ref_code:
             try:
@@ -59,6 +61,8 @@ def telegram_login(request):
                     )
                     referrer.cf_balance += 10
                     referrer.save()
+                    entries.append(ledger.entry(referrer.pk, "CF", 10, "referral", referral))
+        ledger.write(entries)
     else:
         if not Tree.objects.filter(user=user).exists():
             Tree.objects.create(user=user, type="CF")